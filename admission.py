@@ -0,0 +1,185 @@
+import asyncio
+import collections
+import contextlib
+
+# Admission control for CPU heavy work (validating and simulating new jobs)
+# At most `concurrency` tasks run at the same time; others wait in a pending queue in order of arrival
+# Once `max_pending` tasks are waiting, new tasks are rejected (load shedding)
+# Background tasks (e.g. refining estimates) only run when no regular task is waiting, and are never rejected
+
+class Overloaded(Exception):
+    pass
+
+class Admission:
+    def __init__(self, concurrency = 2, max_pending = 20):
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self.running = 0
+        self.waiting = collections.deque() # (future, notify_cb)
+        self.background = collections.deque() # futures
+        self.rejected = 0 # number of tasks rejected so far
+    
+    def pending(self):
+        return len(self.waiting)
+    
+    def _notify(self, start = 0):
+        for i in range(start, len(self.waiting)):
+            future, notify = self.waiting[i]
+            if notify != None: notify(i)
+    
+    # Wait for a free slot; notify(n) is called with the number of tasks ahead while waiting
+    # Raises Overloaded if too many tasks are waiting
+    async def acquire(self, notify = None, background = False):
+        if self.running < self.concurrency and not self.waiting and not self.background:
+            self.running += 1
+            return
+        if not background and len(self.waiting) >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded(f'Too many pending jobs ({len(self.waiting)})')
+        
+        future = asyncio.get_running_loop().create_future()
+        if background:
+            self.background.append(future)
+        else:
+            self.waiting.append((future, notify))
+            if notify != None: notify(len(self.waiting) - 1)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # got the slot, but won't use it
+            elif background:
+                if future in self.background: self.background.remove(future) # release() might have dropped it already
+            else:
+                idx = next( (i for i, x in enumerate(self.waiting) if x[0] is future), None )
+                if idx != None:
+                    del self.waiting[idx]
+                    self._notify(idx)
+            raise
+    
+    # Free a slot, it is handed over to the next waiting task
+    def release(self):
+        while self.waiting:
+            future, notify = self.waiting.popleft()
+            if not future.done():
+                future.set_result(True)
+                self._notify()
+                return
+        while self.background:
+            future = self.background.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        self.running -= 1
+    
+    @contextlib.asynccontextmanager
+    async def slot(self, notify = None, background = False):
+        await self.acquire(notify, background)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+if __name__ == '__main__':
+    import unittest
+    
+    class Test(unittest.IsolatedAsyncioTestCase):
+        async def test_concurrency(self):
+            adm = Admission(concurrency = 2)
+            active = []
+            max_active = 0
+            
+            async def task():
+                nonlocal max_active
+                async with adm.slot():
+                    active.append(1)
+                    max_active = max(max_active, len(active))
+                    await asyncio.sleep(0.01)
+                    active.pop()
+            
+            await asyncio.gather(*[ task() for i in range(10) ])
+            self.assertEqual(max_active, 2)
+            self.assertEqual(adm.running, 0)
+        
+        async def test_order_and_notify(self):
+            adm = Admission(concurrency = 1)
+            order = []
+            notified = { i: [] for i in range(3) }
+            
+            async def task(i):
+                async with adm.slot(lambda n: notified[i].append(n)):
+                    order.append(i)
+                    await asyncio.sleep(0.01)
+            
+            await adm.acquire()
+            tasks = [ asyncio.create_task(task(i)) for i in range(3) ]
+            await asyncio.sleep(0)
+            self.assertEqual(adm.pending(), 3)
+            adm.release()
+            await asyncio.gather(*tasks)
+            self.assertEqual(order, [0, 1, 2])
+            self.assertEqual(notified[0], [0])
+            self.assertEqual(notified[1], [1, 0])
+            self.assertEqual(notified[2], [2, 1, 0])
+        
+        async def test_load_shedding(self):
+            adm = Admission(concurrency = 1, max_pending = 2)
+            await adm.acquire()
+            waiting = [ asyncio.create_task(adm.acquire()) for i in range(2) ]
+            await asyncio.sleep(0)
+            with self.assertRaises(Overloaded): await adm.acquire()
+            self.assertEqual(adm.rejected, 1)
+            background = asyncio.create_task(adm.acquire(background = True)) # never rejected
+            await asyncio.sleep(0)
+            for i in range(3):
+                adm.release()
+                await asyncio.sleep(0)
+            self.assertTrue(all( t.done() for t in waiting ))
+            self.assertTrue(background.done())
+        
+        async def test_background_yields(self):
+            adm = Admission(concurrency = 1)
+            order = []
+            
+            async def task(name, background):
+                async with adm.slot(background = background):
+                    order.append(name)
+            
+            await adm.acquire()
+            tasks = [ asyncio.create_task(task('bg', True)) ]
+            await asyncio.sleep(0)
+            tasks.append( asyncio.create_task(task('a', False)) )
+            await asyncio.sleep(0)
+            adm.release()
+            await asyncio.gather(*tasks)
+            self.assertEqual(order, ['a', 'bg'])
+        
+        async def test_cancel_waiting(self):
+            adm = Admission(concurrency = 1)
+            notified = []
+            await adm.acquire()
+            first = asyncio.create_task(adm.acquire())
+            second = asyncio.create_task(adm.acquire(notified.append))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.sleep(0)
+            self.assertEqual(notified, [1, 0])
+            adm.release()
+            await second
+            adm.release()
+            self.assertEqual(adm.running, 0)
+        
+        async def test_cancel_after_release(self):
+            adm = Admission(concurrency = 1)
+            await adm.acquire()
+            tasks = [ asyncio.create_task(adm.acquire(background = True)) for i in range(2) ]
+            await asyncio.sleep(0)
+            tasks[0].cancel() # cancelled, but its task hasn't run yet when the slot is released
+            adm.release()
+            await tasks[1]
+            with self.assertRaises(asyncio.CancelledError): await tasks[0]
+            adm.release()
+            self.assertEqual(adm.running, 0)
+    
+    unittest.main()
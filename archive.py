@@ -0,0 +1,301 @@
+import os
+import io
+import re
+import json
+import zlib
+import time
+import digest
+import spool_reader
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Archive of the spool files of finished, canceled and failed jobs (see spooler.archive_old_files)
+# Files are rolled into segment files of about segment_size bytes. Each file is compressed on its own (a zstd frame,
+# or zlib without the zstandard module), so it can be read without decompressing the rest of its segment
+# The sidecar index (index.jsonl, one json line per file) has the segment, offset and size of each file, and what it
+# is looked up by: digest, client, date (received) and status. It is kept in memory, by digest and by client
+# Files are only removed once they are synced to a segment and to the index. After a crash, bytes appended to a
+# segment without an index entry are never read, and files that are archived again are only in the index once
+
+INDEX = 'index.jsonl'
+SEGMENT = re.compile(r'(\d{6})\.segment')
+
+def compress(data, codec, level):
+    if codec == 'zstd': return zstandard.ZstdCompressor(level = level).compress(data)
+    return zlib.compress(data, min(level, 9))
+
+def decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard == None: raise ValueError('Archived with zstd, which is not available (pip install zstandard)')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+class Archive:
+    def __init__(self, folder, segment_size = 64 * 2**20, level = 6, algorithm = None):
+        self.folder = folder
+        self.segment_size = segment_size # bytes (compressed), a new segment is started after that
+        self.level = level # compression level
+        self.algorithm = algorithm # digest algorithm (see digest.py)
+        self.codec = 'zstd' if zstandard != None else 'zlib'
+        self.loaded = False
+        self.entries = [] # in order of archiving
+        self.by_hash = {} # digest -> [entry]
+        self.by_client = {} # client -> [entry]
+        self.names = set() # (status, file name)
+        self.partial = False # the last line of the index is incomplete
+    
+    def __len__(self):
+        self._load()
+        return len(self.entries)
+    
+    # Archived files, oldest first. hash can be a prefix of the digest (e.g. from a file name)
+    # since and until are dates as in file names (YYYYMMDD or YYYYMMDD_HHMMSS), until is inclusive
+    def find(self, hash = None, client = None, since = None, until = None, status = None):
+        self._load()
+        if hash != None and hash in self.by_hash: entries = self.by_hash[hash]
+        elif hash != None: entries = [ x for x in self.entries if x['hash'].startswith(hash) ]
+        elif client != None: entries = self.by_client.get(client, [])
+        else: entries = self.entries
+        return [ x for x in entries if
+            (client == None or x['client'] == client) and
+            (since == None or x['date'] >= since) and
+            (until == None or x['date'][:len(until)] <= until) and
+            (status == None or x['status'] == status) ]
+    
+    # Contents of an archived file (bytes)
+    def read(self, entry):
+        with open(os.path.join(self.folder, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            data = f.read(entry['size'])
+        return decompress(data, entry['codec'])
+    
+    # Write an archived file to a folder (with its original name), returns the path
+    def extract(self, entry, folder):
+        os.makedirs(folder, exist_ok = True)
+        path = os.path.join(folder, entry['name'])
+        with open(path, 'wb') as f: f.write(self.read(entry))
+        return path
+    
+    # Move files (of jobs with the given status) into the archive, returns the number of archived files
+    def add(self, paths, status):
+        self._load()
+        os.makedirs(self.folder, exist_ok = True)
+        segment, size = self._current_segment()
+        archived = [] # (path, entry)
+        out = None
+        try:
+            for path in paths:
+                name = os.path.basename(path)
+                if (status, name) in self.names: # archived already, but not removed
+                    archived.append((path, None))
+                    continue
+                with open(path, 'rb') as f: data = f.read()
+                entry = self._entry(name, status, data, os.path.getmtime(path))
+                frame = compress(data, self.codec, self.level)
+                if out != None and size + len(frame) > self.segment_size and size > 0:
+                    self._close_segment(out)
+                    out = None
+                    segment, size = self._next_segment(segment), 0
+                if out == None: out = open(os.path.join(self.folder, segment), 'ab')
+                entry.update(segment = segment, offset = size, size = len(frame), codec = self.codec)
+                out.write(frame)
+                size += len(frame)
+                archived.append((path, entry))
+        finally:
+            if out != None: self._close_segment(out)
+            entries = [ entry for path, entry in archived if entry != None ]
+            if entries:
+                with open(os.path.join(self.folder, INDEX), 'a', encoding='utf-8') as f:
+                    if self.partial: f.write('\n') # don't continue a partly written line
+                    self.partial = False
+                    f.write(''.join( json.dumps(entry) + '\n' for entry in entries ))
+                    f.flush()
+                    os.fsync(f.fileno())
+                for entry in entries: self._index(entry)
+        for path, entry in archived: os.remove(path)
+        return len(archived)
+    
+    def _entry(self, name, status, data, mtime):
+        date = re.match(r'\d{8}_\d{6}', name)
+        try:
+            client = spool_reader.read_header(io.BytesIO(data)).get('{' + spool_reader.NS + '}author')
+        except Exception:
+            client = None
+        if client == None:
+            match = re.search(r'_\[(.*?)\]', name)
+            client = match.group(1) if match != None else ''
+        return {
+            'name': name,
+            'status': status,
+            'hash': digest.digest(data, self.algorithm),
+            'client': client,
+            'date': date.group(0) if date != None else time.strftime('%Y%m%d_%H%M%S', time.localtime(mtime)),
+            'length': len(data),
+        }
+    
+    def _close_segment(self, out):
+        out.flush()
+        os.fsync(out.fileno())
+        out.close()
+    
+    def _segments(self):
+        try:
+            return sorted( x for x in os.listdir(self.folder) if SEGMENT.fullmatch(x) )
+        except FileNotFoundError:
+            return []
+    
+    def _next_segment(self, segment):
+        return f'{int(SEGMENT.fullmatch(segment).group(1)) + 1:06}.segment' if segment != None else '000001.segment'
+    
+    # last segment and its size, or a new segment if it is full
+    def _current_segment(self):
+        segments = self._segments()
+        if segments:
+            size = os.path.getsize(os.path.join(self.folder, segments[-1]))
+            if size < self.segment_size: return segments[-1], size
+        return self._next_segment(segments[-1] if segments else None), 0
+    
+    def _index(self, entry):
+        key = (entry['status'], entry['name'])
+        if key in self.names: return
+        self.names.add(key)
+        self.entries.append(entry)
+        self.by_hash.setdefault(entry['hash'], []).append(entry)
+        self.by_client.setdefault(entry['client'], []).append(entry)
+    
+    def _load(self):
+        if self.loaded: return
+        self.loaded = True
+        try:
+            with open(os.path.join(self.folder, INDEX), 'r', encoding='utf-8') as f: lines = f.readlines()
+        except FileNotFoundError:
+            return
+        self.partial = len(lines) > 0 and not lines[-1].endswith('\n')
+        for line in lines:
+            try:
+                self._index(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                continue # partly written
+
+
+# Archiving n spool files, reading a file from the archive and looking files up
+def benchmark(n = 1000, svg_size = 200_000):
+    import random
+    import tempfile
+    rng = random.Random(0)
+    
+    with tempfile.TemporaryDirectory() as folder:
+        spool = os.path.join(folder, 'finished')
+        os.makedirs(spool)
+        paths = []
+        for i in range(n):
+            d = ' '.join( f'M {rng.uniform(0, 300):.3f} {rng.uniform(0, 200):.3f} L {rng.uniform(0, 300):.3f} {rng.uniform(0, 200):.3f}' for j in range(svg_size // 60) )
+            svg = spool_reader.SVG.replace('tg:author=""', f'tg:author="client-{i}"').replace('M 0 0 L 1 1', d)
+            path = os.path.join(spool, f'20250101_{i:06}.000_[client-{i}]_00000_1.0m_1m0s.svg')
+            with open(path, 'w', encoding='utf-8') as f: f.write(svg)
+            paths.append(path)
+        total = sum( os.path.getsize(x) for x in paths )
+        
+        archive = Archive(os.path.join(folder, 'archive'))
+        start = time.perf_counter()
+        archive.add(paths, 'finished')
+        t_add = time.perf_counter() - start
+        compressed = sum( os.path.getsize(os.path.join(archive.folder, x)) for x in archive._segments() )
+        
+        archive = Archive(archive.folder) # reload the index
+        start = time.perf_counter()
+        entries = archive.find()
+        t_load = time.perf_counter() - start
+        
+        picks = [ rng.choice(entries) for i in range(200) ]
+        start = time.perf_counter()
+        for entry in picks: archive.read(archive.find(hash = entry['hash'][:5])[0])
+        t_read = (time.perf_counter() - start) / len(picks)
+        
+        print(f'{n} files, {total / 2**20:.0f} MB -> {compressed / 2**20:.0f} MB in {len(archive._segments())} segments ({archive.codec}), archived in {t_add:.1f} s')
+        print(f'loading the index {t_load*1000:.1f} ms, looking up and reading a file {t_read*1000:.2f} ms')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    import tempfile
+    
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            self.spool = os.path.join(self.tmp.name, 'finished')
+            self.folder = os.path.join(self.tmp.name, 'archive')
+            os.makedirs(self.spool)
+        
+        def tearDown(self):
+            self.tmp.cleanup()
+        
+        def write(self, name, client = 'abc', body = ''):
+            path = os.path.join(self.spool, name)
+            with open(path, 'w', encoding='utf-8') as f: f.write(spool_reader.SVG.replace('tg:author=""', f'tg:author="{client}"').replace('</svg>', body + '</svg>'))
+            return path
+        
+        def test_add_and_read(self):
+            paths = [ self.write(f'20250101_12000{i}.000_[client-{i}]_00000_1.0m_1m0s.svg', f'client-{i}', str(i)) for i in range(3) ]
+            contents = []
+            for path in paths:
+                with open(path, 'rb') as f: contents.append(f.read())
+            archive = Archive(self.folder, segment_size = 1)
+            self.assertEqual(archive.add(paths, 'finished'), 3)
+            self.assertEqual(os.listdir(self.spool), [])
+            self.assertEqual(len(archive._segments()), 3)
+            
+            archive = Archive(self.folder)
+            self.assertEqual(len(archive), 3)
+            entry = archive.find(client = 'client-1')[0]
+            self.assertEqual((entry['date'], entry['status'], entry['hash']), ('20250101_120001', 'finished', digest.digest(contents[1])))
+            self.assertEqual(archive.read(entry), contents[1])
+            self.assertEqual(archive.find(hash = entry['hash'][:5]), [entry])
+            self.assertEqual(archive.read(archive.find(hash = entry['hash'])[0]), contents[1])
+            path = archive.extract(entry, os.path.join(self.tmp.name, 'reprint'))
+            self.assertEqual(os.path.basename(path), entry['name'])
+        
+        def test_find_by_date(self):
+            archive = Archive(self.folder)
+            archive.add([ self.write(f'2025010{i}_120000.000_[x]_00000_1.0m_1m0s.svg', 'x', str(i)) for i in range(1, 4) ], 'canceled')
+            self.assertEqual([ x['date'] for x in archive.find(since = '20250102', until = '20250102') ], ['20250102_120000'])
+            self.assertEqual(len(archive.find(client = 'x', until = '20250102')), 2)
+            self.assertEqual(archive.find(status = 'finished'), [])
+        
+        def test_client_from_name(self):
+            archive = Archive(self.folder)
+            path = os.path.join(self.spool, 'old_[someone].svg')
+            with open(path, 'w') as f: f.write('<svg/>')
+            archive.add([path], 'error')
+            entry = archive.find()[0]
+            self.assertEqual(entry['client'], 'someone')
+            self.assertEqual(len(entry['date']), 15) # from the modification time
+        
+        def test_interrupted(self):
+            path = self.write('a.svg')
+            archive = Archive(self.folder)
+            archive.add([path], 'finished')
+            self.write('a.svg') # e.g. the file couldn't be removed
+            with open(os.path.join(self.folder, INDEX), 'a') as f: f.write('{"name": "b.svg", "sta')
+            archive = Archive(self.folder)
+            self.assertEqual(archive.add([path, self.write('c.svg')], 'finished'), 2)
+            self.assertFalse(os.path.exists(path))
+            self.assertEqual([ x['name'] for x in Archive(self.folder).find() ], ['a.svg', 'c.svg'])
+        
+        def test_segment_size(self):
+            archive = Archive(self.folder, segment_size = 10**6)
+            for i in range(3): archive.add([ self.write(f'{i}.svg', body = str(i)) ], 'finished')
+            self.assertEqual(archive._segments(), ['000001.segment'])
+            self.assertEqual([ archive.read(x)[-8:] for x in archive.find() ], [ f'{i}</svg>\n'.encode() for i in range(3) ])
+        
+        def test_zlib(self):
+            self.assertEqual(decompress(compress(b'<svg/>', 'zlib', 10), 'zlib'), b'<svg/>')
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
@@ -1,92 +1,378 @@
 import asyncio
+import random
+
+# Sequence with O(log n) positional access, insertion and removal, and O(1) lookup of items
+# Implemented as an implicit treap (randomized balanced tree ordered by position, each node knows the size of its subtree)
+# Items are found by identity via a dict of nodes, their position is computed by walking up to the root
+# Optionally items have a weight (e.g. the time estimate of a job), each node knows the total weight of its subtree,
+# so the sum of the weights before a position is O(log n) as well. Call reweigh(item) when the weight of an item changes
+
+class _Node:
+    __slots__ = ('item', 'priority', 'size', 'weight', 'total', 'left', 'right', 'parent')
+    
+    def __init__(self, item, weight = 0):
+        self.item = item
+        self.priority = random.random()
+        self.size = 1
+        self.weight = weight
+        self.total = weight
+        self.left = None
+        self.right = None
+        self.parent = None
+
+def _size(node):
+    return node.size if node != None else 0
+
+def _total(node):
+    return node.total if node != None else 0
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+    node.total = node.weight + _total(node.left) + _total(node.right)
+    if node.left != None: node.left.parent = node
+    if node.right != None: node.right.parent = node
+
+# join two trees, all items of a before all items of b
+def _merge(a, b):
+    if a == None: return b
+    if b == None: return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+# split a tree into the first k items and the rest
+def _split(node, k):
+    if node == None: return None, None
+    if _size(node.left) >= k:
+        left, right = _split(node.left, k)
+        node.left = right
+        _update(node)
+        if left != None: left.parent = None
+        return left, node
+    left, right = _split(node.right, k - _size(node.left) - 1)
+    node.right = left
+    _update(node)
+    if right != None: right.parent = None
+    return node, right
+
+class IndexedList:
+    def __init__(self, items = (), weight = None):
+        self.root = None
+        self.nodes = {} # id(item) -> list of nodes holding the item
+        self.weight = weight # weight(item), None: no weights
+        for item in items: self.append(item)
+    
+    def __len__(self):
+        return _size(self.root)
+    
+    def __iter__(self):
+        stack = []
+        node = self.root
+        while stack or node != None:
+            while node != None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.item
+            node = node.right
+    
+    def __repr__(self):
+        return f'IndexedList({list(self)!r})'
+    
+    def _node_at(self, idx):
+        node = self.root
+        while True:
+            left = _size(node.left)
+            if idx < left: node = node.left
+            elif idx == left: return node
+            else:
+                idx -= left + 1
+                node = node.right
+    
+    def _rank(self, node):
+        idx = _size(node.left)
+        while node.parent != None:
+            if node is node.parent.right: idx += _size(node.parent.left) + 1
+            node = node.parent
+        return idx
+    
+    def _new_node(self, item):
+        return _Node(item, self.weight(item) if self.weight != None else 0)
+    
+    # recompute sizes and totals from a node up to the root
+    def _update_path(self, node):
+        while node != None:
+            _update(node)
+            node = node.parent
+    
+    def _normalize(self, idx):
+        if idx < -len(self) or idx > len(self)-1: raise IndexError('index out of bounds')
+        return idx + len(self) if idx < 0 else idx
+    
+    def _register(self, node):
+        self.nodes.setdefault(id(node.item), []).append(node)
+    
+    def _unregister(self, node):
+        nodes = self.nodes[id(node.item)]
+        nodes.remove(node)
+        if not nodes: del self.nodes[id(node.item)]
+    
+    # unlink a node by merging its children in its place
+    def _unlink(self, node):
+        sub = _merge(node.left, node.right)
+        parent = node.parent
+        if sub != None: sub.parent = parent
+        if parent == None: self.root = sub
+        elif parent.left is node: parent.left = sub
+        else: parent.right = sub
+        self._update_path(parent)
+        node.left = node.right = node.parent = None
+        node.size = 1
+        node.total = node.weight
+    
+    def _link(self, idx, node):
+        left, right = _split(self.root, idx)
+        self.root = _merge(_merge(left, node), right)
+        self.root.parent = None
+    
+    def __getitem__(self, idx):
+        return self._node_at(self._normalize(idx)).item
+    
+    def append(self, item):
+        node = self._new_node(item)
+        self.root = _merge(self.root, node)
+        self.root.parent = None
+        self._register(node)
+    
+    # insert before idx (0 <= idx <= len)
+    def insert(self, idx, item):
+        node = self._new_node(item)
+        self._link(idx, node)
+        self._register(node)
+    
+    def pop(self, idx = -1):
+        node = self._node_at(self._normalize(idx))
+        self._unlink(node)
+        self._unregister(node)
+        return node.item
+    
+    # position of the first occurrence of item
+    # items are looked up by identity; falls back to a linear search by equality
+    def index(self, item):
+        nodes = self.nodes.get(id(item))
+        if nodes: return min( self._rank(node) for node in nodes )
+        for idx, x in enumerate(self):
+            if x == item: return idx
+        raise ValueError(f'{item!r} is not in queue')
+    
+    def remove(self, item):
+        self.pop(self.index(item))
+    
+    def move(self, idx, new_idx):
+        node = self._node_at(self._normalize(idx))
+        self._unlink(node)
+        self._link(new_idx, node)
+    
+    def swap(self, idx1, idx2):
+        a = self._node_at(self._normalize(idx1))
+        b = self._node_at(self._normalize(idx2))
+        self._unregister(a)
+        self._unregister(b)
+        a.item, b.item = b.item, a.item
+        a.weight, b.weight = b.weight, a.weight
+        self._register(a)
+        self._register(b)
+        self._update_path(a)
+        self._update_path(b)
+    
+    # total weight of all items
+    def total(self):
+        return _total(self.root)
+    
+    # total weight of the first idx items (0 <= idx <= len)
+    def prefix(self, idx):
+        if idx < 0 or idx > len(self): raise IndexError('index out of bounds')
+        node = self.root
+        total = 0
+        while node != None:
+            left = _size(node.left)
+            if idx <= left: node = node.left
+            else:
+                total += _total(node.left) + node.weight
+                idx -= left + 1
+                node = node.right
+        return total
+    
+    # update the weight of an item after it changed
+    def reweigh(self, item):
+        if self.weight == None: return
+        for node in self.nodes.get(id(item), []):
+            node.weight = self.weight(item)
+            self._update_path(node)
 
 # Like asyncio.Queue with support for reordering and removing elements
+# Items are stored in an IndexedList instead of a deque, so get() and put() keep their waiting semantics
+# and reordering is O(log n) instead of rebuilding the whole queue
+# pick(items) chooses the index of the item get() returns (default: the first), see scheduler.py
+# weight(item) gives items a weight, for summing them up by position (see IndexedList)
 class Queue(asyncio.Queue):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.order = []
-        
-    def _rebuild(self):
-        # remove all items
-        try:
-            while True: super().get_nowait()
-        except asyncio.QueueEmpty:
-            pass
-        # add items in new order
-        for item in self.order:
-            try:
-               super().put_nowait(item)
-            except asyncio.QueueFull:
-                pass
+    def __init__(self, maxsize = 0, pick = None, weight = None):
+        self.pick = pick
+        self.weight = weight
+        self.picked = 0 # index of the item last returned by get()
+        super().__init__(maxsize)
+    
+    def _init(self, maxsize):
+        self._queue = IndexedList(weight = self.weight)
+    
+    def _put(self, item):
+        self._queue.append(item)
+    
+    def _get(self):
+        self.picked = self.pick(self._queue) if self.pick != None else 0
+        return self._queue.pop(self.picked)
     
     # get the current queue as list
     def list(self):
-        return self.order.copy()
+        return list(self._queue)
     
     # swap two items by index; supports negative indices
     def swap(self, idx1, idx2):
-        if idx1 < -len(self.order) or idx1 > len(self.order)-1:
+        if idx1 < -len(self._queue) or idx1 > len(self._queue)-1:
             raise IndexError('index 1 out of bounds')
-        if idx2 < -len(self.order) or idx2 > len(self.order)-1:
+        if idx2 < -len(self._queue) or idx2 > len(self._queue)-1:
             raise IndexError('index 2 out of bounds')
         if (idx1 == idx2): return
-        self.order[idx1], self.order[idx2] = self.order[idx2], self.order[idx1]
-        self._rebuild()
+        self._queue.swap(idx1, idx2)
     
     # move an item to new position in queue
     def move(self, idx, new_idx):
-        if idx < -len(self.order) or idx > len(self.order)-1:
+        if idx < -len(self._queue) or idx > len(self._queue)-1:
             raise IndexError('index out of bounds')
-        if new_idx < -len(self.order) or new_idx > len(self.order)-1:
+        if new_idx < -len(self._queue) or new_idx > len(self._queue)-1:
             raise IndexError('target index out of bounds')
         
         # normalize negative indices
-        if idx < 0: idx = len(self.order) + idx
-        if new_idx < 0: new_idx = len(self.order) + new_idx
+        if idx < 0: idx = len(self._queue) + idx
+        if new_idx < 0: new_idx = len(self._queue) + new_idx
         
         if (idx == new_idx): return
-        item = self.order.pop(idx)
-        self.order.insert(new_idx, item)
-        self._rebuild()
+        self._queue.move(idx, new_idx)
     
-    def index(self, *args):
-        return self.order.index(*args)
+    def index(self, item):
+        return self._queue.index(item)
+    
+    # item by index; supports negative indices
+    def __getitem__(self, idx):
+        return self._queue[idx]
     
     def __iter__(self):
-        return self.order.copy().__iter__()
+        return iter(self.list())
     
     # remove an item from the queue; supports negative indices
     def pop(self, idx = -1):
-        if idx < -len(self.order) or idx > len(self.order)-1:
+        if idx < -len(self._queue) or idx > len(self._queue)-1:
             raise IndexError('index out of bounds')
-        item = self.order.pop(idx)
-        # print('remove item', item)
-        self._rebuild()
-        return item
+        return self._queue.pop(idx)
+    
+    # remove an item from the queue; raises ValueError if it isn't queued
+    def remove(self, item):
+        self._queue.remove(item)
     
     # insert an item at an arbitrary position into the queue
     def insert(self, idx, item):
-        if idx < -len(self.order) or idx > len(self.order):
+        if idx < -len(self._queue) or idx > len(self._queue):
             raise IndexError('index out of bounds')
-        self.order.insert(idx, item)
-        self._rebuild()
+        if self.full(): raise asyncio.QueueFull
+        if idx < 0: idx = len(self._queue) + idx
+        self._queue.insert(idx, item)
+        # same bookkeeping as put_nowait(), wakes up a waiting get()
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+    
+    # total weight of all items
+    def total(self):
+        return self._queue.total()
+    
+    # total weight of the items before idx (0 <= idx <= qsize)
+    def prefix(self, idx):
+        return self._queue.prefix(idx)
+    
+    # update the weight of an item after it changed; does nothing if the item isn't queued
+    def reweigh(self, item):
+        self._queue.reweigh(item)
+    
+    # get() and put() are implemented by asyncio.Queue in terms of _get() and _put()
+
+# Compare against the previous implementation, which kept a list and rebuilt the queue on every change
+def benchmark(n = 10000, ops = 2000):
+    import time
+    
+    class ListQueue(asyncio.Queue):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.order = []
+        def _rebuild(self):
+            while not self.empty(): super().get_nowait()
+            for item in self.order: super().put_nowait(item)
+        def put_nowait(self, item):
+            super().put_nowait(item)
+            self.order.append(item)
+        def index(self, item):
+            return self.order.index(item)
+        def pop(self, idx = -1):
+            item = self.order.pop(idx)
+            self._rebuild()
+            return item
+        def move(self, idx, new_idx):
+            self.order.insert(new_idx, self.order.pop(idx))
+            self._rebuild()
+    
+    rng = random.Random(0)
+    jobs = [ {'client': f'client-{i}', 'hash': f'{i:040x}'} for i in range(n) ]
+    picks = [ rng.choice(jobs[:n - ops]) for i in range(ops) ] # never popped by the cancel test below
+    targets = [ rng.randrange(n) for i in range(ops) ]
+    
+    for name, cls in [('list + rebuild', ListQueue), ('indexed', Queue)]:
+        q = cls()
+        start = time.perf_counter()
+        for job in jobs: q.put_nowait(job)
+        t_put = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for job in picks: q.index(job)
+        t_index = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for job, target in zip(picks, targets): q.move(q.index(job), target)
+        t_move = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        for job in jobs[-ops:]: q.pop(q.index(job)) # cancel
+        t_cancel = time.perf_counter() - start
         
-    def put_nowait(self, item):
-        # print('put_nowait')
-        super().put_nowait(item)
-        self.order.append(item)
-    
-    def get_nowait(self):
-        # print('get_nowait')
-        item = super().get_nowait()
-        self.order.pop(0)
-        return item
-    
-    # no need to implement get() and put()
-    # as these are implemented in terms of get_nowait() and put_nowait()
+        print(f'{name:<15} {n} jobs: put {t_put*1e6/n:7.1f} µs, index {t_index*1e6/ops:7.1f} µs, move {t_move*1e6/ops:8.1f} µs, cancel {t_cancel*1e6/ops:8.1f} µs')
+    
+    # time until a job starts: summing up the estimates of the jobs before it, or the prefix sum of the weights
+    for job in jobs: job['time_estimate'] = rng.uniform(60, 600)
+    q = Queue(weight = lambda job: job['time_estimate'])
+    for job in jobs: q.put_nowait(job)
+    start = time.perf_counter()
+    for job in picks: sum( x['time_estimate'] for x in q.list()[:q.index(job)] )
+    t_sum = time.perf_counter() - start
+    start = time.perf_counter()
+    for job in picks: q.prefix(q.index(job))
+    t_prefix = time.perf_counter() - start
+    print(f'start time of a job: sum {t_sum*1e6/ops:.1f} µs, prefix sum {t_prefix*1e6/ops:.1f} µs')
 
 
 if __name__ == '__main__':
+    import sys
     import unittest
     
     class Test(unittest.IsolatedAsyncioTestCase):
@@ -305,7 +591,10 @@ if __name__ == '__main__':
             self.assertEqual(q.index('two'), 2)
             self.assertEqual(q.index('three'), 3)
             with self.assertRaises(ValueError): q.index('none')
-            
+            self.assertEqual(q[1], 'one')
+            self.assertEqual(q[-1], 'three')
+            with self.assertRaises(IndexError): q[4]
+        
         async def test_iter(self):
             q = Queue()
             q.put_nowait('zero')
@@ -314,6 +603,111 @@ if __name__ == '__main__':
             q.put_nowait('three')
             items = [x for x in q]
             self.assertEqual(items, ['zero', 'one', 'two', 'three'])
-            
-    unittest.main()
-    
\ No newline at end of file
+        
+        async def test_remove(self):
+            q = Queue()
+            for x in ['zero', 'one', 'two', 'three']: q.put_nowait(x)
+            q.remove('two')
+            self.assertEqual(q.list(), ['zero', 'one', 'three'])
+            with self.assertRaises(ValueError): q.remove('two')
+            self.assertEqual(self.get_all(q), ['zero', 'one', 'three'])
+        
+        async def test_identity(self):
+            q = Queue()
+            a = {'client': 'a'}
+            b = {'client': 'a'} # equal, but not the same job
+            q.put_nowait(b)
+            q.put_nowait(a)
+            self.assertEqual(q.index(a), 1)
+            self.assertEqual(q.index({'client': 'a'}), 0) # falls back to equality
+            q.put_nowait(a)
+            self.assertEqual(q.index(a), 1)
+            q.pop(1)
+            self.assertEqual(q.index(a), 1)
+            q.move(1, 0)
+            self.assertEqual(q.index(a), 0)
+            q.swap(0, 1)
+            self.assertEqual(q.index(a), 1)
+            self.assertEqual(q.index(b), 0)
+        
+        async def test_insert_wakes_get(self):
+            q = Queue()
+            get_task = asyncio.create_task(q.get())
+            await asyncio.sleep(0)
+            q.insert(0, 'one')
+            self.assertEqual(await get_task, 'one')
+            q = Queue(maxsize = 1)
+            q.insert(0, 'one')
+            with self.assertRaises(asyncio.QueueFull): q.insert(0, 'two')
+        
+        async def test_pick(self):
+            q = Queue(pick = lambda items: len(items) - 1)
+            get_task = asyncio.create_task(q.get())
+            await asyncio.sleep(0)
+            q.put_nowait('one')
+            self.assertEqual(await get_task, 'one')
+            for x in ['one', 'two', 'three']: q.put_nowait(x)
+            self.assertEqual(await q.get(), 'three')
+            self.assertEqual(q.picked, 2)
+            self.assertEqual(q.get_nowait(), 'two')
+            self.assertEqual(q.list(), ['one'])
+        
+        async def test_weights(self):
+            weight = lambda item: item['w']
+            items = [ {'w': w} for w in [1, 2, 3, 4] ]
+            q = Queue(weight = weight)
+            for x in items: q.put_nowait(x)
+            self.assertEqual(q.total(), 10)
+            self.assertEqual([ q.prefix(i) for i in range(5) ], [0, 1, 3, 6, 10])
+            with self.assertRaises(IndexError): q.prefix(5)
+            q.move(0, -1) # 2 3 4 1
+            self.assertEqual(q.prefix(3), 9)
+            q.swap(0, 1) # 3 2 4 1
+            self.assertEqual(q.prefix(1), 3)
+            items[3]['w'] = 10 # 3 2 10 1
+            q.reweigh(items[3])
+            self.assertEqual(q.prefix(3), 15)
+            q.reweigh({'w': 5}) # not queued
+            self.assertEqual(q.get_nowait(), items[2])
+            self.assertEqual(q.total(), 13)
+            q.remove(items[3])
+            self.assertEqual(q.total(), 3)
+            self.assertEqual(Queue().prefix(0), 0)
+        
+        async def test_random_ops(self):
+            rng = random.Random(1)
+            weights = {}
+            q = Queue(weight = lambda item: weights[id(item)])
+            ref = []
+            for i in range(2000):
+                op = rng.randrange(5)
+                if op == 0 or not ref:
+                    item = object()
+                    weights[id(item)] = rng.randrange(100)
+                    idx = rng.randint(0, len(ref))
+                    q.insert(idx, item)
+                    ref.insert(idx, item)
+                elif op == 1:
+                    idx = rng.randrange(len(ref))
+                    self.assertIs(q.pop(idx), ref.pop(idx))
+                elif op == 2:
+                    idx, new_idx = rng.randrange(len(ref)), rng.randrange(len(ref))
+                    q.move(idx, new_idx)
+                    ref.insert(new_idx, ref.pop(idx))
+                elif op == 3:
+                    item = rng.choice(ref)
+                    weights[id(item)] = rng.randrange(100)
+                    q.reweigh(item)
+                else:
+                    item = rng.choice(ref)
+                    self.assertEqual(q.index(item), ref.index(item))
+                self.assertEqual(q.qsize(), len(ref))
+                idx = rng.randint(0, len(ref))
+                self.assertEqual(q.prefix(idx), sum( weights[id(x)] for x in ref[:idx] ))
+            self.assertEqual(q.list(), ref)
+            self.assertEqual(self.get_all(q), ref)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
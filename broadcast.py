@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+# Broadcasting state changes to all connected clients
+# Updates of the same message type within `window` seconds are collapsed into one message with the latest values
+# Each message is serialized once and handed to websockets.broadcast, which writes to all connections
+# without waiting for them (slow clients don't hold up the others)
+# Messages carry a version number, increasing with every broadcast message
+
+class Hub:
+    # clients: collection of connections (read at the time of sending)
+    # broadcast(clients, message): defaults to websockets.broadcast
+    def __init__(self, clients, window = 0.05, broadcast = None):
+        if broadcast == None:
+            import websockets
+            broadcast = websockets.broadcast
+        self.clients = clients
+        self.window = window
+        self.broadcast = broadcast
+        self.version = 0
+        self.pending = {} # message type -> latest fields
+        self.timer = None
+        self.counts = { 'updates': 0, 'messages': 0, 'recipients': 0 }
+    
+    # Queue a state update, e.g. publish('queue_length', length = 3)
+    def publish(self, type, **fields):
+        self.counts['updates'] += 1
+        self.pending.setdefault(type, {}).update(fields)
+        if self.timer == None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+    
+    # Send pending updates now
+    def flush(self):
+        if self.timer != None: self.timer.cancel()
+        self.timer = None
+        pending = self.pending
+        self.pending = {}
+        for type, fields in pending.items():
+            self.version += 1
+            if not self.clients: continue
+            message = json.dumps({ 'type': type, **fields, 'version': self.version })
+            self.broadcast(self.clients, message)
+            self.counts['messages'] += 1
+            self.counts['recipients'] += len(self.clients)
+    
+    def stats(self):
+        return dict(self.counts, version = self.version)
+
+
+# Compare against sending to every client separately, with a stand-in for the network (200 clients, 1000 updates)
+def benchmark(num_clients = 200, updates = 1000):
+    import time
+    
+    class Client:
+        async def send(self, message):
+            pass
+    
+    encodes = 0
+    def dumps(msg):
+        nonlocal encodes
+        encodes += 1
+        return json.dumps(msg)
+    
+    async def per_client():
+        clients = [ Client() for i in range(num_clients) ]
+        for i in range(updates):
+            await asyncio.gather(*[ ws.send(dumps({'type': 'queue_length', 'length': i})) for ws in clients ])
+    
+    sent = 0
+    def broadcast(clients, message):
+        nonlocal sent
+        sent += len(clients)
+    
+    async def hub():
+        hub = Hub([ Client() for i in range(num_clients) ], window = 0.05, broadcast = broadcast)
+        for i in range(updates):
+            hub.publish('queue_length', length = i)
+            if i % 100 == 99: await asyncio.sleep(0.06) # bursts of 100 updates
+        hub.flush()
+        return hub.stats()
+    
+    start = time.perf_counter()
+    asyncio.run(per_client())
+    t = time.perf_counter() - start
+    print(f'per client: {updates} updates, {encodes} encodes, {updates * num_clients} sends, {t*1000:.0f} ms')
+    
+    start = time.perf_counter()
+    stats = asyncio.run(hub())
+    t = time.perf_counter() - start - (updates // 100) * 0.06
+    print(f'hub:        {updates} updates, {stats["messages"]} encodes, {sent} sends, {t*1000:.0f} ms (without waiting)')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    
+    class Test(unittest.IsolatedAsyncioTestCase):
+        def setUp(self):
+            self.sent = []
+            self.clients = ['a', 'b']
+            self.hub = Hub(self.clients, window = 0.01, broadcast = lambda clients, msg: self.sent.append( (list(clients), json.loads(msg)) ))
+        
+        async def test_coalesce(self):
+            for i in range(5): self.hub.publish('queue_length', length = i)
+            self.assertEqual(self.sent, [])
+            await asyncio.sleep(0.02)
+            self.assertEqual(self.sent, [ (['a', 'b'], {'type': 'queue_length', 'length': 4, 'version': 1}) ])
+            self.hub.publish('queue_length', length = 5)
+            await asyncio.sleep(0.02)
+            self.assertEqual(self.sent[-1][1], {'type': 'queue_length', 'length': 5, 'version': 2})
+            self.assertEqual(self.hub.stats(), {'updates': 6, 'messages': 2, 'recipients': 4, 'version': 2})
+        
+        async def test_types(self):
+            self.hub.publish('queue_length', length = 1)
+            self.hub.publish('status', status = 'plotting')
+            self.hub.flush()
+            self.assertEqual([ msg['type'] for clients, msg in self.sent ], ['queue_length', 'status'])
+            self.assertEqual([ msg['version'] for clients, msg in self.sent ], [1, 2])
+            await asyncio.sleep(0.02)
+            self.assertEqual(len(self.sent), 2) # timer was canceled
+        
+        async def test_no_clients(self):
+            self.clients.clear()
+            self.hub.publish('queue_length', length = 1)
+            self.hub.flush()
+            self.assertEqual(self.sent, [])
+            self.clients.append('c')
+            self.hub.publish('queue_length', length = 2)
+            self.hub.flush()
+            self.assertEqual(self.sent, [ (['c'], {'type': 'queue_length', 'length': 2, 'version': 2}) ])
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
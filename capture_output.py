@@ -1,5 +1,7 @@
-from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from contextlib import contextmanager
 import io
+import sys
+import threading
 
 class Out:
     def __init__(self):
@@ -11,13 +13,35 @@ class Out:
         self.stdout_str = self.stdout.getvalue()
         self.stderr_str = self.stderr.getvalue()
 
+# Captures are per thread, so several plotters can run at the same time (see spooler.run_plotter)
+# sys.stdout/sys.stderr are replaced once by a stream that writes to the capture of the current thread (if any)
+_captures = threading.local()
+
+class _ThreadStream:
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream # where output of threads without capture goes
+    def write(self, s):
+        return (getattr(_captures, self.name, None) or self.stream).write(s)
+    def flush(self):
+        (getattr(_captures, self.name, None) or self.stream).flush()
+    def __getattr__(self, attr):
+        return getattr(self.stream, attr)
+
+def _install():
+    if not isinstance(sys.stdout, _ThreadStream): sys.stdout = _ThreadStream('stdout', sys.stdout)
+    if not isinstance(sys.stderr, _ThreadStream): sys.stderr = _ThreadStream('stderr', sys.stderr)
+
 @contextmanager
 def capture_output(print_out = None, print_err = None):
+    out = Out()
+    _install()
+    previous = ( getattr(_captures, 'stdout', None), getattr(_captures, 'stderr', None) )
+    _captures.stdout, _captures.stderr = out.stdout, out.stderr
     try:
-        out = Out()
-        with redirect_stdout(out.stdout), redirect_stderr(out.stderr):
-            yield out
+        yield out
     finally:
+        _captures.stdout, _captures.stderr = previous
         out.finalize()
         if callable(print_out): print_out(out.stdout_str)
         if callable(print_err): print_err(out.stderr_str)
@@ -0,0 +1,216 @@
+import math
+import re
+import numpy as np
+
+import path
+import estimate
+
+# Geometry cleanup, before simulating and plotting
+# - strokes whose ends touch (closer than join) are joined, so the pen stays down (reversing strokes if allowed)
+# - points that deviate less than simplify from a straight line are removed (collinear runs, duplicate points),
+#   so the plotter doesn't slow down for corners that aren't there
+# - strokes shorter than min_length (plotter resolution) that couldn't be joined are dropped
+# Tolerances are in mm on the page. Like in optimize.py, strokes are only joined within a path element
+# (tg-plot writes one path per layer) and paths with curves are left as they are
+
+_PATH_D = re.compile(r'(<path\b[^>]*?\sd=")([^"]*)(")')
+
+# Join strokes (each an (n, 2) array of points) whose ends are closer than tol
+# Strokes are joined in order: each stroke is extended at its end and then at its start with the first
+# touching stroke found. Returns the joined strokes, in the order of their first stroke
+def join(lines, tol, reverse = True):
+    cell = max(tol, 1e-9)
+    grid = {} # cell -> [(stroke, True if end)]
+    for k, line in enumerate(lines):
+        for is_end, (x, y) in [ (False, line[0]), (True, line[-1]) ]:
+            grid.setdefault( (math.floor(x / cell), math.floor(y / cell)), [] ).append((k, is_end))
+    used = bytearray(len(lines))
+    
+    # unused stroke with an end (is_end True) or start close to point, None if there is none
+    def find(point, ends, starts):
+        x, y = point
+        cx, cy = math.floor(x / cell), math.floor(y / cell)
+        for key in [ (cx + i, cy + j) for i in (-1, 0, 1) for j in (-1, 0, 1) ]:
+            for k, is_end in grid.get(key, []):
+                if used[k] or not (ends if is_end else starts): continue
+                ex, ey = lines[k][-1] if is_end else lines[k][0]
+                if (ex - x)**2 + (ey - y)**2 <= tol**2: return k, is_end
+        return None
+    
+    out = []
+    for i in range(len(lines)):
+        if used[i]: continue
+        used[i] = 1
+        chain = [ lines[i] ]
+        head = []
+        # extend at the end: a start (as is) or an end (reversed) touches the end of the chain
+        while True:
+            found = find(chain[-1][-1], reverse, True)
+            if found == None: break
+            k, is_end = found
+            used[k] = 1
+            chain.append( lines[k][::-1] if is_end else lines[k] )
+        # extend at the start: an end (as is) or a start (reversed) touches the start of the chain
+        while True:
+            first = head[-1] if head else chain[0]
+            found = find(first[0], True, reverse)
+            if found == None: break
+            k, is_end = found
+            used[k] = 1
+            head.append( lines[k] if is_end else lines[k][::-1] )
+        parts = head[::-1] + chain
+        out.append( np.concatenate(parts) if len(parts) > 1 else parts[0] )
+    return out
+
+# Remove points that are closer than tol to the simplified stroke (Ramer-Douglas-Peucker)
+# Distances are measured to segments (not lines), so a stroke that turns back on itself keeps its turning point
+def simplify(pts, tol):
+    n = len(pts)
+    if n < 3: return pts
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [ (0, n - 1) ]
+    while stack:
+        a, c = stack.pop()
+        if c - a < 2: continue
+        seg = pts[c] - pts[a]
+        rel = pts[a+1:c] - pts[a]
+        length2 = float(seg @ seg)
+        t = np.clip(rel @ seg / length2, 0, 1) if length2 > 0 else np.zeros(len(rel))
+        d = np.hypot(*(rel - t[:, None] * seg).T)
+        k = int(np.argmax(d))
+        if d[k] > tol:
+            b = a + 1 + k
+            keep[b] = True
+            stack.append((a, b))
+            stack.append((b, c))
+    return pts[keep]
+
+def length(pts):
+    return float(np.sum(np.hypot(*np.diff(pts, axis=0).T)))
+
+# Clean up strokes, tolerances in the units of the points (None to skip a step)
+# Returns the cleaned strokes and the number of dropped strokes
+def cleanup_lines(lines, join_tol = None, simplify_tol = None, min_length = None, reverse = True):
+    if join_tol != None: lines = join(lines, join_tol, reverse)
+    if simplify_tol != None: lines = [ simplify(line, simplify_tol) for line in lines ]
+    dropped = 0
+    if min_length != None:
+        count = len(lines)
+        lines = [ line for line in lines if length(line) >= min_length ]
+        dropped = count - len(lines)
+    return lines, dropped
+
+# Clean up all paths of an svg, tolerances in mm (see above)
+# Returns the cleaned svg and a report with the number of pen lifts (strokes) and points before and after,
+# and the number of dropped strokes. Returns the svg unchanged and None if the svg isn't supported
+def cleanup_svg(svg, join = 0.02, simplify = 0.01, min_length = 0.02, reverse = True, precision = 3):
+    try:
+        scale, ox, oy = estimate.page_transform(svg)
+    except Exception:
+        return svg, None
+    to_user = lambda tol: tol / scale if tol != None else None # mm to user units
+    report = { 'pen_lifts_before': 0, 'pen_lifts_after': 0, 'points_before': 0, 'points_after': 0, 'dropped': 0 }
+    out = []
+    last = 0
+    for match in _PATH_D.finditer(svg):
+        try:
+            lines = [ np.frombuffer(line, dtype=float).reshape(-1, 2) for line in path.polylines(match.group(2)) ]
+        except ValueError:
+            continue
+        cleaned, dropped = cleanup_lines(lines, to_user(join), to_user(simplify), to_user(min_length), reverse)
+        report['pen_lifts_before'] += len(lines)
+        report['pen_lifts_after'] += len(cleaned)
+        report['points_before'] += sum(map(len, lines))
+        report['points_after'] += sum(map(len, cleaned))
+        report['dropped'] += dropped
+        if len(cleaned) == len(lines) and all( len(a) == len(b) for a, b in zip(lines, cleaned) ): continue # nothing changed
+        out.append(svg[last:match.start(2)])
+        out.append(path.encode_polylines([ line.ravel().tolist() for line in cleaned ], precision))
+        last = match.end(2)
+    out.append(svg[last:])
+    return ''.join(out), report
+
+
+# Strokes like those of turtle graphics: chains of short collinear segments, drawn as separate strokes
+def random_svg(n = 2000, size = (420, 297), seed = 0):
+    rng = np.random.default_rng(seed)
+    lines = []
+    for i in range(n // 20):
+        pos = rng.uniform([10, 10], [size[0] - 10, size[1] - 10])
+        for j in range(20):
+            direction = rng.choice([ [1, 0], [0, 1], [-1, 0], [0, -1] ]) * rng.uniform(1, 5)
+            steps = np.outer(np.linspace(0, 1, 5), direction) + pos
+            lines.append(steps.ravel().tolist())
+            pos = steps[-1]
+    d = path.encode_polylines(lines)
+    return f'<svg xmlns="http://www.w3.org/2000/svg" width="{size[0]}mm" height="{size[1]}mm" viewBox="0 0 {size[0]} {size[1]}"><path d="{d}" /></svg>'
+
+def benchmark():
+    import time
+    for n in [2000, 20000]:
+        svg = random_svg(n)
+        start = time.perf_counter()
+        out, report = cleanup_svg(svg)
+        t = time.perf_counter() - start
+        before, after = estimate.estimate(svg), estimate.estimate(out)
+        print(f'{n:>6} strokes: pen lifts {report["pen_lifts_before"]} -> {report["pen_lifts_after"]}, ' +
+            f'points {report["points_before"]} -> {report["points_after"]}, ' +
+            f'time {before["time_estimate"]/60:.1f} -> {after["time_estimate"]/60:.1f} min ({t:.2f} s)')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    
+    def svg_doc(d, width = 100):
+        return f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}mm" height="100mm" viewBox="0 0 100 100"><path d="{d}" /></svg>'
+    
+    def strokes(svg):
+        return [ list(line) for m in _PATH_D.finditer(svg) for line in path.polylines(m.group(2)) ]
+    
+    arr = lambda *pts: np.array(pts, dtype=float)
+    
+    class Test(unittest.TestCase):
+        def test_join(self):
+            lines = [ arr([0, 0], [1, 0]), arr([5, 5], [6, 6]), arr([2, 0], [1, 0]), arr([-1, 0], [0, 0]) ]
+            joined = join(lines, 0.01)
+            self.assertEqual([ x.tolist() for x in joined ], [ [[-1, 0], [0, 0], [0, 0], [1, 0], [1, 0], [2, 0]], [[5, 5], [6, 6]] ])
+            joined = join(lines, 0.01, reverse = False)
+            self.assertEqual(len(joined), 3) # [2, 0] -> [1, 0] can't be reversed
+            self.assertEqual(len(join([ arr([0, 0], [1, 0]), arr([1.1, 0], [2, 0]) ], 0.2)), 1)
+            self.assertEqual(len(join([ arr([0, 0], [1, 0]), arr([1.1, 0], [2, 0]) ], 0.05)), 2)
+        
+        def test_join_closed(self):
+            square = arr([0, 0], [1, 0], [1, 1], [0, 0])
+            self.assertEqual(len(join([ square, arr([5, 5], [6, 6]) ], 0.01)), 2)
+        
+        def test_simplify(self):
+            self.assertEqual(simplify(arr([0, 0], [1, 0], [2, 0], [2, 0], [3, 0.001], [4, 0]), 0.01).tolist(), [[0, 0], [4, 0]])
+            self.assertEqual(simplify(arr([0, 0], [1, 0], [2, 1]), 0.01).tolist(), [[0, 0], [1, 0], [2, 1]])
+            self.assertEqual(simplify(arr([0, 0], [2, 0], [1, 0]), 0.01).tolist(), [[0, 0], [2, 0], [1, 0]]) # turning back
+            self.assertEqual(simplify(arr([0, 0], [0, 0], [0, 0]), 0.01).tolist(), [[0, 0], [0, 0]])
+        
+        def test_cleanup_svg(self):
+            svg = svg_doc('M 0 0 L 10 0 M 10 0 L 20 0 20 10 M 50 50 L 50.001 50 M 60 60 L 70 70')
+            out, report = cleanup_svg(svg)
+            self.assertEqual(strokes(out), [ [0, 0, 20, 0, 20, 10], [60, 60, 70, 70] ])
+            self.assertEqual(report, { 'pen_lifts_before': 4, 'pen_lifts_after': 2, 'points_before': 9, 'points_after': 5, 'dropped': 1 })
+            out, report = cleanup_svg(svg, min_length = None)
+            self.assertEqual(report['pen_lifts_after'], 3)
+            self.assertEqual(cleanup_svg(out, min_length = None)[0], out) # nothing left to do
+        
+        def test_tolerance_in_mm(self):
+            svg = svg_doc('M 0 0 L 10 0 M 10.1 0 L 20 0', width = 1000) # 10 mm per user unit
+            self.assertEqual(cleanup_svg(svg, join = 0.5)[1]['pen_lifts_after'], 2)
+            self.assertEqual(cleanup_svg(svg, join = 2)[1]['pen_lifts_after'], 1)
+        
+        def test_unsupported(self):
+            svg = svg_doc('M 0 0 C 1 1 2 2 3 3')
+            self.assertEqual(cleanup_svg(svg)[0], svg)
+            self.assertEqual(cleanup_svg('<svg viewBox="0 0 10 10" width="10furlong"></svg>'), ('<svg viewBox="0 0 10 10" width="10furlong"></svg>', None))
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
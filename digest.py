@@ -0,0 +1,76 @@
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Content digests of jobs (used in filenames, for recognizing duplicates and as simulation cache key)
+# Digests are hex strings; they are computed once when a job is received, in a streaming fashion for uploads
+
+ALGORITHMS = ['xxh3_128', 'sha1', 'blake2b'] # xxh3_128 needs the xxhash module
+# fastest available: xxh3 is an order of magnitude faster than the others,
+# sha1 is hardware accelerated on most CPUs and usually beats blake2b
+DEFAULT = 'xxh3_128' if xxhash != None else 'sha1'
+
+# Returns a hash object with update() and hexdigest()
+# algorithm None uses the default
+def new(algorithm = None):
+    if algorithm == None: algorithm = DEFAULT
+    if algorithm == 'blake2b': return hashlib.blake2b(digest_size = 20)
+    if algorithm == 'sha1': return hashlib.sha1()
+    if algorithm == 'xxh3_128':
+        if xxhash == None: raise ValueError('Digest algorithm xxh3_128 needs the xxhash module (pip install xxhash)')
+        return xxhash.xxh3_128()
+    raise ValueError(f'Unknown digest algorithm: {algorithm}')
+
+# Digest of str (utf-8) or bytes-like data
+def digest(data, algorithm = None):
+    h = new(algorithm)
+    h.update(data.encode('utf-8') if isinstance(data, str) else data)
+    return h.hexdigest()
+
+def benchmark(size_mb = 64):
+    import os
+    import time
+    data = os.urandom(size_mb * 2**20)
+    for algorithm in ALGORITHMS:
+        try:
+            new(algorithm)
+        except ValueError as e:
+            print(f'{algorithm:<10} {e}')
+            continue
+        start = time.perf_counter()
+        digest(data, algorithm)
+        t = time.perf_counter() - start
+        print(f'{algorithm:<10} {size_mb / t:8.0f} MB/s')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    
+    class Test(unittest.TestCase):
+        def test_digest(self):
+            self.assertEqual(digest('abc', 'sha1'), hashlib.sha1(b'abc').hexdigest())
+            self.assertEqual(digest('abc'), digest(b'abc'))
+            self.assertEqual(len(digest('abc', 'blake2b')), 40)
+            self.assertEqual(digest('abc'), digest('abc', DEFAULT))
+            self.assertNotEqual(digest('abc'), digest('abd'))
+        
+        def test_streaming(self):
+            h = new()
+            for part in [b'<svg>', b'...', b'</svg>']: h.update(part)
+            self.assertEqual(h.hexdigest(), digest('<svg>...</svg>'))
+        
+        def test_algorithms(self):
+            with self.assertRaises(ValueError): new('md4')
+            if xxhash == None:
+                with self.assertRaises(ValueError): new('xxh3_128')
+            else:
+                self.assertEqual(len(digest('abc', 'xxh3_128')), 32)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
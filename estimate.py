@@ -0,0 +1,307 @@
+import re
+import numpy as np
+
+import path
+
+# Fast analytic plot time estimate
+# Models the AxiDraw motion: trapezoidal velocity profiles for pen-down and pen-up moves, slowing down
+# at corners, and the time it takes the servo to lift and lower the pen
+# Only straight path segments are supported (M, L, H, V, Z), which is what tg-plot produces
+# The estimate is meant for queueing jobs immediately; it is refined later by a full simulation
+
+# AxiDraw motion parameters (from axidraw_conf.py, high resolution mode), lengths in mm
+SPEED_LIMIT = 8.6979 * 25.4 # max. XY speed at 100% (mm/s)
+ACCEL_PENDOWN = 40 * 25.4 # acceleration with pen down at accel 100% (mm/s^2)
+ACCEL_PENUP = 60 * 25.4 # acceleration with pen up at accel 100% (mm/s^2)
+SERVO_MOVE_MIN = 45 # minimum time for a pen move (ms)
+SERVO_MOVE_SLOPE = 2.69 # additional time per percent of pen travel, at pen rate 100% (ms)
+MIN_SEGMENT = 0.001 # segments shorter than this are ignored (mm)
+
+DEFAULT_OPTIONS = {
+    'speed_pendown': 25,
+    'speed_penup': 75,
+    'accel': 75,
+    'pen_rate_lower': 50,
+    'pen_rate_raise': 75,
+    'pen_pos_up': 60,
+    'pen_pos_down': 40,
+}
+
+_LAYER = re.compile(r'<g\b[^>]*\binkscape:groupmode="layer"[^>]*>')
+_PATH_D = re.compile(r'<path\b[^>]*?\sd="([^"]*)"')
+_ROOT = re.compile(r'<svg\b[^>]*>')
+_LENGTH = re.compile(r'^\s*([-+]?[\d.]+(?:[eE][-+]?\d+)?)\s*(mm|cm|in|px|pt)?\s*$')
+
+UNITS_MM = { 'mm': 1, 'cm': 10, 'in': 25.4, 'px': 25.4/96, 'pt': 25.4/72, None: 25.4/96 }
+
+def _attr(tag, name):
+    match = re.search(r'\s' + name + r'="([^"]*)"', tag)
+    return match.group(1) if match else None
+
+# Returns (scale, offset_x, offset_y) to convert user units to mm on the page
+def page_transform(svg):
+    root = _ROOT.search(svg)
+    if not root: raise ValueError('No svg element')
+    root = root.group(0)
+    viewbox = _attr(root, 'viewBox')
+    width = _attr(root, 'width')
+    if viewbox == None:
+        return 1.0, 0.0, 0.0
+    vb = [ float(x) for x in re.split(r'[\s,]+', viewbox.strip()) ]
+    if width == None: return 1.0, vb[0], vb[1] # assume user units are mm
+    match = _LENGTH.match(width)
+    if not match or vb[2] == 0: raise ValueError('Unsupported width')
+    width_mm = float(match.group(1)) * UNITS_MM[match.group(2)]
+    return width_mm / vb[2], vb[0], vb[1]
+
+# Decode path data into a list of subpaths, each a (n, 2) array of absolute coordinates
+def decode_subpaths(d):
+    return [ np.frombuffer(line, dtype=float).reshape(-1, 2) for line in path.polylines(d) ]
+
+_FAST_PATH = re.compile(r'[ML\d\s,.eE+-]*')
+_EMPTY_COMMAND = re.compile(r'[ML][\s,]*(?:[ML]|$)')
+
+# Decode path data into an (n, 2) array of absolute coordinates and an array of subpath ids for each point
+def decode_path(d):
+    if _FAST_PATH.fullmatch(d) and d.lstrip()[:1] == 'M' and not _EMPTY_COMMAND.search(d):
+        # absolute moveto/lineto only (tg-plot output): parse all numbers at once, marking subpath starts with nan
+        # every token has to be a number (e.g. not 1..5 or 1e), numbers without separators (1-2) take the slow path
+        try:
+            nums = np.array(d.replace(',', ' ').replace('M', ' nan nan ').replace('L', ' ').split(), dtype=float)
+        except ValueError:
+            pass
+        else:
+            if len(nums) % 2: raise ValueError('Invalid path data')
+            pts = nums.reshape(-1, 2)
+            marks = np.isnan(pts[:, 0])
+            sub_id = np.cumsum(marks)[~marks] - 1
+            pts = pts[~marks]
+            if np.isnan(pts).any(): raise ValueError('Invalid path data')
+            return pts, sub_id
+    subpaths = decode_subpaths(d)
+    if len(subpaths) == 0: return np.zeros((0, 2)), np.zeros(0, dtype=int)
+    sub_id = np.repeat(np.arange(len(subpaths)), [ len(x) for x in subpaths ])
+    return np.concatenate(subpaths), sub_id
+
+# Decode all paths of an svg document
+# Returns a list of layers, each a tuple of absolute coordinates in mm and subpath ids (see decode_path)
+# Paths before the first layer are added to a layer of their own
+def decode_svg(svg):
+    scale, ox, oy = page_transform(svg)
+    layer_starts = [ m.start() for m in _LAYER.finditer(svg) ]
+    layers = [ [] for i in range(len(layer_starts) + 1) ]
+    for match in _PATH_D.finditer(svg):
+        layer = np.searchsorted(layer_starts, match.start())
+        layers[layer].append( decode_path(match.group(1)) )
+    out = []
+    for paths in layers:
+        paths = [ p for p in paths if len(p[0]) > 0 ]
+        if len(paths) == 0: continue
+        offsets = np.cumsum([0] + [ p[1][-1] + 1 for p in paths[:-1] ])
+        pts = np.concatenate([ p[0] for p in paths ])
+        sub_id = np.concatenate([ p[1] + o for p, o in zip(paths, offsets) ])
+        pts = (pts - [ox, oy]) * scale
+        out.append((pts, sub_id))
+    return out
+
+# Time (s) for moving distance d with entry speed v0, exit speed v1, max speed v and acceleration a
+# All arguments can be arrays
+def move_time(d, v0, v1, v, a):
+    d_acc = (v**2 - v0**2) / (2*a)
+    d_dec = (v**2 - v1**2) / (2*a)
+    # trapezoid: accelerate to v, cruise, decelerate
+    t_trap = (v - v0)/a + (v - v1)/a + np.maximum(d - d_acc - d_dec, 0) / v
+    # triangle: v isn't reached
+    vp = np.sqrt(np.maximum((2*a*d + v0**2 + v1**2) / 2, 0))
+    vp = np.maximum(vp, np.maximum(v0, v1))
+    t_tri = (vp - v0)/a + (vp - v1)/a
+    return np.where(d_acc + d_dec <= d, t_trap, t_tri)
+
+# Pen-down time and distance for all segments of all subpaths
+def _pendown_time(pts, sub_id, v, a):
+    seg = np.diff(pts, axis=0)
+    length = np.hypot(seg[:, 0], seg[:, 1])
+    keep = (sub_id[1:] == sub_id[:-1]) & (length > MIN_SEGMENT)
+    seg, length, sid = seg[keep], length[keep], sub_id[1:][keep]
+    if len(length) == 0: return 0.0, 0.0
+    # junction speed: full speed when going straight, stop when reversing or at the end of a subpath
+    unit = seg / length[:, None]
+    cos = np.einsum('ij,ij->i', unit[:-1], unit[1:])
+    vj = v * np.clip((1 + cos) / 2, 0, 1)
+    vj = np.minimum(vj, np.sqrt(2 * a * np.minimum(length[:-1], length[1:])))
+    vj = np.where(sid[1:] == sid[:-1], vj, 0)
+    v0 = np.concatenate(([0.0], vj))
+    v1 = np.concatenate((vj, [0.0]))
+    return float(np.sum(move_time(length, v0, v1, v, a))), float(np.sum(length))
+
+def pen_move_time(options):
+    travel = abs(options['pen_pos_up'] - options['pen_pos_down'])
+    raise_ms = SERVO_MOVE_MIN + SERVO_MOVE_SLOPE * travel * 100 / max(options['pen_rate_raise'], 1)
+    lower_ms = SERVO_MOVE_MIN + SERVO_MOVE_SLOPE * travel * 100 / max(options['pen_rate_lower'], 1)
+    return raise_ms / 1000, lower_ms / 1000
+
+# Estimate the plot time of an svg with the given plot options (see DEFAULT_OPTIONS)
+# Returns a dict compatible with spooler.simulate() (time in s, distances in m), with per layer stats in 'layer_stats'
+def estimate(svg, options = {}):
+    options = { **DEFAULT_OPTIONS, **options }
+    v_down = SPEED_LIMIT * min(options['speed_pendown'], 110) / 100
+    v_up = SPEED_LIMIT * min(options['speed_penup'], 110) / 100
+    a_down = ACCEL_PENDOWN * options['accel'] / 100
+    a_up = ACCEL_PENUP * options['accel'] / 100
+    t_raise, t_lower = pen_move_time(options)
+    
+    layers = decode_svg(svg)
+    layer_stats = []
+    pos = np.zeros(2) # home
+    for i, (pts, sub_id) in enumerate(layers):
+        # subpaths with at least two points
+        counts = np.bincount(sub_id)
+        first = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        last = first + counts - 1
+        first, last = first[counts > 1], last[counts > 1]
+        if len(first) == 0: continue
+        # pen-up travel: from the end of the previous subpath to the start of the next one
+        frm = np.vstack(([pos], pts[last[:-1]]))
+        to = pts[first]
+        if i == len(layers) - 1: # return home at the end
+            frm = np.vstack((frm, pts[last[-1:]]))
+            to = np.vstack((to, [[0, 0]]))
+        travel = np.hypot(*(to - frm).T)
+        travel = travel[travel > MIN_SEGMENT]
+        t_up = float(np.sum(move_time(travel, 0, 0, v_up, a_up)))
+        d_up = float(np.sum(travel))
+        t_down, d_down = _pendown_time(pts, sub_id, v_down, a_down)
+        pos = pts[last[-1]]
+        layer_stats.append({
+            'time_estimate': t_up + t_down + len(first) * (t_raise + t_lower),
+            'distance_total': (d_up + d_down) / 1000,
+            'distance_pendown': d_down / 1000,
+            'pen_lifts': len(first),
+        })
+    
+    total = lambda key: sum( x[key] for x in layer_stats )
+    return {
+        'error_code': 0,
+        'time_estimate': total('time_estimate'),
+        'distance_total': total('distance_total'),
+        'distance_pendown': total('distance_pendown'),
+        'pen_lifts': total('pen_lifts'),
+        'layers': max(len(layer_stats), 1),
+        'layer_stats': layer_stats,
+    }
+
+
+if __name__ == '__main__':
+    import unittest
+    import time
+    import importlib.util
+    
+    def svg_doc(*layers, width='100mm', viewbox='0 0 100 100'):
+        out = f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="{width}" height="{width}" viewBox="{viewbox}">'
+        for i, paths in enumerate(layers):
+            out += f'<g inkscape:groupmode="layer" inkscape:label="{"!" if i > 0 else ""}{i} Layer {i}">'
+            for d in paths: out += f'<path d="{d}" />'
+            out += '</g>'
+        return out + '</svg>'
+    
+    class Test(unittest.TestCase):
+        def test_decode_subpaths(self):
+            sub = decode_subpaths('M 0 0 L 10 0 10 10 M -5 -5 L -5e1 1.5E1')
+            self.assertEqual(len(sub), 2)
+            self.assertEqual(sub[0].tolist(), [[0, 0], [10, 0], [10, 10]])
+            self.assertEqual(sub[1].tolist(), [[-5, -5], [-50, 15]])
+        
+        def test_decode_relative(self):
+            sub = decode_subpaths('m 1 1 l 1 0 0 1 h -1 z M 5 5 H 6 V 7')
+            self.assertEqual(sub[0].tolist(), [[1, 1], [2, 1], [2, 2], [1, 2], [1, 1]])
+            self.assertEqual(sub[1].tolist(), [[5, 5], [6, 5], [6, 7]])
+        
+        def test_decode_invalid(self):
+            with self.assertRaises(ValueError): decode_subpaths('M 0 0 C 1 1 2 2 3 3')
+            with self.assertRaises(ValueError): decode_subpaths('L 1 1')
+            with self.assertRaises(ValueError): decode_subpaths('M 1')
+            with self.assertRaises(ValueError): decode_subpaths('x M 1 1')
+        
+        def test_decode_svg_units(self):
+            svg = svg_doc(['M -50 -50 L 50 50'], width='200mm', viewbox='-50 -50 100 100')
+            pts, sub_id = decode_svg(svg)[0]
+            self.assertEqual(pts.tolist(), [[0, 0], [200, 200]])
+        
+        def test_decode_path(self):
+            pts, sub_id = decode_path('M 0 0 L 10 0 10 10 M -5 -5 L -5e1 1.5E1 M 3 3')
+            self.assertEqual(pts.tolist(), [[0, 0], [10, 0], [10, 10], [-5, -5], [-50, 15], [3, 3]])
+            self.assertEqual(sub_id.tolist(), [0, 0, 0, 1, 1, 2])
+            pts, sub_id = decode_path('M 0,0 L 10,0 m 1 1 l 1 1')
+            self.assertEqual(pts.tolist(), [[0, 0], [10, 0], [11, 1], [12, 2]])
+            self.assertEqual(sub_id.tolist(), [0, 0, 1, 1])
+            with self.assertRaises(ValueError): decode_path('M 0 0 M 1 1 L 1')
+            with self.assertRaises(ValueError): decode_path('M L 1 1')
+            with self.assertRaises(ValueError): decode_path('M 0 0 L 1..5 2 3 3')
+            with self.assertRaises(ValueError): decode_path('M 0 0 L 1e 2 3 3')
+            self.assertEqual(decode_path('M 0 0 L 1-2 3,4')[0].tolist(), [[0, 0], [1, -2], [3, 4]]) # no separator before a sign, not parsed by the fast path
+        
+        def test_move_time(self):
+            v, a = 100.0, 1000.0
+            # long move: accelerate (0.1 s, 5 mm), cruise, decelerate (0.1 s, 5 mm)
+            self.assertAlmostEqual(float(move_time(110.0, 0, 0, v, a)), 1.2)
+            # short move: v isn't reached
+            self.assertAlmostEqual(float(move_time(10.0, 0, 0, v, a)), 0.2)
+            self.assertAlmostEqual(float(move_time(2.5, 0, 0, v, a)), 0.1)
+            # already at full speed
+            self.assertAlmostEqual(float(move_time(100.0, v, v, v, a)), 1.0)
+        
+        def test_estimate(self):
+            options = { 'speed_pendown': 100, 'speed_penup': 100, 'accel': 100, 'pen_rate_lower': 100, 'pen_rate_raise': 100 }
+            one = estimate(svg_doc(['M 10 10 L 90 10']), options)
+            self.assertEqual(one['layers'], 1)
+            self.assertEqual(one['pen_lifts'], 1)
+            self.assertAlmostEqual(one['distance_pendown'], 0.08)
+            self.assertAlmostEqual(one['distance_total'], 0.08 + (2**0.5 * 10 + 90.55385) / 1000, places=5)
+            # straight continuation is faster than a reversal
+            straight = estimate(svg_doc(['M 10 10 L 50 10 90 10']), options)
+            reverse = estimate(svg_doc(['M 10 10 L 90 10 10 10']), options)
+            self.assertAlmostEqual(straight['time_estimate'], one['time_estimate'], places=5)
+            self.assertGreater(reverse['time_estimate'], one['time_estimate'])
+            # slower speed takes longer
+            slow = estimate(svg_doc(['M 10 10 L 90 10']), { **options, 'speed_pendown': 50, 'pen_rate_raise': 50 })
+            self.assertGreater(slow['time_estimate'], one['time_estimate'])
+        
+        def test_layers(self):
+            res = estimate(svg_doc(['M 10 10 L 90 10'], ['M 10 20 L 90 20', 'M 10 30 L 90 30']))
+            self.assertEqual(res['layers'], 2)
+            self.assertEqual(res['pen_lifts'], 3)
+            self.assertEqual([ x['pen_lifts'] for x in res['layer_stats'] ], [1, 2])
+            self.assertAlmostEqual(res['time_estimate'], sum( x['time_estimate'] for x in res['layer_stats'] ))
+        
+        def test_large(self):
+            # ~5 MB of path data
+            rng = np.random.default_rng(0)
+            pts = rng.uniform(0, 100, (300_000, 2))
+            d = ' '.join( f'M {a[0]:.3f} {a[1]:.3f} L {b[0]:.3f} {b[1]:.3f}' for a, b in zip(pts[0::2], pts[1::2]) )
+            svg = svg_doc([d])
+            start = time.perf_counter()
+            res = estimate(svg)
+            elapsed = time.perf_counter() - start
+            self.assertEqual(res['pen_lifts'], 150_000)
+            self.assertLess(elapsed, 2)
+    
+    # Calibration against pyaxidraw (only if available): python estimate.py Calibration
+    CALIBRATION_TOLERANCE = 0.15 # max. relative error
+    
+    @unittest.skipUnless(importlib.util.find_spec('pyaxidraw'), 'pyaxidraw not available')
+    class Calibration(unittest.TestCase):
+        def test_corpus(self):
+            import spooler
+            import test_job
+            for name in ['square', 'wide', 'high', 'layers']:
+                for speed in [100, 50, 10]:
+                    svg = getattr(test_job, 'test_' + name)
+                    sim = spooler.simulate({ 'svg': svg, 'speed': speed })
+                    est = estimate(svg, spooler.plot_options(speed))
+                    with self.subTest(name=name, speed=speed):
+                        print(f'{name} @ {speed}%: simulated {sim["time_estimate"]:.2f} s, estimated {est["time_estimate"]:.2f} s')
+                        self.assertEqual(est['layers'], sim['layers'])
+                        self.assertAlmostEqual(est['time_estimate'] / sim['time_estimate'], 1, delta=CALIBRATION_TOLERANCE)
+                        self.assertAlmostEqual(est['distance_pendown'] / sim['distance_pendown'], 1, delta=0.01)
+    
+    unittest.main()
@@ -0,0 +1,194 @@
+import re
+import numpy as np
+
+import estimate
+
+# Sheet ganging: several small drawings are packed onto one sheet and plotted as one job (see spooler.gang)
+# Drawings keep their orientation and scale, they are only moved. Coordinates are in mm on the page
+# Paths are rewritten with absolute coordinates (instead of using transforms), so the analytic estimate
+# works on the composite as well. Only straight path segments are supported (see estimate.py)
+# Paths are read without their context, so drawings with transforms, other shapes (e.g. <line>), nested svgs or
+# paths that aren't plotted as they are (e.g. in <defs>) can't be ganged: they would change on the sheet
+
+_ROOT = re.compile(r'<svg\b[^>]*>')
+_STROKE = re.compile(r'\sstroke="([^"]*)"')
+_LAYER = re.compile(r'<g\b[^>]*\binkscape:groupmode="layer"[^>]*>')
+_TRANSFORM = re.compile(r'\stransform\s*=')
+_UNSUPPORTED = re.compile(r'<(?:\w+:)?(?:line|polyline|polygon|rect|circle|ellipse|use|text|image|svg|defs|symbol|marker|pattern|clipPath|mask|foreignObject)\b')
+
+# Raises ValueError if a drawing can't be moved by rewriting its paths (see above)
+def check_supported(svg):
+    root = _ROOT.search(svg)
+    if root == None: raise ValueError('No svg element')
+    if _TRANSFORM.search(svg): raise ValueError('Transforms are not supported')
+    match = _UNSUPPORTED.search(svg, root.end())
+    if match: raise ValueError(f'Unsupported element: {match.group(0)[1:]}')
+
+# Bounding box of all paths in mm on the page: (x0, y0, x1, y1), None if there are no paths
+# Raises ValueError for drawings that can't be ganged (see check_supported)
+def bounds(svg):
+    check_supported(svg)
+    layers = estimate.decode_svg(svg)
+    if len(layers) == 0: return None
+    pts = np.concatenate([ pts for pts, sub_id in layers ])
+    x0, y0 = pts.min(axis=0)
+    x1, y1 = pts.max(axis=0)
+    return ( float(x0), float(y0), float(x1), float(y1) )
+
+# Pen (stroke color) of the drawing: stroke of the first layer, or of the svg element
+def pen(svg):
+    for tag in [ _LAYER.search(svg), _ROOT.search(svg) ]:
+        if tag == None: continue
+        match = _STROKE.search(tag.group(0))
+        if match: return match.group(1)
+    return None
+
+# Shelf packing: rectangles (w, h) are sorted by height and placed left to right in rows (shelves),
+# each into the first shelf with enough room
+# Returns the top left corner of each rectangle (in input order), or None if they don't all fit into width x height
+def pack(sizes, width, height, spacing = 0):
+    order = sorted( range(len(sizes)), key = lambda i: -sizes[i][1] )
+    pos = [None] * len(sizes)
+    shelves = [] # [top, height, used width]
+    bottom = 0
+    for i in order:
+        w, h = sizes[i]
+        if w > width: return None
+        for shelf in shelves:
+            if h <= shelf[1] and shelf[2] + spacing + w <= width:
+                pos[i] = ( shelf[2] + spacing, shelf[0] )
+                shelf[2] += spacing + w
+                break
+        else:
+            top = bottom + spacing if shelves else 0
+            if top + h > height: return None
+            shelves.append([top, h, w])
+            pos[i] = ( 0, top )
+            bottom = top + h
+    return pos
+
+# Place drawings with the given bounding boxes (see bounds) on a sheet of size (width, height), leaving a margin
+# Returns the offset (dx, dy) to move each drawing by, or None if they don't fit
+def arrange(boxes, size, margin = 0, spacing = 0):
+    sizes = [ (x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes ]
+    pos = pack(sizes, size[0] - 2 * margin, size[1] - 2 * margin, spacing)
+    if pos == None: return None
+    return [ (margin + x - box[0], margin + y - box[1]) for (x, y), box in zip(pos, boxes) ]
+
+def _path_data(pts, sub_id):
+    starts = np.flatnonzero( np.diff(sub_id, prepend = -1) )
+    d = []
+    for sub in np.split(pts, starts[1:]):
+        if len(sub) < 2: continue
+        coords = [ f'{v:.3f}' for v in sub.ravel() ]
+        d.append( f'M {coords[0]} {coords[1]} L ' + ' '.join(coords[2:]) )
+    return ' '.join(d)
+
+# Composite svg of a sheet of size (width, height) in mm
+# parts: list of (svg, (dx, dy)), the drawings and the offsets to move them by (see arrange)
+# All layers of all parts end up in a single layer
+def compose(parts, size, stroke = 'black'):
+    width, height = size
+    paths = []
+    for svg, (dx, dy) in parts:
+        check_supported(svg)
+        for pts, sub_id in estimate.decode_svg(svg):
+            d = _path_data(pts + [dx, dy], sub_id)
+            if d: paths.append(f'        <path d="{d}" />')
+    return '\n'.join([
+        '<svg xmlns="http://www.w3.org/2000/svg"',
+        '     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"',
+        f'     width="{width}mm"',
+        f'     height="{height}mm"',
+        f'     viewBox="0 0 {width} {height}"',
+        f'     stroke="{stroke}" fill="none" stroke-linecap="round">',
+        f'    <g id="Sheet" stroke="{stroke}" inkscape:groupmode="layer" inkscape:label="1 Sheet">',
+        *paths,
+        '    </g>',
+        '</svg>',
+    ])
+
+
+# Jobs per hour with and without ganging, for random small drawings on A3 (and a paper change for every sheet)
+def benchmark(n = 100, size = (420, 297), paper_change = 60, max_jobs = 4, seed = 0):
+    import random
+    import time
+    rng = random.Random(seed)
+    
+    def drawing():
+        w, h = rng.uniform(40, 200), rng.uniform(40, 140)
+        x, y = rng.uniform(0, size[0] - w), rng.uniform(0, size[1] - h)
+        d = ' '.join( f'M {x:.3f} {y + i * h / 10:.3f} L {x + w:.3f} {y + i * h / 10:.3f}' for i in range(11) )
+        return f'<svg width="{size[0]}mm" height="{size[1]}mm" viewBox="0 0 {size[0]} {size[1]}"><path d="{d}" /></svg>'
+    
+    svgs = [ drawing() for i in range(n) ]
+    single = sum( estimate.estimate(svg)['time_estimate'] + paper_change for svg in svgs )
+    
+    start = time.perf_counter()
+    sheets = []
+    waiting = [ (svg, bounds(svg)) for svg in svgs ]
+    while waiting:
+        members = [ waiting.pop(0) ]
+        for item in list(waiting):
+            if len(members) == max_jobs: break
+            if arrange([ box for svg, box in members + [item] ], size, 10, 5) != None:
+                members.append(item)
+                waiting.remove(item)
+        offsets = arrange([ box for svg, box in members ], size, 10, 5)
+        sheets.append( compose([ (svg, offset) for (svg, box), offset in zip(members, offsets) ], size) )
+    t = time.perf_counter() - start
+    ganged = sum( estimate.estimate(svg)['time_estimate'] + paper_change for svg in sheets )
+    
+    print(f'single: {n} jobs on {n} sheets, {single/3600:.2f} h, {n / single * 3600:.1f} jobs/h')
+    print(f'ganged: {n} jobs on {len(sheets)} sheets, {ganged/3600:.2f} h, {n / ganged * 3600:.1f} jobs/h (packing took {t*1000:.0f} ms)')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    
+    def svg_doc(d, width = 100, height = 100, viewbox = None):
+        return f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}mm" height="{height}mm" viewBox="{viewbox or f"0 0 {width} {height}"}" stroke="red"><path d="{d}" /></svg>'
+    
+    class Test(unittest.TestCase):
+        def test_bounds(self):
+            self.assertEqual(bounds(svg_doc('M 10 20 L 30 25 M 5 50 L 6 51')), (5, 20, 30, 51))
+            self.assertEqual(bounds(svg_doc('M -10 -10 L 10 10', viewbox = '-50 -50 100 100')), (40, 40, 60, 60))
+            self.assertEqual(bounds(svg_doc('')), None)
+            with self.assertRaisesRegex(ValueError, 'Transforms'): bounds(svg_doc('M 0 0 L 1 1" transform="translate(50 0)'))
+            with self.assertRaisesRegex(ValueError, 'Transforms'): bounds(svg_doc('M 0 0 L 1 1').replace('<path', '<g transform="translate(50 0)"><path').replace('</svg>', '</g></svg>'))
+            with self.assertRaisesRegex(ValueError, 'line'): bounds(svg_doc('M 0 0 L 1 1').replace('</svg>', '<line x1="0" y1="0" x2="5" y2="5" /></svg>'))
+            with self.assertRaisesRegex(ValueError, 'defs'): bounds(svg_doc('M 0 0 L 1 1').replace('<path', '<defs><path d="M 0 0 L 9 9" /></defs><path'))
+        
+        def test_pen(self):
+            self.assertEqual(pen(svg_doc('M 0 0 L 1 1')), 'red')
+            self.assertEqual(pen('<svg stroke="black"><g inkscape:groupmode="layer" stroke="blue"></g></svg>'), 'blue')
+            self.assertEqual(pen('<svg></svg>'), None)
+        
+        def test_pack(self):
+            self.assertEqual(pack([ (40, 20), (50, 30), (50, 10) ], 100, 100, spacing = 5), [ (55, 0), (0, 0), (0, 35) ])
+            self.assertEqual(pack([ (60, 60), (60, 60) ], 100, 100), None)
+            self.assertEqual(pack([ (60, 60), (60, 40) ], 100, 100), [ (0, 0), (0, 60) ])
+            self.assertEqual(pack([ (101, 1) ], 100, 100), None)
+        
+        def test_arrange(self):
+            boxes = [ (10, 10, 50, 30), (0, 0, 50, 30) ]
+            self.assertEqual(arrange(boxes, (100, 100), margin = 5, spacing = 5), [ (-5, 30), (5, 5) ])
+            self.assertEqual(arrange(boxes, (100, 60), margin = 5, spacing = 5), None)
+        
+        def test_compose(self):
+            a = svg_doc('M 10 10 L 50 10 50 30')
+            b = svg_doc('M 0 0 L 10 10 M 20 20 L 30 30', viewbox = '-50 -50 100 100')
+            sheet = compose([ (a, (-5, 0)), (b, (0, 40)) ], (100, 100))
+            self.assertEqual(bounds(sheet), (5, 10, 80, 120))
+            self.assertEqual(sheet.count('<path'), 2)
+            self.assertEqual(sheet.count('M '), 3)
+            self.assertIn('inkscape:groupmode="layer"', sheet)
+            length = lambda svg: estimate.estimate(svg)['distance_pendown']
+            self.assertAlmostEqual(length(sheet), length(a) + length(b))
+            with self.assertRaises(ValueError): compose([ (a, (0, 0)), (a.replace('</svg>', '<circle r="5" /></svg>'), (0, 40)) ], (100, 100))
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
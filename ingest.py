@@ -0,0 +1,283 @@
+import json
+import re
+import digest
+import xml.etree.ElementTree as ElementTree
+from xml.parsers import expat
+import protocol
+import spool_reader
+
+# Decoding and validation of client messages
+# Meant to run in a worker process (see sim_pool.py), so large plot submissions don't block the event loop
+# Plot messages are turned into jobs that are ready to be queued (normalized, svg updated and hashed)
+
+# Message schemas: keys ending with ? are optional, unknown keys are allowed
+# A type (or tuple of types) for values, a dict for nested objects, a list [type, ...] for fixed length lists
+NUMBER = (int, float)
+SCHEMA = {
+    'echo': {},
+    'cancel': {
+        'client': str,
+    },
+    # plot an archived job of the client again (see spooler.reprint)
+    'reprint': {
+        'client': str,
+        'hash': str, # digest, or a prefix of it
+    },
+    'plot': {
+        'client': str,
+        'id?': str,
+        'svg': str,
+        'stats': {
+            'count': NUMBER,
+            'layer_count': NUMBER,
+            'oob_count': NUMBER,
+            'short_count': NUMBER,
+            'travel': NUMBER,
+            'travel_ink': NUMBER,
+            'travel_blank?': NUMBER,
+        },
+        'timestamp': str,
+        'hash?': str,
+        'speed?': NUMBER,
+        'format?': str,
+        'size': [NUMBER, NUMBER],
+    },
+}
+# Plot messages with polylines (see protocol.py) need all fields except the svg, which is created from the polylines
+PLOT_META_SCHEMA = { k: v for k, v in SCHEMA['plot'].items() if k != 'svg' }
+# Chunked uploads (see uploads.py): plot_begin has all fields of a plot message except the svg
+SCHEMA['plot_begin'] = dict(PLOT_META_SCHEMA, upload_id = str, upload_size = int)
+SCHEMA['plot_chunk'] = { 'upload_id': str, 'offset': int, 'data': (str, bytes) } # str (json) or bytes (binary chunk)
+SCHEMA['plot_end'] = { 'upload_id': str }
+
+DEFAULT_SPEED = 100
+DEFAULT_FORMAT = 'A4_LANDSCAPE'
+
+def _type_name(t):
+    if isinstance(t, tuple): return ' or '.join( x.__name__ for x in t )
+    return t.__name__
+
+# Raises ValueError if value doesn't match the schema
+def validate(value, schema, name = 'message'):
+    if isinstance(schema, dict):
+        if not isinstance(value, dict): raise ValueError(f'{name} needs to be an object')
+        for key, sub_schema in schema.items():
+            optional = key.endswith('?')
+            key = key.rstrip('?')
+            if key not in value:
+                if optional: continue
+                raise ValueError(f'{name} is missing {key}')
+            validate(value[key], sub_schema, f'{name}.{key}')
+    elif isinstance(schema, list):
+        if not isinstance(value, list) or len(value) != len(schema): raise ValueError(f'{name} needs to be a list of {len(schema)}')
+        for i, sub_schema in enumerate(schema):
+            validate(value[i], sub_schema, f'{name}[{i}]')
+    elif not isinstance(value, schema) or isinstance(value, bool): # bool is a subclass of int
+        raise ValueError(f'{name} needs to be {_type_name(schema)}')
+
+# Limit speed to (min_speed, 100) and fill in defaults
+def normalize_job(job, min_speed):
+    if 'speed' in job: job['speed'] = max( min(job['speed'], 100), min_speed )
+    else: job['speed'] = DEFAULT_SPEED
+    if 'format' not in job: job['format'] = DEFAULT_FORMAT
+
+# Updated pre version 4 SVGs, so they are compatible with resume queue
+# Only the root element is searched. Returns True if the svg has been changed (the job needs a new digest)
+def update_svg(job):
+    start = job['svg'].find('<svg')
+    end = job['svg'].find('>', start)
+    if start == -1 or end == -1: return False
+    match = re.search('tg:version="(\\d+)"', job['svg'][start:end])
+    if match != None and int(match.group(1)) >= 4: return False
+    
+    MARKER = 'xmlns:tg="https://sketch.process.studio/turtle-graphics"'
+    idx = job['svg'].find(MARKER, start, end)
+    if idx == -1: return False
+    idx += len(MARKER)
+    insert = f'\n     tg:version="4" tg:layer_count="1" tg:oob_count="{job['stats']['oob_count']}" tg:short_count="{job['stats']['short_count']}" tg:format="{job['format']}" tg:width_mm="{job['size'][0]}" tg:height_mm="{job['size'][1]}" tg:speed="{job['speed']}" tg:author="{job['client']}" tg:timestamp="{job['timestamp']}"'
+    
+    job['svg'] = job['svg'][:idx] + insert + job['svg'][idx:]
+    return True
+
+# Validate the svg and prepare a plot message for the spooler
+# The job gets its canonical digest (see digest.py), the hash sent by the client is replaced
+# Pass parse_svg = False for svgs that are known to be valid, and the digest if it is already known (uploads)
+def prepare_plot(msg, min_speed, parse_svg = True, algorithm = None, svg_digest = None):
+    if parse_svg:
+        try:
+            ElementTree.fromstring(msg['svg'])
+        except ElementTree.ParseError as e:
+            raise ValueError(f'Invalid svg: {e}') from None
+    normalize_job(msg, min_speed)
+    if update_svg(msg) or svg_digest == None: svg_digest = digest.digest(msg['svg'], algorithm)
+    msg['hash'] = svg_digest
+
+# Decode a message (json as str or bytes, or a binary frame, see protocol.py) and validate it
+# Plot messages are prepared for the spooler (see prepare_plot)
+# Raises ValueError with a message that can be sent back to the client
+def decode(message, min_speed = 10, algorithm = None):
+    polylines = None
+    if protocol.is_chunk(message):
+        return protocol.decode_chunk(message)
+    if protocol.is_frame(message):
+        msg, polylines = protocol.decode_frame(message)
+    else:
+        try:
+            msg = json.loads(message)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'Invalid JSON: {e.msg} (position {e.pos})') from None # don't send the message back and forth
+    if not isinstance(msg, dict) or not isinstance(msg.get('type'), str) or msg['type'] not in SCHEMA:
+        raise ValueError('Unknown message type')
+    if polylines != None:
+        validate(msg, PLOT_META_SCHEMA)
+        msg['svg'] = protocol.polylines_svg(msg, *polylines)
+    validate(msg, SCHEMA[msg['type']])
+    
+    if msg['type'] == 'plot':
+        prepare_plot(msg, min_speed, parse_svg = polylines == None, algorithm = algorithm) # svgs created from polylines are valid
+    elif msg['type'] == 'plot_chunk' and isinstance(msg['data'], str):
+        msg['data'] = msg['data'].encode('utf-8')
+    return msg
+
+# Raises ValueError if an xml file isn't well-formed (or not utf-8). It is read in chunks, without building a tree
+def check_xml_file(path, chunk_size = 2**20):
+    parser = expat.ParserCreate()
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                parser.Parse(data, not data)
+                if not data: break
+    except expat.ExpatError as e:
+        raise ValueError(f'Invalid svg: {e}') from None
+
+# Create a plot message from a finished upload (see uploads.py)
+# meta is the plot_begin message, upload_digest the digest of the uploaded svg (computed with algorithm)
+# The svg is checked from the file, so memory doesn't grow with the size of the upload, and the message gets the upload
+# path instead of the svg: the spooler moves the file instead of writing it again. Only svgs that need to be updated
+# (before version 4, see update_svg) are read, they get the updated svg and its digest
+def decode_upload(path, meta, upload_digest, min_speed = 10, algorithm = None):
+    msg = { k: v for k, v in meta.items() if k != 'upload_size' }
+    msg['type'] = 'plot'
+    validate(msg, PLOT_META_SCHEMA)
+    check_xml_file(path)
+    normalize_job(msg, min_speed)
+    version = spool_reader.read_header(path).get('{' + spool_reader.NS + '}version', '')
+    if not version.isdigit() or int(version) < 4:
+        with open(path, 'r', encoding='utf-8', newline='') as f: msg['svg'] = f.read()
+        if update_svg(msg):
+            msg['hash'] = digest.digest(msg['svg'], algorithm)
+            return msg
+        del msg['svg']
+    msg['hash'] = upload_digest
+    msg['upload_path'] = path
+    return msg
+
+if __name__ == '__main__':
+    import unittest
+    
+    SVG = '<svg xmlns="http://www.w3.org/2000/svg" xmlns:tg="https://sketch.process.studio/turtle-graphics"><path d="M 0 0 L 1 1" /></svg>'
+    
+    def plot_msg(**kwargs):
+        msg = {
+            'type': 'plot', 'client': 'abc', 'id': 'XYZ', 'svg': SVG, 'timestamp': '20241010_210611.777_UTC+1',
+            'stats': { 'count': 1, 'layer_count': 1, 'oob_count': 0, 'short_count': 0, 'travel': 10, 'travel_ink': 5, 'travel_blank': 5 },
+            'size': [297, 210], 'speed': 50, 'format': 'A4 Landscape',
+        }
+        msg.update(kwargs)
+        return json.dumps(msg)
+    
+    class Test(unittest.TestCase):
+        def test_validate(self):
+            schema = { 'a': str, 'b?': NUMBER, 'c': { 'd': [int, int] } }
+            validate({ 'a': 'x', 'c': { 'd': [1, 2] } }, schema)
+            validate({ 'a': 'x', 'b': 1.5, 'c': { 'd': [1, 2] }, 'e': None }, schema)
+            with self.assertRaisesRegex(ValueError, 'missing a'): validate({ 'c': { 'd': [1, 2] } }, schema)
+            with self.assertRaisesRegex(ValueError, r'message\.b needs to be int or float'): validate({ 'a': 'x', 'b': '1', 'c': { 'd': [1, 2] } }, schema)
+            with self.assertRaisesRegex(ValueError, r'message\.c\.d\[1\]'): validate({ 'a': 'x', 'c': { 'd': [1, True] } }, schema)
+            with self.assertRaisesRegex(ValueError, 'list of 2'): validate({ 'a': 'x', 'c': { 'd': [1] } }, schema)
+            with self.assertRaisesRegex(ValueError, 'object'): validate([], schema)
+        
+        def test_decode(self):
+            self.assertEqual(decode('{"type": "echo"}'), { 'type': 'echo' })
+            self.assertEqual(decode(b'{"type": "cancel", "client": "abc"}'), { 'type': 'cancel', 'client': 'abc' })
+            with self.assertRaisesRegex(ValueError, 'Invalid JSON'): decode('{"type": ')
+            with self.assertRaisesRegex(ValueError, 'Unknown message type'): decode('{"type": "foo"}')
+            with self.assertRaisesRegex(ValueError, 'Unknown message type'): decode('[1, 2]')
+            with self.assertRaisesRegex(ValueError, 'Unknown message type'): decode('{"type": [1]}') # unhashable
+            with self.assertRaisesRegex(ValueError, 'Unknown message type'): decode('{"type": {}}')
+            with self.assertRaisesRegex(ValueError, 'missing client'): decode('{"type": "cancel"}')
+            self.assertEqual(decode('{"type": "reprint", "client": "abc", "hash": "f2197"}'), { 'type': 'reprint', 'client': 'abc', 'hash': 'f2197' })
+            with self.assertRaisesRegex(ValueError, 'missing hash'): decode('{"type": "reprint", "client": "abc"}')
+        
+        def test_decode_plot(self):
+            job = decode(plot_msg(speed = 5), min_speed = 10)
+            self.assertEqual(job['speed'], 10)
+            self.assertIn('tg:version="4"', job['svg'])
+            self.assertIn('tg:author="abc"', job['svg'])
+            self.assertEqual(job['hash'], digest.digest(job['svg']))
+            self.assertEqual(decode(plot_msg(), algorithm = 'sha1')['hash'], digest.digest(decode(plot_msg())['svg'], 'sha1'))
+            
+            msg = json.loads(plot_msg())
+            del msg['speed'], msg['format']
+            job = decode(json.dumps(msg))
+            self.assertEqual((job['speed'], job['format']), (DEFAULT_SPEED, DEFAULT_FORMAT))
+            
+            with self.assertRaisesRegex(ValueError, 'Invalid svg'): decode(plot_msg(svg = '<svg>'))
+            with self.assertRaisesRegex(ValueError, r'message\.stats\.travel needs'): decode(plot_msg(stats = { 'count': 1, 'layer_count': 1, 'oob_count': 0, 'short_count': 0, 'travel': '10', 'travel_ink': 5 }))
+        
+        def test_update_svg(self):
+            job = json.loads(plot_msg(svg = SVG.replace('<path', '<desc>tg:version="4"</desc><path')))
+            self.assertTrue(update_svg(job)) # only the root element counts
+            self.assertEqual(job['svg'].count('tg:version="4"'), 2)
+            self.assertFalse(update_svg(job))
+        
+        def test_decode_frame(self):
+            msg = json.loads(plot_msg())
+            self.assertEqual(decode(protocol.encode_frame(msg)), decode(plot_msg()))
+            del msg['svg']
+            job = decode(protocol.encode_frame(msg, [ [(0, 0), (1, 1)] ]))
+            self.assertIn('M 0 0 L 1000 1000', job['svg'])
+            self.assertIn('tg:speed="50"', job['svg'])
+            del msg['size']
+            with self.assertRaisesRegex(ValueError, 'missing size'): decode(protocol.encode_frame(msg, [ [(0, 0), (1, 1)] ]))
+        
+        def test_decode_chunks(self):
+            self.assertEqual(decode('{"type": "plot_chunk", "upload_id": "a", "offset": 0, "data": "<svg>"}')['data'], b'<svg>')
+            self.assertEqual(decode(protocol.encode_chunk('a', 5, b'<svg>'))['offset'], 5)
+            begin = json.loads(plot_msg())
+            del begin['svg']
+            begin.update(type = 'plot_begin', upload_id = 'a', upload_size = 10)
+            self.assertEqual(decode(json.dumps(begin))['upload_id'], 'a')
+        
+        def test_decode_upload(self):
+            import tempfile
+            import os
+            meta = json.loads(plot_msg())
+            svg = meta.pop('svg').replace('xmlns:tg="https://sketch.process.studio/turtle-graphics"', 'xmlns:tg="https://sketch.process.studio/turtle-graphics" tg:version="4"')
+            meta.update(type = 'plot_begin', upload_id = 'a', upload_size = len(svg))
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'a.part')
+                with open(path, 'w', encoding='utf-8') as f: f.write(svg)
+                svg_digest = digest.digest(svg)
+                job = decode_upload(path, dict(meta, hash = 'client hash'), svg_digest)
+                self.assertEqual((job['type'], job['hash'], job['upload_path']), ('plot', svg_digest, path))
+                self.assertNotIn('upload_size', job)
+                self.assertNotIn('svg', job) # read from the upload path
+                
+                with open(path, 'wb') as f: f.write(svg.replace('><', '>\r\n<').encode()) # line endings are kept
+                with open(path, 'rb') as f: svg_digest = digest.digest(f.read())
+                self.assertEqual(decode_upload(path, meta, svg_digest)['hash'], svg_digest)
+                
+                with open(path, 'w', encoding='utf-8') as f: f.write(SVG) # before version 4, updated
+                job = decode_upload(path, meta, digest.digest(SVG))
+                self.assertIn('tg:version="4"', job['svg'])
+                self.assertEqual(job['hash'], digest.digest(job['svg']))
+                self.assertNotIn('upload_path', job)
+                
+                with open(path, 'w', encoding='utf-8') as f: f.write(svg[:-10])
+                with self.assertRaisesRegex(ValueError, 'Invalid svg'): decode_upload(path, meta, svg_digest)
+                with open(path, 'wb') as f: f.write(svg.encode().replace(b'<path', '<päth'.encode('latin-1')))
+                with self.assertRaisesRegex(ValueError, 'Invalid svg'): decode_upload(path, meta, svg_digest)
+    
+    unittest.main()
@@ -0,0 +1,200 @@
+import tempfile
+
+# A queued plot job
+# Fields are slots instead of dict entries and can be accessed like a dict (job['speed'], 'stats' in job, job.get(...)),
+# unset fields behave like missing keys. Unknown keys of a plot message are dropped
+# The svg is only kept in memory until it has been written to the spool file (see spooler.save_svg and spool_writer.py),
+# after that it is read from the file when needed (i.e. for simulating and plotting)
+# The output svg of a paused plot (needed for resuming) is kept in an anonymous temporary file
+
+FIELDS = [
+    # plot message (see ingest.py)
+    'type', 'client', 'id', 'stats', 'timestamp', 'hash', 'speed', 'format', 'size', 'upload_id',
+    # added by the spooler
+    'status', 'cancel', 'received', 'position', 'position_notified', 'eta', 'loaded_from_file',
+    'time_estimate', 'time_estimate_source', 'layers', 'layer_estimates',
+    # digest of the svg as it was received, if it was rewritten (see spooler.replace_svg)
+    'received_hash',
+    # plot interrupted by a restart: status, repetitions, layer and interrupts (see spooler.resume_queue_from_disk)
+    'progress',
+    'save_path', 'upload_path',
+    'queue_position_cb', 'done_cb', 'cancel_cb', 'error_cb',
+    # ganging (see spooler.gang): jobs on a sheet, the sheet a job is on, bounding box and pen, True if a sheet with the job was declined
+    'members', 'sheet', 'bounds', 'pen', 'no_gang',
+    # pen-up travel (mm) and time estimate (s) before and after optimizing (see spooler.optimize_job)
+    'optimized',
+    # pen lifts and points before and after cleaning up, number of dropped fragments (see spooler.cleanup_job)
+    'cleaned',
+]
+
+class Job:
+    __slots__ = FIELDS + ['_svg', '_output']
+    
+    def __init__(self, fields = None, **kwargs):
+        self._svg = None
+        self._output = None
+        for source in [fields or {}, kwargs]:
+            for key, value in source.items():
+                if key in FIELDS or key in ['svg', 'output_svg']: self[key] = value
+    
+    def __repr__(self):
+        return f'Job({self.get("client")!r}, {self.get("hash", "")[0:5]!r}, {self.get("status")!r})'
+    
+    # svg: in memory, or read from the spool file
+    @property
+    def svg(self):
+        if self._svg != None: return self._svg
+        path = self.get('save_path') or self.get('upload_path')
+        if path == None: raise AttributeError('svg')
+        with open(path, 'r', encoding='utf-8') as f: return f.read()
+    
+    @svg.setter
+    def svg(self, svg):
+        self._svg = svg
+    
+    # Drop the in-memory svg, once it is saved at path
+    # If svg is given, the svg is only dropped if it is still the one that was saved
+    def spooled(self, path, svg = None):
+        self.save_path = path
+        if svg == None or self._svg is svg: self._svg = None
+    
+    # True if the svg is only in the spool file
+    def is_spooled(self):
+        return self._svg == None and self.get('save_path') != None
+    
+    @property
+    def output_svg(self):
+        if self._output == None: raise AttributeError('output_svg')
+        self._output.seek(0)
+        return self._output.read()
+    
+    @output_svg.setter
+    def output_svg(self, svg):
+        if self._output == None: self._output = tempfile.TemporaryFile('w+', encoding='utf-8')
+        self._output.seek(0)
+        self._output.truncate()
+        self._output.write(svg)
+    
+    @output_svg.deleter
+    def output_svg(self):
+        if self._output != None: self._output.close()
+        self._output = None
+    
+    # dict-like access
+    def __getitem__(self, key):
+        if key.startswith('_'): raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def __setitem__(self, key, value):
+        if key.startswith('_'): raise KeyError(key)
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key) from None
+    
+    def __delitem__(self, key):
+        if key not in self: raise KeyError(key)
+        delattr(self, key)
+    
+    def __contains__(self, key):
+        if key == 'svg': return self._svg != None or self.get('save_path') != None or self.get('upload_path') != None
+        if key == 'output_svg': return self._output != None
+        return key in FIELDS and hasattr(self, key)
+    
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def pop(self, key, *default):
+        if key not in self:
+            if default: return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+    
+    def keys(self):
+        return [ key for key in FIELDS + ['svg', 'output_svg'] if key in self ]
+
+
+# Memory used by queued jobs, with svgs in memory (as dicts) and spooled to disk (as Job)
+def benchmark(n = 300, svg_size = 2**20):
+    import os
+    import tracemalloc
+    svg = '<svg>' + 'M 0 0 L 1 1 ' * (svg_size // 12) + '</svg>'
+    msg = { 'type': 'plot', 'client': 'client', 'id': 'id', 'stats': {'count': 1}, 'timestamp': '', 'hash': '0' * 40, 'speed': 100, 'format': 'A3_LANDSCAPE', 'size': [420, 297] }
+    
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ['dict', 'Job']:
+            tracemalloc.start()
+            jobs = []
+            for i in range(n):
+                job = dict(msg, client = f'client-{i}', svg = svg[:-6] + f'{i}</svg>')
+                if name == 'Job':
+                    job = Job(job)
+                    path = os.path.join(folder, f'{i}.svg')
+                    with open(path, 'w', encoding='utf-8') as f: f.write(job['svg'])
+                    job.spooled(path)
+                jobs.append(job)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f'{name:<5} {n} jobs with {svg_size // 2**10} kB svgs: {size / 2**20:8.2f} MB')
+            del jobs
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    import unittest
+    
+    class Test(unittest.TestCase):
+        def test_dict_access(self):
+            job = Job({ 'client': 'abc', 'speed': 50, 'unknown': 1 }, status = 'waiting')
+            self.assertEqual(job['client'], 'abc')
+            self.assertEqual(job.status, 'waiting')
+            self.assertIn('speed', job)
+            self.assertNotIn('unknown', job)
+            self.assertNotIn('position', job)
+            with self.assertRaises(KeyError): job['position']
+            with self.assertRaises(KeyError): job['unknown'] = 1
+            with self.assertRaises(KeyError): job['_svg']
+            self.assertEqual(job.get('position', 0), 0)
+            job['position'] = 1
+            self.assertEqual(job.pop('position'), 1)
+            self.assertEqual(job.pop('position', None), None)
+            self.assertEqual(job.keys(), ['client', 'speed', 'status'])
+            self.assertFalse(hasattr(job, '__dict__'))
+        
+        def test_spooled_svg(self):
+            job = Job(client = 'abc', svg = '<svg/>')
+            self.assertIn('svg', job)
+            with tempfile.TemporaryDirectory() as folder:
+                path = os.path.join(folder, 'job.svg')
+                with open(path, 'w', encoding='utf-8') as f: f.write(job['svg'])
+                job.spooled(path)
+                self.assertTrue(job.is_spooled())
+                self.assertEqual(job['svg'], '<svg/>')
+                os.rename(path, path + '.moved')
+                job.spooled(path + '.moved')
+                self.assertEqual(job['svg'], '<svg/>')
+            self.assertNotIn('svg', Job(client = 'abc'))
+        
+        def test_output_svg(self):
+            job = Job()
+            self.assertNotIn('output_svg', job)
+            job['output_svg'] = '<svg>long</svg>'
+            job['output_svg'] = '<svg/>'
+            self.assertIn('output_svg', job)
+            self.assertEqual(job['output_svg'], '<svg/>')
+            del job['output_svg']
+            self.assertNotIn('output_svg', job)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
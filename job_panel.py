@@ -0,0 +1,238 @@
+import asyncio
+import math
+from textual.widgets import DataTable, Static, ProgressBar
+from textual.containers import Horizontal, Vertical
+from hotkey_button import HotkeyButton
+import spooler
+
+QUEUE_HEADERS = ['#', 'Client', 'Hash', 'Lines', 'Layers', 'Travel', 'Ink', 'Format', 'Speed', 'Duration', 'Optimized', 'Status']
+
+# Pen-up travel before and after optimizing, and the time saved (see spooler.optimize_job)
+def optimized_str(job):
+    if job.get('optimized') == None: return ''
+    report = job['optimized']
+    saved = report['time_before'] - report['time_after']
+    return f'{report["travel_blank_before"]/1000:.1f}→{report["travel_blank_after"]/1000:.1f}, -{math.floor(saved/60)}:{round(saved%60):02}'
+
+def job_to_row(job, idx):
+    return (idx, job['client'], job['hash'][:5], job['stats']['count'], job['stats']['layer_count'], int(job['stats']['travel'])/1000, int(job['stats']['travel_ink'])/1000, job['format'], job['speed'], f'{math.floor(job["time_estimate"]/60)}:{round(job["time_estimate"]%60):02}', optimized_str(job), job['status'])
+
+# Current job, status and commands of a plotter (see spooler.Plotter)
+# Only one panel can have hotkeys (they are bound app-wide), the buttons of the others need to be clicked
+class JobPanel(Vertical):
+    def __init__(self, plotter, hotkeys = True, **kwargs):
+        super().__init__(**kwargs)
+        self.plotter = plotter
+        self.hotkeys = hotkeys
+        self.prompt_future = None
+    
+    def hotkey(self, key):
+        return key if self.hotkeys else None
+    
+    def compose(self):
+        self.job_current = DataTable()
+        self.job_status = Static(spooler.status(self.plotter)['status_desc'])
+        self.job_progress = ProgressBar()
+        
+        yield self.job_current
+        yield self.job_status
+        yield self.job_progress
+        with Horizontal(classes='commands') as self.commands:
+            with Vertical() as self.commands_1:
+                yield (b_pos := HotkeyButton(label='Plot', id="pos"))
+            with Vertical() as self.commands_2:
+                yield (b_align := HotkeyButton(self.hotkey('a'), 'Align', label='Align', id='align'))
+                yield (b_cycle := HotkeyButton(self.hotkey('c'), 'Cycle', label='Cycle', id='cycle'))
+                yield (b_home := HotkeyButton(self.hotkey('h'), 'Home', label='Home', id='home'))
+            with Vertical() as self.commands_3:
+                yield (b_plus := HotkeyButton(label='+10', id='plus'))
+                yield (b_minus := HotkeyButton(label='-10', id='minus'))
+            with Vertical() as self.commands_4:
+                yield (b_preview := HotkeyButton(self.hotkey('v'), 'Preview', label='Preview', id='preview'))
+            with Vertical() as self.commands_5:
+                yield (b_neg := HotkeyButton(label='Cancel', id='neg'))
+        self.b_pos, self.b_neg, self.b_align, self.b_cycle, self.b_home = b_pos, b_neg, b_align, b_cycle, b_home
+        self.b_plus, self.b_minus, self.b_preview = b_plus, b_minus, b_preview
+    
+    def on_mount(self):
+        self.border_title = 'Job' if len(spooler.plotters()) == 1 else self.plotter.name
+        self.styles.border = ('solid', 'white')
+        self.styles.height = 22
+        
+        self.job_current.styles.height = 3
+        self.job_current.add_columns(*QUEUE_HEADERS)
+        self.job_current.cursor_type = 'none'
+        self.job_status.styles.margin = 1
+        self.job_progress.styles.margin = 1
+        self.job_progress.styles.width = '100%'
+        self.job_progress.query_one('#bar').styles.width = '1fr'
+        self.job_progress.styles.display = 'none'
+        
+        self.commands.styles.margin = (3, 0, 0, 0)
+        
+        for button in self.commands.query('Button'):
+            button.styles.width = '100%'
+            button.styles.margin = (0, 1);
+        
+        for col in self.commands.query('Vertical'):
+            col.styles.align_horizontal = 'center'
+            # col.styles.border = ('vkey', 'white')
+        
+        self.commands_2.styles.width = '0.5625fr'
+        for button in self.commands_2.query('Button'):
+            button.styles.min_width = 9
+        
+        self.commands_3.styles.width = '0.3125fr'
+        for button in self.commands_3.query('Button'):
+            button.styles.min_width = 5
+        
+        self.commands_4.styles.width = '0.6875fr'
+        for button in self.commands_4.query('Button'):
+            button.styles.min_width = 11
+        
+        for button in self.commands.query('Button'): button.disabled = True
+    
+    def on_button_pressed(self, event):
+        event.stop()
+        id = event.button.id
+        if id == 'preview':
+            self.app.preview_job( self.plotter.job )
+            return
+        if id == 'plus':
+            self.app.adjust_job_speed( self.plotter.job, 10 )
+            return
+        if id == 'minus':
+            self.app.adjust_job_speed( self.plotter.job, -10 )
+            return
+        if id == 'neg' and self.plotter.status == 'plotting':
+            print(f'[yellow]Interrupting {self.plotter.name}...')
+            spooler.request_plot_pause(self.plotter)
+            return
+        
+        if self.prompt_future != None and not self.prompt_future.done():
+            if id == None and event.button.hotkey_description:
+                id = str(event.button.hotkey_description).lower()
+            if id == None and event.button.label:
+                id = str(event.button.label).lower()
+            
+            self.prompt_future.set_result({
+                'id': id, # use button id, hotkey description (lowercase), or button label (lowercase)
+                'button': event.button
+            })
+    
+    def update_current_job(self):
+        job = self.plotter.job
+        self.job_current.clear()
+        if job != None:
+            self.job_current.add_row( *job_to_row(job, 1), key=job['client'] )
+    
+    def cancel_prompt_ui(self):
+        if self.prompt_future != None and not self.prompt_future.done():
+            self.prompt_future.set_result(False)
+    
+    # This not a coroutine (no async). It returns a future, which can be awaited from coroutines
+    def prompt_ui(self, variant, message = ''):
+        # print('PROMPT', variant)
+        
+        if len(message) > 0: message = ' – ' + message
+        self.job_status.update(spooler.status(self.plotter)['status_desc'] + message)
+        self.update_current_job()
+        
+        b_pos, b_neg, b_align, b_cycle, b_home = self.b_pos, self.b_neg, self.b_align, self.b_cycle, self.b_home
+        b_plus, b_minus, b_preview = self.b_plus, self.b_minus, self.b_preview
+        
+        match variant:
+            case 'setup':
+                b_pos.variant = 'default'
+                b_pos.disabled = True
+                
+                b_neg.update_hotkey(self.hotkey('d'), 'Done')
+                b_neg.variant = 'success'
+                b_neg.disabled = False
+                
+                b_align.disabled = False
+                b_cycle.disabled = False
+                b_home.disabled = True
+                b_plus.disabled = True
+                b_minus.disabled = True
+                b_preview.disabled = True
+            case 'waiting':
+                b_pos.disabled = True
+                b_neg.disabled = True
+                
+                b_align.disabled = False
+                b_cycle.disabled = False
+                b_home.disabled = True
+                b_plus.disabled = True
+                b_minus.disabled = True
+                b_preview.disabled = True
+            case 'start_plot':
+                b_pos.update_hotkey(self.hotkey('p'), 'Plot')
+                b_pos.variant = 'success'
+                b_pos.disabled = False
+                
+                b_neg.update_hotkey(self.hotkey('escape'), 'Cancel')
+                b_neg.variant = 'error'
+                b_neg.disabled = False
+                
+                b_align.disabled = False
+                b_cycle.disabled = False
+                b_home.disabled = True
+                b_plus.disabled = False
+                b_minus.disabled = False
+                b_preview.disabled = False
+            case 'plotting':
+                b_pos.disabled = True
+                
+                b_neg.update_hotkey(self.hotkey('escape'), 'Pause')
+                b_neg.variant = 'warning'
+                b_neg.disabled = False
+                
+                b_align.disabled = True
+                b_cycle.disabled = True
+                b_home.disabled = True
+                b_plus.disabled = True
+                b_minus.disabled = True
+                b_preview.disabled = False
+            case 'repeat_plot':
+                b_pos.update_hotkey(self.hotkey('r'), 'Repeat')
+                b_pos.variant = 'primary'
+                b_pos.disabled = False
+                
+                b_neg.update_hotkey(self.hotkey('d'), 'Done')
+                b_neg.variant = 'success'
+                b_neg.disabled = False
+                
+                b_align.disabled = False
+                b_cycle.disabled = False
+                b_home.disabled = True
+                b_plus.disabled = False
+                b_minus.disabled = False
+                b_preview.disabled = False
+            case 'resume_plot':
+                b_pos.update_hotkey(self.hotkey('p'), 'Continue')
+                b_pos.variant = 'primary'
+                b_pos.disabled = False
+                
+                b_neg.update_hotkey(self.hotkey('d'), 'Done')
+                b_neg.variant = 'warning'
+                b_neg.disabled = False
+                
+                b_align.disabled = False
+                b_cycle.disabled = False
+                b_home.disabled = False
+                b_plus.disabled = True
+                b_minus.disabled = True
+                b_preview.disabled = False
+            case _:
+                raise ValueError('Invalid prompt variant')
+        
+        # return a future that eventually resolves to the result
+        # reuse the future if it isn't done. allows for updating the prompt
+        if self.prompt_future == None or self.prompt_future.done():
+            loop = asyncio.get_running_loop()
+            self.prompt_future = loop.create_future()
+        
+        if variant == 'plotting': self.prompt_future.set_result(True)
+        
+        return self.prompt_future
@@ -0,0 +1,326 @@
+import os
+import json
+
+# Order and state of the waiting jobs, as an append-only journal next to their spool files
+# Spool files of waiting jobs have stable names (see spooler.waiting_name), so moving or canceling a job
+# doesn't rename the files of all jobs after it. Instead each change appends one record (a json line):
+#   { "op": "add", "name": ..., "state": ... }        added at the end (if it isn't in the journal yet)
+#   { "op": "move", "name": ..., "before": ... }      moved before another job (before None: to the end)
+#   { "op": "remove", "name": ... }                   finished, canceled or failed
+#   { "op": "state", "name": ..., "state": ... }      changed fields of the job's state (None: removed)
+# The state of a job is what the spooler needs to pick up where it left off after a restart, without simulating
+# the job again, e.g. when it was received, its speed, time estimate, status and plot progress (see spooler.resume_queue_from_disk)
+# The journal keeps the order in memory as a linked list, so reading it back is O(number of records)
+# When there are many more records than jobs, the journal is compacted: rewritten as a snapshot with one add
+# (with the full state) per job. A partly written last record (e.g. after a crash) is ignored
+
+class Journal:
+    def __init__(self, path, fsync = False, compact_min = 1000):
+        self.path = path
+        self.fsync = fsync # sync after each record (safer on power loss, but slower)
+        self.compact_min = compact_min # min. number of records before compacting
+        self.file = None
+        self.loaded = False
+        self.next = {} # name -> next name (None: last)
+        self.prev = {} # name -> previous name (None: first)
+        self.first = None
+        self.last = None
+        self.states = {} # name -> dict
+        self.records = 0 # records in the file
+        self.partial = False # the last line of the file is incomplete
+    
+    def __len__(self):
+        self._load()
+        return len(self.next)
+    
+    def __contains__(self, name):
+        self._load()
+        return name in self.next
+    
+    # names in order
+    def order(self):
+        self._load()
+        out = []
+        name = self.first
+        while name != None:
+            out.append(name)
+            name = self.next[name]
+        return out
+    
+    # state of a job (a copy), empty if there is none
+    def state(self, name):
+        self._load()
+        return dict(self.states.get(name, {}))
+    
+    def status(self, name):
+        return self.state(name).get('status')
+    
+    # Add a job at the end, with the given state. Jobs that are in the journal already keep their place,
+    # their state is updated
+    def add(self, name, **state):
+        self._load()
+        if name in self.next:
+            self.update(name, **state)
+            return
+        self._apply({ 'op': 'add', 'name': name, 'state': state })
+    
+    def move(self, name, before = None):
+        self._load()
+        if name not in self.next or name == before: return
+        if before not in self.next: before = None
+        if self.next[name] == before and (before != None or self.last == name): return # already there
+        self._apply({ 'op': 'move', 'name': name, 'before': before })
+    
+    def remove(self, name):
+        self._load()
+        if name not in self.next: return
+        self._apply({ 'op': 'remove', 'name': name })
+    
+    # Change fields of the state of a job (None: remove the field), only fields that differ are written
+    def update(self, name, **state):
+        self._load()
+        if name not in self.next: return
+        current = self.states.get(name, {})
+        changed = { key: value for key, value in state.items() if current.get(key) != value }
+        if changed: self._apply({ 'op': 'state', 'name': name, 'state': changed })
+    
+    def set_status(self, name, status):
+        self.update(name, status = status)
+    
+    # Keep only the given names (e.g. the spool files that exist), and compact the journal
+    def retain(self, names):
+        self._load()
+        names = set(names)
+        for name in [ x for x in self.next if x not in names ]: self._unlink(name)
+        self.compact()
+    
+    # Rewrite the journal with one record per job (a snapshot of the order and states)
+    def compact(self):
+        self._load()
+        self.close()
+        lines = [ json.dumps({ 'op': 'add', 'name': name, 'state': self.states.get(name, {}) }) for name in self.order() ]
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(''.join( line + '\n' for line in lines ))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.records = len(lines)
+        self.partial = False
+    
+    def close(self):
+        if self.file != None: self.file.close()
+        self.file = None
+    
+    def _load(self):
+        if self.loaded: return
+        self.loaded = True
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f: lines = f.readlines()
+        except FileNotFoundError:
+            return
+        self.partial = len(lines) > 0 and not lines[-1].endswith('\n')
+        for line in lines:
+            try:
+                record = json.loads(line)
+                self._replay(record)
+            except (ValueError, KeyError, TypeError):
+                continue # partly written
+            self.records += 1
+    
+    def _apply(self, record):
+        self._replay(record)
+        self._write(record)
+        if self.records > max(self.compact_min, 4 * len(self.next)): self.compact()
+    
+    def _write(self, record):
+        if self.file == None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+            self.file = open(self.path, 'a', encoding='utf-8')
+        if self.partial: self.file.write('\n') # don't continue a partly written record
+        self.partial = False
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        if self.fsync: os.fsync(self.file.fileno())
+        self.records += 1
+    
+    def _replay(self, record):
+        op, name = record['op'], record['name']
+        if op == 'add':
+            if name not in self.next:
+                self._link(name, None)
+                self._set_state(name, record.get('state', {}))
+        elif op == 'move':
+            if name not in self.next: return
+            before = record.get('before')
+            self._unlink(name, keep_state = True)
+            self._link(name, before if before in self.next else None)
+        elif op == 'remove':
+            if name in self.next: self._unlink(name)
+        elif op == 'state':
+            if name in self.next: self._set_state(name, record['state'])
+        elif op == 'status': # written by earlier versions
+            if name in self.next: self._set_state(name, { 'status': record['status'] })
+        else:
+            raise ValueError(f'Unknown journal record: {op}')
+    
+    def _set_state(self, name, changed):
+        state = self.states.setdefault(name, {})
+        for key, value in changed.items():
+            if value == None: state.pop(key, None)
+            else: state[key] = value
+        if not state: del self.states[name]
+    
+    # insert before another name (None: at the end)
+    def _link(self, name, before):
+        prev = self.prev[before] if before != None else self.last
+        self.prev[name], self.next[name] = prev, before
+        if prev != None: self.next[prev] = name
+        else: self.first = name
+        if before != None: self.prev[before] = name
+        else: self.last = name
+    
+    def _unlink(self, name, keep_state = False):
+        prev, next = self.prev.pop(name), self.next.pop(name)
+        if prev != None: self.next[prev] = next
+        else: self.first = next
+        if next != None: self.prev[next] = prev
+        else: self.last = prev
+        if not keep_state: self.states.pop(name, None)
+
+
+# Cost of moving a job to the top of a queue of n waiting jobs: renaming all spool files (with positions in their names),
+# or appending to the journal
+def benchmark(n = 1000, moves = 100):
+    import random
+    import tempfile
+    import time
+    rng = random.Random(0)
+    
+    with tempfile.TemporaryDirectory() as folder:
+        names = [ f'{i:040x}_[client-{i}].svg' for i in range(n) ]
+        for name in names:
+            with open(os.path.join(folder, name), 'w') as f: f.write('<svg></svg>')
+        
+        order = list(names)
+        paths = { name: os.path.join(folder, name) for name in names }
+        start = time.perf_counter()
+        for i in range(moves):
+            order.insert(0, order.pop(rng.randrange(n)))
+            for pos, name in enumerate(order):
+                path = os.path.join(folder, f'{(pos + 1):03}_{name}')
+                if paths[name] != path: os.replace(paths[name], path)
+                paths[name] = path
+        t_rename = time.perf_counter() - start
+        
+        journal = Journal(os.path.join(folder, 'queue.journal'))
+        for name in names: journal.add(name, speed = 100, time_estimate = 600.0, time_estimate_source = 'simulation', layers = 1, layer_estimates = [600.0])
+        start = time.perf_counter()
+        for i in range(moves): journal.move(names[rng.randrange(n)], journal.first)
+        t_journal = time.perf_counter() - start
+        journal.close()
+        
+        start = time.perf_counter()
+        count = len(Journal(journal.path).order())
+        t_load = time.perf_counter() - start
+        
+        print(f'{n} jobs, move to top: rename files {t_rename*1000/moves:.2f} ms, journal {t_journal*1000/moves:.3f} ms')
+        print(f'reading the journal back: {count} jobs, {journal.records} records, {t_load*1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    import tempfile
+    
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            self.path = os.path.join(self.tmp.name, 'waiting', 'queue.journal')
+        
+        def tearDown(self):
+            self.tmp.cleanup()
+        
+        def reopen(self, journal):
+            journal.close()
+            return Journal(self.path, compact_min = journal.compact_min)
+        
+        def test_order(self):
+            journal = Journal(self.path)
+            for name in 'abcd': journal.add(name)
+            journal.add('a') # already there
+            journal.move('d', 'a')
+            journal.move('a') # to the end
+            journal.remove('b')
+            journal.move('x', 'a') # not in the journal
+            self.assertEqual(journal.order(), ['d', 'c', 'a'])
+            self.assertEqual(self.reopen(journal).order(), ['d', 'c', 'a'])
+            self.assertEqual(journal.records, 7)
+        
+        def test_status(self):
+            journal = Journal(self.path)
+            for name in 'ab': journal.add(name)
+            journal.set_status('a', 'plotting')
+            journal.move('a', None)
+            self.assertEqual(self.reopen(journal).status('a'), 'plotting')
+            journal.remove('a')
+            journal.add('a')
+            self.assertEqual(self.reopen(journal).status('a'), None)
+        
+        def test_state(self):
+            journal = Journal(self.path)
+            journal.add('a', speed = 100, time_estimate = 60)
+            journal.add('a', speed = 50) # already there, only the speed changes
+            journal.update('a', speed = 50, layer = 1)
+            journal.update('x', speed = 10) # not in the journal
+            self.assertEqual(journal.records, 3)
+            journal.update('a', layer = None)
+            journal.move('a', None)
+            self.assertEqual(self.reopen(journal).state('a'), { 'speed': 50, 'time_estimate': 60 })
+            journal.state('a')['speed'] = 10 # a copy
+            self.assertEqual(journal.state('a')['speed'], 50)
+            self.assertEqual(journal.state('x'), {})
+        
+        def test_old_status_records(self):
+            os.makedirs(os.path.dirname(self.path))
+            with open(self.path, 'w') as f: f.write('{"op": "add", "name": "a"}\n{"op": "status", "name": "a", "status": "paused"}\n')
+            self.assertEqual(Journal(self.path).status('a'), 'paused')
+        
+        def test_compact(self):
+            journal = Journal(self.path, compact_min = 10)
+            for name in 'abc': journal.add(name)
+            for i in range(20):
+                journal.move('c', 'a')
+                journal.move('a', 'c')
+            self.assertLessEqual(journal.records, 12)
+            journal.set_status('b', 'plotting')
+            journal = self.reopen(journal)
+            self.assertEqual(journal.order(), ['a', 'c', 'b'])
+            self.assertEqual(journal.status('b'), 'plotting')
+            journal.compact()
+            self.assertEqual(self.reopen(journal).status('b'), 'plotting')
+            journal.retain(['a', 'b'])
+            self.assertEqual(self.reopen(journal).order(), ['a', 'b'])
+            self.assertEqual(journal.records, 2)
+        
+        def test_partial_record(self):
+            journal = Journal(self.path)
+            for name in 'ab': journal.add(name)
+            journal.close()
+            with open(self.path, 'a') as f: f.write('{"op": "remove", "na')
+            journal = Journal(self.path)
+            self.assertEqual(journal.order(), ['a', 'b'])
+            self.assertEqual(len(journal), 2)
+            self.assertIn('a', journal)
+            journal.remove('a')
+            self.assertEqual(self.reopen(journal).order(), ['b'])
+        
+        def test_missing(self):
+            self.assertEqual(Journal(self.path).order(), [])
+            self.assertFalse(os.path.exists(self.path)) # only created when writing
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
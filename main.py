@@ -19,33 +19,43 @@ PING_INTERVAL = 10
 PING_TIMEOUT  = 5
 SHOW_CONNECTION_EVENTS = 0 # Print when clients connect/disconnect
 MAX_MESSAGE_SIZE_MB = 5 # in MB (Default in websockets lib is 2)
-
-QUEUE_HEADERS = ['#', 'Client', 'Hash', 'Lines', 'Layers', 'Travel', 'Ink', 'Format', 'Speed', 'Duration', 'Status']
+INGEST_WORKERS = 2 # number of worker processes for decoding and validating large messages
+INGEST_INLINE_SIZE = 64 * 1024 # json messages smaller than this (in bytes) are decoded directly on the event loop
+INGEST_TIMEOUT = 10 # seconds
+UPLOAD_MAX_SIZE_MB = 200 # max. size of chunked uploads (plot_begin/plot_chunk/plot_end), in MB
+UPLOAD_EXPIRY = 24 # hours after which unfinished uploads are removed
+BROADCAST_WINDOW = 0.05 # seconds, queue updates within this time are sent to clients as one message (see broadcast.py)
 
 import textual
 from textual import on
 from textual.events import Key
 from textual.app import App as TextualApp
-from textual.widgets import Button, DataTable, RichLog, Footer, Header, Static, ProgressBar, Rule
+from textual.widgets import DataTable, RichLog, Footer, Header, Rule
 from textual.widgets.data_table import RowDoesNotExist
 from textual.containers import Horizontal, Vertical
-from hotkey_button import HotkeyButton
+from job_panel import JobPanel, QUEUE_HEADERS, job_to_row
 from header_timer import HeaderTimer
 
 import asyncio
 import websockets
 import spooler
 import json
-import math
 import subprocess
 import porkbun
-import functools
+import ingest
+import sim_pool
+import uploads
+import protocol
+import broadcast
 
 
 app = None
 ssl_context = None
 num_clients = 0
 clients = []
+ingest_pool = None
+upload_manager = None
+hub = broadcast.Hub(clients, BROADCAST_WINDOW)
 
 
 # Status simply shows up in the header
@@ -105,44 +115,107 @@ async def send_msg(msg, ws):
 async def on_queue_size(size):
     app.update_job_queue()
     app.update_header()
-    cbs = []
-    for ws in clients:
-        cbs.append( send_msg({'type': 'queue_length', 'length': size}, ws) )
-    await asyncio.gather(*cbs)
+    hub.publish('queue_length', length = size) # sent to all clients once per burst of changes
 
 async def send_current_queue_size(ws):
     await send_msg( {'type': 'queue_length', 'length': spooler.num_jobs()}, ws )
 
+# Decode and validate a message (see ingest.py)
+# Large messages are handled by a worker process, so the event loop stays responsive during uploads. So are all binary
+# frames (see protocol.py), however small: their payload is compressed and might expand to MAX_CONTENT_SIZE
+# Raises ValueError for any message that can't be decoded, so the client gets an error and the connection stays open
+async def decode_message(message):
+    if (len(message) < INGEST_INLINE_SIZE and not protocol.is_frame(message)) or protocol.is_chunk(message):
+        try:
+            return ingest.decode(message, spooler.MIN_SPEED, spooler.DIGEST_ALGORITHM)
+        except ValueError:
+            raise
+        except Exception as e:
+            print(f'Error decoding message: {e!r}')
+            raise ValueError('Invalid message') from None
+    return await run_ingest(ingest.decode, message, spooler.MIN_SPEED, spooler.DIGEST_ALGORITHM)
+
+async def run_ingest(fn, *args):
+    try:
+        return await ingest_pool.run(fn, *args, timeout = INGEST_TIMEOUT)
+    except ValueError:
+        raise
+    except (TimeoutError, EOFError, OSError):
+        raise ValueError('Cannot process message, please try again')
+    except Exception as e: # raised in the worker
+        print(f'Error decoding message: {e!r}')
+        raise ValueError('Invalid message') from None
+
+# Chunked uploads (see uploads.py)
+# Returns a plot message once the upload is finished, otherwise None
+async def handle_upload(msg, ws):
+    if msg['type'] == 'plot_begin':
+        upload = await asyncio.to_thread(upload_manager.begin, msg['upload_id'], msg['client'], msg['upload_size'])
+        upload.meta = msg
+    else:
+        upload = upload_manager.get(msg['upload_id'])
+    
+    if msg['type'] == 'plot_chunk':
+        await asyncio.to_thread(upload.write, msg['offset'], msg['data'])
+    elif msg['type'] == 'plot_end':
+        try:
+            upload_digest = await asyncio.to_thread(upload.finish)
+            return await run_ingest(ingest.decode_upload, upload.path, upload.meta, upload_digest, spooler.MIN_SPEED, spooler.DIGEST_ALGORITHM)
+        except ValueError:
+            upload_manager.discard(upload.id)
+            raise
+    await send_msg( {'type': 'upload_offset', 'upload_id': upload.id, 'offset': upload.offset}, ws )
+
 async def handle_message(message, ws):
     async def on_queue_position(pos, job):
-        await send_msg( {'type': 'queue_position', 'position': pos}, ws )
+        await send_msg( {'type': 'queue_position', 'position': pos, 'eta': job['eta']}, ws ) # eta: expected seconds until the job starts
     async def on_done(job):
         await send_msg( {'type': 'job_done'}, ws )
     async def on_cancel(job):
         await send_msg( {'type': 'job_canceled'}, ws )
     async def on_error(msg, job):
         await send_msg( {'type': 'error', 'msg': msg}, ws )
+    async def on_validating(ahead, job):
+        await send_msg( {'type': 'validating', 'ahead': ahead}, ws )
     
     try:
-        msg = json.loads(message)
-    except JSONDecodeError:
+        msg = await decode_message(message)
+        if msg['type'] in ['plot_begin', 'plot_chunk', 'plot_end']:
+            msg = await handle_upload(msg, ws)
+            if msg == None: return
+    except ValueError as e:
+        await send_msg( {'type': 'error', 'msg': str(e)}, ws )
         return
     
     if msg['type'] == 'echo':
         await ws.send(message)
     elif msg['type'] == 'plot':
         qsize = spooler.num_jobs()
-        result = await spooler.enqueue(msg, on_queue_position, on_done, on_cancel, on_error)
+        result = await spooler.enqueue(msg, on_queue_position, on_done, on_cancel, on_error, on_validating)
+        if 'upload_id' in msg: await asyncio.to_thread(upload_manager.discard, msg['upload_id']) # the part file has been moved, or isn't needed anymore
         if result: print_status()
     elif msg['type'] == 'cancel':
         result = await spooler.cancel(msg['client'])
         if result: print_status()
+    elif msg['type'] == 'reprint': # only jobs of the same client, the latest if there are several
+        entries = await asyncio.to_thread(spooler.find_archived, hash = msg['hash'], client = msg['client'])
+        if len(entries) == 0:
+            await on_error('Cannot reprint job, it is not in the archive!', None)
+            return
+        entry = max(entries, key = lambda x: x['date'])
+        result = await spooler.reprint(entry, on_queue_position, on_done, on_cancel, on_error, on_validating)
+        if result: print_status()
 
 async def run_server(app):
     async with websockets.serve(handle_connection, BIND_IP, PORT, ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT, ssl=ssl_context, max_size=MAX_MESSAGE_SIZE_MB*(2**20)):
         print(f'Server running on {"ws" if ssl_context == None else "wss"}://{BIND_IP}:{PORT}')
         print()
         spooler.set_queue_size_cb(on_queue_size)
+        global ingest_pool
+        ingest_pool = sim_pool.Pool(INGEST_WORKERS, preload = ['ingest'])
+        ingest_pool.start()
+        global upload_manager
+        upload_manager = uploads.Uploads(spooler.UPLOAD_FOLDER, max_size = UPLOAD_MAX_SIZE_MB * 2**20, expiry = UPLOAD_EXPIRY * 60 * 60, algorithm = spooler.DIGEST_ALGORITHM)
         # await asyncio.Future() # run forever
         await spooler.start(app) # run forever
 
@@ -151,8 +224,6 @@ class MyDataTable(DataTable):
         self.app.on_queue_click(event)
 
 class App(TextualApp):
-    prompt_future = None
-    
     def compose(self):
         global header, queue, log, footer
         header = HeaderTimer(icon = '🖨️', show_clock = True, time_format = '%H:%M')
@@ -162,38 +233,16 @@ class App(TextualApp):
         log = RichLog(markup=True)
         footer = Footer(id="footer", show_command_palette=True)
         
-        global job_current, job_status,job_progress
-        job_current = DataTable()
-        job_status = Static(spooler.status()['status_desc'])
-        job_progress = ProgressBar()
-        
-        global col_left, col_right, job, commands, commands_1, commands_2, commands_3, commands_4, commands_5
-        global b_pos, b_neg, b_align, b_cycle, b_home, b_plus, b_minus, b_preview
+        global col_left, col_right, plotters
         
         yield header
         # yield HotkeyButton('p', 'Press')
         # yield HotkeyButton('x', 'Something')
         with Horizontal():
             with Vertical() as col_left:
-                with Vertical() as job:
-                    yield job_current
-                    yield job_status
-                    yield job_progress
-                    # yield Rule()
-                    with Horizontal(id='commands') as commands:
-                        with Vertical() as commands_1:
-                            yield (b_pos := HotkeyButton(label='Plot', id="pos"))
-                        with Vertical() as commands_2:
-                            yield (b_align := HotkeyButton('a', 'Align', label='Align', id='align'))
-                            yield (b_cycle := HotkeyButton('c', 'Cycle', label='Cycle', id='cycle'))
-                            yield (b_home := HotkeyButton('h', 'Home', label='Home', id='home'))
-                        with Vertical() as commands_3:
-                            yield (b_plus := HotkeyButton(label='+10', id='plus'))
-                            yield (b_minus := HotkeyButton(label='-10', id='minus'))
-                        with Vertical() as commands_4:
-                            yield (b_preview := HotkeyButton('v', 'Preview', label='Preview', id='preview'))
-                        with Vertical() as commands_5:
-                            yield (b_neg := HotkeyButton(label='Cancel', id='neg'))
+                with Horizontal() as plotters:
+                    self.panels = [ JobPanel(plotter, hotkeys = plotter.index == 0) for plotter in spooler.plotters() ]
+                    for panel in self.panels: yield panel
                 yield queue
             with Vertical() as col_right:
                 yield log
@@ -210,40 +259,7 @@ class App(TextualApp):
         log.border_title = 'Log'
         log.styles.border = ('solid', 'white')
         
-        job.border_title = 'Job'
-        job.styles.border = ('solid', 'white')
-        job.styles.height = 22
-        
-        job_current.styles.height = 3
-        job_current.add_columns(*QUEUE_HEADERS)
-        job_current.cursor_type = 'none'
-        job_status.styles.margin = 1
-        job_progress.styles.margin = 1
-        job_progress.styles.width = '100%'
-        job_progress.query_one('#bar').styles.width = '1fr'
-        job_progress.styles.display = 'none'
-        
-        commands.styles.margin = (3, 0, 0, 0)
-        
-        for button in commands.query('Button'):
-            button.styles.width = '100%'
-            button.styles.margin = (0, 1);
-            
-        for col in commands.query('Vertical'):
-            col.styles.align_horizontal = 'center'
-            # col.styles.border = ('vkey', 'white')
-            
-        commands_2.styles.width = '0.5625fr'
-        for button in commands_2.query('Button'):
-            button.styles.min_width = 9
-        
-        commands_3.styles.width = '0.3125fr'
-        for button in commands_3.query('Button'):
-            button.styles.min_width = 5
-        
-        commands_4.styles.width = '0.6875fr'
-        for button in commands_4.query('Button'):
-            button.styles.min_width = 11
+        plotters.styles.height = 22
         
         queue.border_title = 'Queue'
         queue.styles.border = ('solid', 'white')
@@ -255,15 +271,6 @@ class App(TextualApp):
         
         self.update_header()
         
-        b_pos.disabled = True
-        b_neg.disabled = True
-        b_align.disabled = True
-        b_cycle.disabled = True
-        b_home.disabled = True
-        b_plus.disabled = True
-        b_minus.disabled = True
-        b_preview.disabled = True
-        
         self.bind('t', 'enqueue_test_job', description = 'Test job')
         self.bind('o', 'open_svg_folder', description = 'Open SVG folder')
         
@@ -313,8 +320,7 @@ class App(TextualApp):
         status = spooler.status()
         self.title = status['status_desc']
         self.sub_title = f'{num_clients} Clients – {spooler.num_jobs()} Jobs'
-        total_secs = functools.reduce(lambda acc, x: acc + x['time_estimate'], spooler.jobs(), 0)
-        header.time_seconds = total_secs
+        header.time_seconds = spooler.total_time()
     
     def bind(self, *args, **kwargs):
         super().bind(*args, **kwargs)
@@ -351,36 +357,11 @@ class App(TextualApp):
             speed = int(speed / 10) * 10
             speed = max( min(speed, 100), 10 )
             print(f'Adjust job speed \\[{job["client"]}]: {speed}')
-            job['speed'] = speed
-            if (job == spooler.current_job()): self.update_current_job()
-    
-    @on(Button.Pressed, '#commands Button')
-    def on_button(self, event):
-        id = event.button.id
-        if id == 'preview':
-            self.preview_job( spooler.current_job() )
-            return
-        if id == 'plus':
-            self.adjust_job_speed( spooler.current_job(), 10 )
-            return
-        if id == 'minus':
-            self.adjust_job_speed( spooler.current_job(), -10 )
-            return
-        if id == 'neg' and spooler.status()['status'] == 'plotting':
-            print('[yellow]Interrupting...')
-            spooler.request_plot_pause()
-            return
-        
-        if self.prompt_future != None and not self.prompt_future.done():
-            if id == None and event.button.hotkey_description:
-                id = str(event.button.hotkey_description).lower()
-            if id == None and event.button.label:
-                id = str(event.button.label).lower()
-            
-            self.prompt_future.set_result({
-                'id': id, # use button id, hotkey description (lowercase), or button label (lowercase)
-                'button': event.button
-            })
+            plotter = spooler.job_plotter(job)
+            async def set_speed():
+                await spooler.set_speed(job, speed) # estimates the job again
+                if plotter != None: self.panels[plotter.index].update_current_job()
+            asyncio.create_task(set_speed())
     
     @on(Key)
     async def on_queue_hotkey(self, event):
@@ -395,8 +376,9 @@ class App(TextualApp):
             
             if (event.key == 'backspace'):
                 # if this is the current job, and we haven't started, cancel the prompt to start
-                if spooler.current_client() == client and spooler.status()['status'] == 'confirm_plot':
-                    self.cancel_prompt_ui()
+                plotter = spooler.job_plotter( spooler.job_by_client(client) )
+                if plotter != None and plotter.status == 'confirm_plot':
+                    self.cancel_prompt_ui(plotter)
                 # handle all other cases (even plots that are running)
                 else:
                     await spooler.cancel(client)
@@ -420,15 +402,6 @@ class App(TextualApp):
         if queue.row_count > 0:
             queue.show_cursor = True
     
-    def job_to_row(self, job, idx):
-        return (idx, job['client'], job['hash'][:5], job['stats']['count'], job['stats']['layer_count'], int(job['stats']['travel'])/1000, int(job['stats']['travel_ink'])/1000, job['format'], job['speed'], f'{math.floor(job["time_estimate"]/60)}:{round(job["time_estimate"]%60):02}', job['status'])
-        
-    def update_current_job(self):
-        job = spooler.current_job()
-        job_current.clear()
-        if job != None:
-            job_current.add_row( *self.job_to_row(job, 1), key=job['client'] )
-    
     def update_job_queue(self):
         if queue.row_count == 0: queue.show_cursor = False
         # remember selected client
@@ -439,7 +412,7 @@ class App(TextualApp):
         
         queue.clear()
         for idx, job in enumerate(spooler.jobs()):
-            queue.add_row( *self.job_to_row(job, idx+1), key=job['client'] )
+            queue.add_row( *job_to_row(job, idx+1), key=job['client'] )
         
         # recall client (if possible)
         if client:
@@ -450,113 +423,12 @@ class App(TextualApp):
                 # print('row does not exist')
                 queue.show_cursor = False
     
-    def cancel_prompt_ui(self):
-        if self.prompt_future != None and not self.prompt_future.done():
-            self.prompt_future.set_result(False)
-        
+    def cancel_prompt_ui(self, plotter):
+        self.panels[plotter.index].cancel_prompt_ui()
+    
     # This not a coroutine (no async). It returns a future, which can be awaited from coroutines
-    def prompt_ui(self, variant, message = ''):
-        # print('PROMPT', variant)
-        
-        if len(message) > 0: message = ' – ' + message
-        job_status.update(spooler.status()['status_desc'] + message)
-        self.update_current_job()
-        
-        match variant:
-            case 'setup':
-                b_pos.variant = 'default'
-                b_pos.disabled = True
-                
-                b_neg.update_hotkey('d', 'Done')
-                b_neg.variant = 'success'
-                b_neg.disabled = False
-                
-                b_align.disabled = False
-                b_cycle.disabled = False
-                b_home.disabled = True
-                b_plus.disabled = True
-                b_minus.disabled = True
-                b_preview.disabled = True
-            case 'waiting':
-                b_pos.disabled = True
-                b_neg.disabled = True
-                
-                b_align.disabled = False
-                b_cycle.disabled = False
-                b_home.disabled = True
-                b_plus.disabled = True
-                b_minus.disabled = True
-                b_preview.disabled = True
-            case 'start_plot':
-                b_pos.update_hotkey('p', 'Plot')
-                b_pos.variant = 'success'
-                b_pos.disabled = False
-                
-                b_neg.update_hotkey('escape', 'Cancel')
-                b_neg.variant = 'error'
-                b_neg.disabled = False
-                
-                b_align.disabled = False
-                b_cycle.disabled = False
-                b_home.disabled = True
-                b_plus.disabled = False
-                b_minus.disabled = False
-                b_preview.disabled = False
-            case 'plotting':
-                b_pos.disabled = True
-                
-                b_neg.update_hotkey('escape', 'Pause')
-                b_neg.variant = 'warning'
-                b_neg.disabled = False
-                
-                b_align.disabled = True
-                b_cycle.disabled = True
-                b_home.disabled = True
-                b_plus.disabled = True
-                b_minus.disabled = True
-                b_preview.disabled = False
-            case 'repeat_plot':
-                b_pos.update_hotkey('r', 'Repeat')
-                b_pos.variant = 'primary'
-                b_pos.disabled = False
-                
-                b_neg.update_hotkey('d', 'Done')
-                b_neg.variant = 'success'
-                b_neg.disabled = False
-                
-                b_align.disabled = False
-                b_cycle.disabled = False
-                b_home.disabled = True
-                b_plus.disabled = False
-                b_minus.disabled = False
-                b_preview.disabled = False
-            case 'resume_plot':
-                b_pos.update_hotkey('p', 'Continue')
-                b_pos.variant = 'primary'
-                b_pos.disabled = False
-                
-                b_neg.update_hotkey('d', 'Done')
-                b_neg.variant = 'warning'
-                b_neg.disabled = False
-                
-                b_align.disabled = False
-                b_cycle.disabled = False
-                b_home.disabled = False
-                b_plus.disabled = True
-                b_minus.disabled = True
-                b_preview.disabled = False
-            case _:
-                raise ValueError('Invalid prompt variant')
-        
-        # return a future that eventually resolves to the result
-        # reuse the future if it isn't done. allows for updating the prompt
-        if self.prompt_future == None or self.prompt_future.done():
-            loop = asyncio.get_running_loop()
-            self.prompt_future = loop.create_future()
-        
-        if variant == 'plotting': self.prompt_future.set_result(True)
-        
-        return self.prompt_future
+    def prompt_ui(self, plotter, variant, message = ''):
+        return self.panels[plotter.index].prompt_ui(variant, message)
 
 
 
@@ -0,0 +1,246 @@
+import math
+import re
+import time
+import numpy as np
+
+import path
+import estimate
+
+# Pen-up travel optimization
+# Reorders the subpaths (strokes) of each path element, and reverses them if allowed, so the pen travels less
+# between them: nearest neighbour on a grid of stroke ends, refined with 2-opt
+# tg-plot writes one path element per layer, so strokes are reordered within layers. Path elements (and layers)
+# keep their order and attributes. Path data is rewritten with absolute coordinates (see path.encode_polylines),
+# paths with curves are left as they are
+
+_PATH_D = re.compile(r'(<path\b[^>]*?\sd=")([^"]*)(")')
+
+# Pen-up distance from start through all strokes, given the start (P) and end points (Q) of the strokes in order
+def travel(P, Q, start):
+    if len(P) == 0: return 0.0
+    frm = np.vstack(([start], Q[:-1]))
+    return float(np.sum(np.hypot(*(P - frm).T)))
+
+# Cells at chebyshev distance r from (cx, cy), within a grid of nx * ny cells
+def _ring(cx, cy, r, nx, ny):
+    if r == 0:
+        if 0 <= cx < nx and 0 <= cy < ny: yield (cx, cy)
+        return
+    x0, x1, y0, y1 = cx - r, cx + r, cy - r, cy + r
+    for x in range(max(x0, 0), min(x1, nx - 1) + 1):
+        if 0 <= y0 < ny: yield (x, y0)
+        if 0 <= y1 < ny: yield (x, y1)
+    for y in range(max(y0 + 1, 0), min(y1 - 1, ny - 1) + 1):
+        if 0 <= x0 < nx: yield (x0, y)
+        if 0 <= x1 < nx: yield (x1, y)
+
+# Greedy tour: always continue with the stroke with the nearest end
+# Stroke ends are kept in a grid with about one end per cell, the search widens ring by ring until the nearest end is found
+# Returns the order of the strokes and whether each one is plotted reversed
+def nearest_neighbour(P, Q, start, reverse = True):
+    n = len(P)
+    ends = np.vstack((P, Q)) if reverse else P
+    lo = ends.min(axis=0)
+    cell = max( float((ends.max(axis=0) - lo).max()) / max(math.sqrt(len(ends)), 1), 1e-9 )
+    cells = np.floor((ends - lo) / cell).astype(int)
+    nx, ny = (cells.max(axis=0) + 1).tolist()
+    grid = {}
+    for k, key in enumerate(map(tuple, cells.tolist())):
+        grid.setdefault(key, []).append(k)
+    coords = ends.tolist()
+    used = bytearray(n)
+    order = []
+    flipped = []
+    x, y = float(start[0]), float(start[1])
+    for step in range(n):
+        cx, cy = int((x - lo[0]) // cell), int((y - lo[1]) // cell)
+        r_max = max(cx, nx - 1 - cx, cy, ny - 1 - cy)
+        best, best_d = None, math.inf
+        r = 0
+        while True:
+            for key in _ring(cx, cy, r, nx, ny):
+                bucket = grid.get(key)
+                if not bucket: continue
+                live = [ k for k in bucket if not used[k % n] ]
+                if len(live) != len(bucket): grid[key] = live # drop used strokes
+                for k in live:
+                    ex, ey = coords[k]
+                    d = (ex - x)**2 + (ey - y)**2
+                    if d < best_d: best, best_d = k, d
+            # ends in the next ring are at least r cells away
+            if best != None and (best_d <= (r * cell)**2 or r >= r_max): break
+            r += 1
+        i = best % n
+        used[i] = 1
+        order.append(i)
+        flipped.append(best >= n)
+        x, y = coords[i] if best >= n else coords[i + n] if reverse else Q[i].tolist()
+    return np.array(order), np.array(flipped, dtype=bool)
+
+# 2-opt: reverse runs of strokes (each stroke reversed as well) while that shortens the pen-up travel
+# Runs are at most window strokes long. Stops after max_passes passes without improvement or at the deadline
+# Returns the order of the strokes and whether each one is plotted reversed
+def two_opt(P, Q, start, window = 1000, max_passes = 5, deadline = None):
+    n = len(P)
+    P, Q = P.copy(), Q.copy()
+    order = np.arange(n)
+    flipped = np.zeros(n, dtype=bool)
+    N = np.vstack((P[1:], [[0, 0]])) # start of the next stroke (see below for the last one)
+    L = np.hypot(*(Q - N).T) # pen-up travel to the next stroke
+    L[-1] = 0
+    start = np.asarray(start, dtype=float)
+    for p in range(max_passes):
+        improved = False
+        for i in range(n):
+            if deadline != None and time.perf_counter() > deadline: return order, flipped
+            prev = Q[i-1] if i > 0 else start
+            j = slice(i, min(i + window, n))
+            # reversing i..j: prev -> Q[j] and P[i] -> N[j], instead of prev -> P[i] and Q[j] -> N[j]
+            # after the last stroke there is no travel (the plotter returns home from wherever it is)
+            N[-1] = P[i]
+            delta = np.hypot(*(prev - Q[j]).T) + np.hypot(*(P[i] - N[j]).T) - L[j] - math.hypot(*(prev - P[i]))
+            k = int(np.argmin(delta))
+            if delta[k] >= -1e-9: continue
+            j = i + k + 1
+            P[i:j], Q[i:j] = Q[i:j][::-1].copy(), P[i:j][::-1].copy()
+            order[i:j] = order[i:j][::-1].copy()
+            flipped[i:j] = ~flipped[i:j][::-1]
+            lo = max(i - 1, 0)
+            N[lo:j] = P[lo+1:j+1] if j < n else np.vstack((P[lo+1:], [[0, 0]]))
+            L[lo:j] = np.hypot(*(Q[lo:j] - N[lo:j]).T)
+            L[-1] = 0
+            improved = True
+        if not improved: break
+    return order, flipped
+
+# Reorder strokes (each an (n, 2) array of points), starting at start
+# Returns the strokes in their new order and the end point. The strokes are returned unchanged if that's not shorter
+def optimize_lines(lines, start, reverse = True, window = 1000, deadline = None):
+    P = np.array([ line[0] for line in lines ])
+    Q = np.array([ line[-1] for line in lines ])
+    order, flipped = nearest_neighbour(P, Q, start, reverse)
+    P1 = np.where(flipped[:, None], Q[order], P[order])
+    Q1 = np.where(flipped[:, None], P[order], Q[order])
+    if reverse:
+        order2, flipped2 = two_opt(P1, Q1, start, window, deadline = deadline)
+        order, flipped = order[order2], flipped[order2] ^ flipped2
+        P1 = np.where(flipped[:, None], Q[order], P[order])
+        Q1 = np.where(flipped[:, None], P[order], Q[order])
+    if travel(P1, Q1, start) >= travel(P, Q, start): return lines, lines[-1][-1]
+    out = [ lines[i][::-1] if f else lines[i] for i, f in zip(order.tolist(), flipped.tolist()) ]
+    return out, out[-1][-1]
+
+# Reorder the strokes of all paths in an svg, starting from home (the top left corner of the page)
+# options: plot options for the estimate (see estimate.DEFAULT_OPTIONS)
+# Returns the optimized svg and a report with the pen-up travel (mm) and time estimate (s) before and after,
+# or the svg unchanged and None if the svg isn't supported by the estimator
+def optimize_svg(svg, reverse = True, window = 1000, time_limit = None, options = {}, precision = 3):
+    deadline = time.perf_counter() + time_limit if time_limit != None else None
+    try:
+        before = estimate.estimate(svg, options)
+        scale, ox, oy = estimate.page_transform(svg)
+    except Exception:
+        return svg, None
+    pos = np.array([ox, oy])
+    out = []
+    last = 0
+    for match in _PATH_D.finditer(svg):
+        try:
+            lines = [ np.frombuffer(line, dtype=float).reshape(-1, 2) for line in path.polylines(match.group(2)) ]
+        except ValueError:
+            continue
+        if len(lines) == 0: continue
+        if len(lines) == 1:
+            pos = lines[0][-1]
+            continue
+        optimized, pos = optimize_lines(lines, pos, reverse, window, deadline)
+        if optimized is lines: continue
+        out.append(svg[last:match.start(2)])
+        out.append(path.encode_polylines([ line.ravel().tolist() for line in optimized ], precision))
+        last = match.end(2)
+    out.append(svg[last:])
+    svg = ''.join(out)
+    after = estimate.estimate(svg, options)
+    return svg, {
+        'travel_blank_before': (before['distance_total'] - before['distance_pendown']) * 1000,
+        'travel_blank_after': (after['distance_total'] - after['distance_pendown']) * 1000,
+        'time_before': before['time_estimate'],
+        'time_after': after['time_estimate'],
+    }
+
+
+# Random strokes (generative art like), e.g. 5000 short lines scattered over an A3 sheet
+def random_svg(n = 5000, size = (420, 297), seed = 0):
+    rng = np.random.default_rng(seed)
+    a = rng.uniform([10, 10], [size[0] - 10, size[1] - 10], (n, 2))
+    b = a + rng.normal(0, 5, (n, 2))
+    d = path.encode_polylines(np.hstack((a, b)).tolist())
+    return f'<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="{size[0]}mm" height="{size[1]}mm" viewBox="0 0 {size[0]} {size[1]}"><g inkscape:groupmode="layer" inkscape:label="1"><path d="{d}" /></g></svg>'
+
+def benchmark():
+    for n in [500, 5000, 20000]:
+        svg = random_svg(n)
+        start = time.perf_counter()
+        out, report = optimize_svg(svg, time_limit = 10)
+        t = time.perf_counter() - start
+        print(f'{n:>6} strokes: pen-up travel {report["travel_blank_before"]/1000:7.1f} m -> {report["travel_blank_after"]/1000:5.1f} m, ' +
+            f'time {report["time_before"]/60:6.1f} -> {report["time_after"]/60:5.1f} min ({t:.2f} s)')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    
+    def svg_doc(*paths):
+        return '<svg xmlns="http://www.w3.org/2000/svg" width="100mm" height="100mm" viewBox="0 0 100 100">' + \
+            ''.join( f'<path d="{d}" />' for d in paths ) + '</svg>'
+    
+    def strokes(svg):
+        return [ [ list(line) for line in path.polylines(m.group(2)) ] for m in _PATH_D.finditer(svg) ]
+    
+    class Test(unittest.TestCase):
+        def test_nearest_neighbour(self):
+            P = np.array([ [90, 0], [10, 0], [50, 0] ], dtype=float)
+            Q = np.array([ [95, 0], [20, 0], [40, 0] ], dtype=float)
+            order, flipped = nearest_neighbour(P, Q, (0, 0))
+            self.assertEqual(order.tolist(), [1, 2, 0])
+            self.assertEqual(flipped.tolist(), [False, True, False])
+            order, flipped = nearest_neighbour(P, Q, (0, 0), reverse = False)
+            self.assertEqual(order.tolist(), [1, 2, 0])
+            self.assertFalse(flipped.any())
+        
+        def test_two_opt(self):
+            # zig zag: the middle strokes are plotted in the wrong direction
+            P = np.array([ [0, 0], [20, 0], [10, 0], [30, 0] ], dtype=float)
+            Q = np.array([ [10, 0], [30, 0], [20, 0], [40, 0] ], dtype=float)
+            order, flipped = two_opt(P, Q, (0, 0))
+            P1 = np.where(flipped[:, None], Q[order], P[order])
+            Q1 = np.where(flipped[:, None], P[order], Q[order])
+            self.assertEqual(travel(P1, Q1, (0, 0)), 0)
+        
+        def test_optimize_svg(self):
+            svg = svg_doc('M 90 90 L 95 95 M 10 10 L 5 5 M 50 50 L 55 55', 'M 0 0 L 1 1')
+            out, report = optimize_svg(svg)
+            self.assertEqual(strokes(out), [ [ [5, 5, 10, 10], [50, 50, 55, 55], [90, 90, 95, 95] ], [ [0, 0, 1, 1] ] ])
+            self.assertLess(report['travel_blank_after'], report['travel_blank_before'])
+            self.assertLess(report['time_after'], report['time_before'])
+            out, report = optimize_svg(out)
+            self.assertEqual(report['travel_blank_after'], report['travel_blank_before']) # already optimal
+        
+        def test_no_reverse(self):
+            out, report = optimize_svg(svg_doc('M 90 90 L 95 95 M 10 10 L 5 5'), reverse = False)
+            self.assertEqual(strokes(out), [ [ [10, 10, 5, 5], [90, 90, 95, 95] ] ])
+        
+        def test_unsupported(self):
+            svg = svg_doc('M 90 90 C 1 1 2 2 3 3 M 0 0 L 1 1')
+            self.assertEqual(optimize_svg(svg), (svg, None))
+        
+        def test_random(self):
+            out, report = optimize_svg(random_svg(300))
+            self.assertLess(report['travel_blank_after'], report['travel_blank_before'] / 4)
+            self.assertEqual(sorted(map(sorted, strokes(out)[0])), sorted(map(sorted, strokes(random_svg(300))[0])))
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
@@ -1,4 +1,178 @@
 import re
+from array import array
+from itertools import chain
+import operator
+import sys
+
+# Streaming tokenizer for SVG path data
+# Works directly on bytes-like buffers (bytes, bytearray, memoryview, mmap) without copying them,
+# and yields coordinates as compact array('d') chunks
+# Supports negative numbers and exponents (e.g. '-1.5e-3'), as well as comma separators
+
+NUMBER = rb'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+COMMANDS = b'MmLlHhVvZzCcSsQqTtAa'
+_NUMBER = re.compile(NUMBER)
+_COMMAND = re.compile(b'[' + COMMANDS + b']')
+_SEPARATOR = re.compile(rb'[\s,]')
+# numbers between two commands: separated, or directly followed by a sign or a point (e.g. '-.5-.5', '.5.5', but not '1..5')
+_NUMBERS = re.compile(rb'[\s,]*(?:' + NUMBER + rb'(?:[\s,]+|(?<!\.)(?=[-+.])|\Z))*')
+_VALID = COMMANDS + b'0123456789 \t\n\r\f\v,.eE+-'
+_NOT_COMMAND = bytes( c for c in range(256) if c not in COMMANDS )
+# translation table: commands become a zero byte (to split at), commas become spaces
+_MARK = bytes( 0 if c in COMMANDS else 32 if c == ord(',') else c for c in range(256) )
+
+# Number of arguments per segment for each command
+ARG_COUNT = { 'M': 2, 'L': 2, 'H': 1, 'V': 1, 'Z': 0, 'C': 6, 'S': 4, 'Q': 4, 'T': 2, 'A': 7 }
+ARG_COUNT.update({ k.lower(): v for k, v in ARG_COUNT.items() })
+# Command used when a command is continued in the next chunk (additional coordinates of a moveto are linetos)
+CONTINUATION = { 'M': 'L', 'm': 'l' }
+_MODULUS = { k: v if v > 0 else sys.maxsize for k, v in ARG_COUNT.items() } # closepath: any argument is wrong
+_MIN_COUNT = { k: min(v, 1) for k, v in ARG_COUNT.items() }
+
+CHUNK_SIZE = 2**16 # bytes of path data per chunk
+
+def _buffer(data):
+    if isinstance(data, str): return data.encode('ascii')
+    return data
+
+# Tokenizes path data in chunks of about chunk_size bytes
+# Yields (commands, counts, numbers) for each chunk: commands is a str with one letter per command,
+# counts an array('L') with the number of arguments of each command, numbers an array('d') of all arguments
+# Commands longer than chunk_size are continued in the next chunk (a moveto is continued as lineto)
+# All per-command work is done by bytes.translate/split and map(), so this stays fast for millions of commands
+# (the number regex is only used for chunks with numbers that aren't separated, e.g. '-.5-.5')
+# Raises ValueError on invalid path data
+def iter_chunks(data, chunk_size = CHUNK_SIZE):
+    buf = _buffer(data)
+    end = len(buf)
+    pending = None # command continued from the previous chunk
+    continued = False # pending continues a command that had all its arguments, so it might get no more
+    carry = array('d') # arguments of an incomplete segment, continued from the previous chunk
+    pos = 0
+    while pos < end:
+        # split the data at a command (or at a separator if a single command is too long)
+        split = end
+        mid_command = False
+        if end - pos > chunk_size:
+            match = _COMMAND.search(buf, pos + chunk_size, min(pos + 2 * chunk_size, end))
+            if match != None: split = match.start()
+            else:
+                match = _SEPARATOR.search(buf, pos + chunk_size)
+                if match != None:
+                    split = match.start()
+                    mid_command = True
+        
+        chunk = bytes(buf[pos:split])
+        invalid = chunk.translate(None, _VALID)
+        if invalid: raise ValueError(f'Invalid character at position {pos + chunk.index(invalid[:1])}')
+        cmds = list(chunk.translate(None, _NOT_COMMAND).decode())
+        parts = chunk.translate(_MARK).split(b'\0')
+        args = list(map(bytes.split, parts))
+        try:
+            nums = array('d', map(float, chain.from_iterable(args)))
+        except ValueError:
+            if not all(map(_NUMBERS.fullmatch, parts)): raise ValueError(f'Invalid number in path data at position {pos}') from None
+            args = list(map(_NUMBER.findall, parts))
+            nums = array('d', map(float, chain.from_iterable(args)))
+        counts = array('L', map(len, args))
+        
+        first = counts.pop(0) # numbers before the first command
+        if pending != None and continued and not carry and first == 0: pending = None # the chunk starts with a command
+        if pending != None:
+            cmds.insert(0, pending)
+            counts.insert(0, len(carry) + first)
+            nums = carry + nums
+        elif first:
+            raise ValueError('Path data needs to start with a command')
+        pending = None
+        continued = False
+        carry = array('d')
+        
+        if mid_command and cmds:
+            # keep incomplete segments of the last command for the next chunk
+            rest = counts[-1] % ARG_COUNT[cmds[-1]] if ARG_COUNT[cmds[-1]] else 0
+            if rest:
+                carry = nums[len(nums) - rest:]
+                del nums[len(nums) - rest:]
+                counts[-1] -= rest
+            if counts[-1] == 0:
+                pending = cmds.pop()
+                counts.pop()
+            else:
+                pending = CONTINUATION.get(cmds[-1], cmds[-1])
+                continued = not carry
+        
+        # check argument counts: a multiple of the segment size, at least one segment, none for closepath
+        if any(map(operator.mod, counts, map(_MODULUS.__getitem__, cmds))) or any(map(operator.lt, counts, map(_MIN_COUNT.__getitem__, cmds))):
+            raise ValueError('Wrong number of arguments')
+        pos = split
+        if cmds: yield ''.join(cmds), counts, nums
+    if pending != None and (carry or (ARG_COUNT[pending] > 0 and not continued)):
+        raise ValueError(f'Wrong number of arguments for command {pending}')
+
+# Yields (command, numbers) for each command in the path data, numbers is an array('d')
+# Long commands may be yielded in several parts (see iter_chunks)
+# Raises ValueError on invalid path data
+def iter_path(data, chunk_size = CHUNK_SIZE):
+    for cmds, counts, nums in iter_chunks(data, chunk_size):
+        offset = 0
+        for cmd, count in zip(cmds, counts):
+            yield cmd, nums[offset:offset + count]
+            offset += count
+
+# Converts path data to polylines
+# Yields each subpath as flat array('d') of absolute coordinates [x0, y0, x1, y1, ...]
+# Only straight segments are supported (M, L, H, V, Z and their relative variants); raises ValueError otherwise
+def polylines(data, chunk_size = CHUNK_SIZE):
+    current = None
+    x = y = 0.0 # current point
+    sx = sy = 0.0 # start of subpath
+    for cmd, nums in iter_path(data, chunk_size):
+        if cmd == 'M' or cmd == 'm':
+            if current != None and len(current) > 2: yield current
+            if cmd == 'm':
+                nums[0] += x
+                nums[1] += y
+            sx, sy = nums[0], nums[1]
+            current = array('d', (sx, sy))
+            x, y = sx, sy
+            nums = nums[2:]
+            cmd = 'L' if cmd == 'M' else 'l'
+            if len(nums) == 0: continue
+        if current == None:
+            raise ValueError('Path data needs to start with a moveto')
+        if cmd == 'L':
+            current.extend(nums)
+        elif cmd == 'l':
+            for i in range(0, len(nums), 2):
+                x += nums[i]
+                y += nums[i+1]
+                nums[i] = x
+                nums[i+1] = y
+            current.extend(nums)
+        elif cmd in 'Hh':
+            for v in nums:
+                x = x + v if cmd == 'h' else v
+                current.extend((x, y))
+        elif cmd in 'Vv':
+            for v in nums:
+                y = y + v if cmd == 'v' else v
+                current.extend((x, y))
+        elif cmd in 'Zz':
+            current.extend((sx, sy))
+        else:
+            raise ValueError(f'Unsupported path command: {cmd}')
+        x, y = current[-2], current[-1]
+    if current != None and len(current) > 2: yield current
+
+# Encodes polylines (flat sequences of absolute coordinates, see polylines()) as path data
+def encode_polylines(lines, precision = 3):
+    out = []
+    for line in lines:
+        coords = [ f'{v:.{precision}f}'.rstrip('0').rstrip('.') for v in line ]
+        coords = [ '0' if c == '-0' else c for c in coords ]
+        out.append( f'M {coords[0]} {coords[1]} L ' + ' '.join(coords[2:]) )
+    return ' '.join(out)
 
 def to_num(str):
     num = float(str)
@@ -7,30 +181,148 @@ def to_num(str):
 
 # E.g.: 'M 12.012 2.0 30'
 def decode_command(str):
-    str = str.strip()
-    # check whole string
-    check = re.fullmatch(r'[ML](\s+\d+\.?\d*\s*)+', str);
-    if not check: return None
-    type = re.match(r'^[ML]', str)[0]
-    nums = re.findall(r'\d+\.?\d*', str)
-    nums = list(map(to_num, nums))
-    return (type, nums)
+    try:
+        cmds = list(iter_path(str))
+    except ValueError:
+        return None
+    if len(cmds) != 1: return None
+    type, nums = cmds[0]
+    return (type, list(map(to_num, nums)))
 
 # E.g.: 'M 12.012 2.0 L 10 30 23.4 99.0 M 10.0 22'
 def decode_path(str):
+    try:
+        cmds = [ (type, list(map(to_num, nums))) for type, nums in iter_path(str, chunk_size = len(str) + 1) ]
+    except ValueError:
+        return None
+    if not cmds: return None
+    return cmds
+
+
+def _legacy_decode_path(str):
+    # previous regex based implementation (positive numbers only), for benchmarking
     check = re.fullmatch(r'([ML](\s+\d+\.?\d*\s*)+)+', str);
     if not check: return None
     cmds = re.split(r'\s+(?=[ML])', str)
-    cmds = map(decode_command, cmds)
-    cmds = list(filter(lambda x: x != None, cmds))
-    if not cmds: return None
-    return cmds
+    out = []
+    for cmd in cmds:
+        cmd = cmd.strip()
+        nums = list(map(to_num, re.findall(r'\d+\.?\d*', cmd)))
+        out.append((cmd[0], nums))
+    return out
+
+def benchmark(segments = 1_000_000):
+    import random
+    import time
+    random.seed(0)
+    
+    def timed(label, fn):
+        start = time.perf_counter()
+        res = fn()
+        print(f'{label:<44} {time.perf_counter() - start:7.3f} s')
+        return res
+    
+    # one long polyline, and many short strokes (tg-plot style)
+    coords = ' '.join( f'{random.uniform(0, 400):.3f} {random.uniform(0, 280):.3f}' for i in range(segments) )
+    polyline = 'M 0 0 L ' + coords
+    strokes = ' '.join( f'M {random.uniform(-200, 200):.3f} {random.uniform(-140, 140):.3f} L {random.uniform(-200, 200):.3f} {random.uniform(-140, 140):.3f}' for i in range(segments) )
+    print(f'{segments} segments; polyline {len(polyline)/2**20:.1f} MB, strokes {len(strokes)/2**20:.1f} MB')
+    
+    polyline_bytes = polyline.encode()
+    strokes_bytes = strokes.encode()
+    timed('legacy decode_path (polyline)', lambda: _legacy_decode_path(polyline))
+    timed('iter_chunks (polyline, bytes)', lambda: sum( len(nums) for cmds, counts, nums in iter_chunks(memoryview(polyline_bytes)) ))
+    timed('iter_path (polyline, bytes)', lambda: sum( len(nums) for cmd, nums in iter_path(memoryview(polyline_bytes)) ))
+    timed('polylines (polyline, bytes)', lambda: list(polylines(polyline_bytes)))
+    timed('iter_chunks (strokes, bytes)', lambda: sum( len(nums) for cmds, counts, nums in iter_chunks(memoryview(strokes_bytes)) ))
+    timed('iter_path (strokes, bytes)', lambda: sum( len(nums) for cmd, nums in iter_path(memoryview(strokes_bytes)) ))
+    timed('polylines (strokes, bytes)', lambda: list(polylines(strokes_bytes)))
+    timed('decode_path (strokes, str)', lambda: decode_path(strokes))
+
 
 if __name__ == '__main__':
-    # x = decode_command('M 12.012 2.0 30');
-    # x = decode_command('M 1.2');
-    # print(x)
+    import unittest
+    
+    class Test(unittest.TestCase):
+        def test_decode_command(self):
+            self.assertEqual(decode_command('M 12.012 2.0 30 1'), ('M', [12.012, 2, 30, 1]))
+            self.assertEqual(decode_command('  L 1.5  2  '), ('L', [1.5, 2]))
+            self.assertEqual(decode_command('M 1.2'), None)
+            self.assertEqual(decode_command('M 1 2 L 3 4'), None)
+        
+        def test_decode_path(self):
+            self.assertEqual(
+                decode_path('M 12.012 2.0 L 10 30 23.4 99.0 M 10.0 22'),
+                [('M', [12.012, 2]), ('L', [10, 30, 23.4, 99]), ('M', [10, 22])]
+            )
+            self.assertEqual(decode_path(''), None)
+            self.assertEqual(decode_path('M 1 2 X 3'), None)
+            self.assertEqual(decode_path('1 2 M 3 4'), None)
+        
+        def test_negative_and_exponents(self):
+            self.assertEqual(
+                decode_path('M -99.75 -1e2 L +1.5E-1,2e+1 -.5-.5 .25.25'),
+                [('M', [-99.75, -100]), ('L', [0.15, 20, -0.5, -0.5, 0.25, 0.25])]
+            )
+        
+        def test_iter_path_buffers(self):
+            data = 'M 1 2 L 3 4 z'
+            for buf in [data, data.encode(), bytearray(data.encode()), memoryview(data.encode())]:
+                cmds = [ (cmd, list(nums)) for cmd, nums in iter_path(buf) ]
+                self.assertEqual(cmds, [('M', [1, 2]), ('L', [3, 4]), ('z', [])])
+            self.assertEqual(list(iter_path('')), [])
+            self.assertEqual(list(iter_path('  ')), [])
+            with self.assertRaises(ValueError): list(iter_path('M 1 2 Z 3'))
+            with self.assertRaises(ValueError): list(iter_path('M'))
+            with self.assertRaises(ValueError): list(iter_path('L 1 2 3'))
+            for data in ['M 0 0 L 1e 2', 'M 0 0 L 1e5e 2', 'M 0 0 L 1..5 2', 'M 0 0 L 1.5.5 2e']:
+                with self.assertRaises(ValueError): list(iter_path(data))
+        
+        def test_iter_chunks(self):
+            data = 'M 1 2 L 3 4 5 6 Z ' * 100
+            chunks = list(iter_chunks(data, chunk_size = 64))
+            self.assertGreater(len(chunks), 10)
+            self.assertEqual(''.join( c[0] for c in chunks ), 'MLZ' * 100)
+            self.assertEqual(sum(( list(c[1]) for c in chunks ), []), [2, 4, 0] * 100)
+            self.assertEqual(sum(( list(c[2]) for c in chunks ), []), [1, 2, 3, 4, 5, 6] * 100)
+            # split before a separator or the next command, after all arguments of a command
+            for chunk_size in range(1, 14):
+                self.assertEqual([ (cmd, list(c)) for cmd, c in iter_path(b'M 1 2 L 3 4 ' * 3, chunk_size) ], [('M', [1, 2]), ('L', [3, 4])] * 3)
+            with self.assertRaises(ValueError): list(iter_path('M 1 2 L 3 4 5 L', chunk_size = 5))
+        
+        def test_long_command(self):
+            nums = [ float(i) * (-1)**i for i in range(1001) ]
+            data = 'M ' + ' '.join(map(str, nums)) + ' 0'
+            chunks = list(iter_path(data, chunk_size = 100))
+            self.assertGreater(len(chunks), 10)
+            self.assertEqual(chunks[0][0], 'M')
+            self.assertTrue(all( cmd == 'L' for cmd, c in chunks[1:] ))
+            self.assertTrue(all( len(c) % 2 == 0 for cmd, c in chunks ))
+            self.assertEqual(sum(( list(c) for cmd, c in chunks ), []), nums + [0])
+        
+        def test_polylines(self):
+            lines = [ list(x) for x in polylines('M 1 1 L 2 1 m 1 1 l 1 0 0 1 h -1 z M 5 5 H 6 V 7 M 9 9 M 0 0 1 1') ]
+            self.assertEqual(lines, [
+                [1, 1, 2, 1],
+                [3, 2, 4, 2, 4, 3, 3, 3, 3, 2],
+                [5, 5, 6, 5, 6, 7],
+                [0, 0, 1, 1],
+            ])
+            with self.assertRaises(ValueError): list(polylines('M 0 0 C 1 1 2 2 3 3'))
+        
+        def test_polylines_chunked(self):
+            data = 'm 0 0 ' + ' '.join( '1 -1' for i in range(500) )
+            line = list(polylines(data, chunk_size = 64))
+            self.assertEqual(len(line), 1)
+            self.assertEqual(line[0][-2:].tolist(), [500, -500])
+            self.assertEqual(len(line[0]), 1002)
+        
+        def test_encode_polylines(self):
+            lines = [ array('d', [0, -0.0, 1.5, 2.25]), array('d', [-1.0004, 3, 4, 5]) ]
+            self.assertEqual(encode_polylines(lines), 'M 0 0 L 1.5 2.25 M -1 3 L 4 5')
+            self.assertEqual([ list(x) for x in polylines(encode_polylines(lines)) ], [[0, 0, 1.5, 2.25], [-1, 3, 4, 5]])
     
-    x = decode_path('M 12.012 2.0 L 10 30 23.4 99.0 M 10.0 22');
-    # x = decode_command('M 1.2');
-    print(x)
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 1_000_000)
+    else:
+        unittest.main()
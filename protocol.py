@@ -0,0 +1,314 @@
+import json
+import struct
+import zlib
+from xml.sax.saxutils import escape
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Binary plot submissions
+# A binary websocket frame carries a small header, the plot message as json (without the svg),
+# and the drawing as compressed svg or as compact binary polylines (which are converted to svg on the server)
+#
+# Frame:    magic 'TGP1' | content (uint8) | compression (uint8) | meta size (uint32) | meta (json, utf-8) | payload
+# Polylines payload (after decompression):
+#           line count n (uint32) | point counts (uint32 * n) | layer numbers (uint16 * n) | coordinates (int32 * 2 * points)
+#           Coordinates are in µm, with the origin in the center of the page (like tg-plot svgs)
+#           They are delta encoded: x, y of each point relative to the previous point (the first one relative to 0, 0)
+#
+# Chunk of a chunked upload (see uploads.py):
+#           magic 'TGC1' | offset (uint64) | upload id size (uint8) | upload id (ascii) | data
+# All numbers are little endian
+
+MAGIC = b'TGP1'
+HEADER = struct.Struct('<4sBBI')
+CHUNK_MAGIC = b'TGC1'
+CHUNK_HEADER = struct.Struct('<4sQB')
+
+CONTENT_SVG = 0
+CONTENT_POLYLINES = 1
+
+COMPRESSION = { None: 0, 'deflate': 1, 'zstd': 2 }
+COMPRESSION_NAMES = { v: k for k, v in COMPRESSION.items() }
+
+MAX_CONTENT_SIZE = 64 * 2**20 # max. size of the decompressed payload (protects against compression bombs)
+
+def is_frame(data):
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:len(MAGIC)]) == MAGIC
+
+def is_chunk(data):
+    return isinstance(data, (bytes, bytearray, memoryview)) and bytes(data[:len(CHUNK_MAGIC)]) == CHUNK_MAGIC
+
+def compress(data, compression):
+    if compression == None: return data
+    if compression == 'deflate': return zlib.compress(data, 6)
+    if compression == 'zstd':
+        if zstandard == None: raise ValueError('zstd is not available (pip install zstandard)')
+        return zstandard.ZstdCompressor(level = 6).compress(data)
+    raise ValueError(f'Unknown compression: {compression}')
+
+# Raises ValueError if the data is invalid or decompresses to more than max_size bytes
+def decompress(data, compression, max_size = MAX_CONTENT_SIZE):
+    if compression == None:
+        out = bytes(data)
+    elif compression == 'deflate':
+        d = zlib.decompressobj()
+        try:
+            out = d.decompress(data, max_size + 1)
+        except zlib.error as e:
+            raise ValueError(f'Invalid deflate payload: {e}') from None
+        if not d.eof and len(out) <= max_size: raise ValueError('Truncated deflate payload')
+    elif compression == 'zstd':
+        if zstandard == None: raise ValueError('zstd is not supported by this server')
+        out = bytearray()
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+                while len(out) <= max_size:
+                    chunk = reader.read(2**20)
+                    if not chunk: break
+                    out += chunk
+        except zstandard.ZstdError as e:
+            raise ValueError(f'Invalid zstd payload: {e}') from None
+    else:
+        raise ValueError('Unknown compression')
+    if len(out) > max_size: raise ValueError(f'Payload too large (max. {max_size // 2**20} MB)')
+    return out
+
+# Encode polylines as payload (see above)
+# lines: sequences of (x, y) points in mm, layers: layer number for each line (default: 0)
+def encode_polylines(lines, layers = None):
+    points = np.array([ len(x) for x in lines ], dtype='<u4')
+    if layers == None: layers = [0] * len(lines)
+    coords = np.rint(np.concatenate([ np.asarray(x, dtype=float).reshape(-1, 2) for x in lines ]) * 1000).astype(np.int64) if lines else np.zeros((0, 2), dtype=np.int64)
+    deltas = np.diff(coords, axis=0, prepend=0).astype('<i4')
+    return struct.pack('<I', len(lines)) + points.tobytes() + np.array(layers, dtype='<u2').tobytes() + deltas.tobytes()
+
+# Decode polylines payload into (points, layers, coords): point counts and layer numbers per line,
+# and absolute coordinates in µm as (n, 2) array
+def decode_polylines(data):
+    if len(data) < 4: raise ValueError('Invalid polylines payload')
+    n = struct.unpack_from('<I', data)[0]
+    offset = 4 + n * 6
+    if len(data) < offset: raise ValueError('Invalid polylines payload')
+    points = np.frombuffer(data, dtype='<u4', count=n, offset=4).astype(np.int64)
+    layers = np.frombuffer(data, dtype='<u2', count=n, offset=4 + n * 4)
+    if len(data) - offset != points.sum() * 8: raise ValueError('Invalid polylines payload')
+    if n > 0 and points.min() < 2: raise ValueError('Polylines need at least two points')
+    deltas = np.frombuffer(data, dtype='<i4', offset=offset).reshape(-1, 2)
+    coords = np.cumsum(deltas, axis=0, dtype=np.int64)
+    return points, layers, coords
+
+# Create a tg-plot (v4) compatible svg from polylines and plot message meta data
+# The viewBox is in µm, so coordinates can be written as integers
+def polylines_svg(meta, points, layers, coords):
+    def attr(value):
+        return escape(str(value), {'"': '&quot;'})
+    
+    width, height = meta['size']
+    stats = meta['stats']
+    tokens = list(map(str, coords.ravel().tolist()))
+    ends = np.cumsum(points * 2).tolist()
+    starts = [0] + ends[:-1]
+    
+    out = [
+        '<svg xmlns="http://www.w3.org/2000/svg"\n'
+        '     xmlns:tg="https://sketch.process.studio/turtle-graphics"\n'
+        '     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"\n'
+        f'     tg:version="4" tg:count="{attr(stats["count"])}" tg:layer_count="{attr(stats["layer_count"])}" tg:oob_count="{attr(stats["oob_count"])}" tg:short_count="{attr(stats["short_count"])}" '
+        f'tg:travel="{attr(stats["travel"])}" tg:travel_ink="{attr(stats["travel_ink"])}" tg:travel_blank="{attr(stats.get("travel_blank", 0))}" '
+        f'tg:format="{attr(meta.get("format", "A4_LANDSCAPE"))}" tg:width_mm="{attr(width)}" tg:height_mm="{attr(height)}" tg:speed="{attr(meta.get("speed", 100))}" '
+        f'tg:author="{attr(meta["client"])}" tg:timestamp="{attr(meta["timestamp"])}"\n'
+        f'     width="{width}mm"\n'
+        f'     height="{height}mm"\n'
+        f'     viewBox="{-width * 500:g} {-height * 500:g} {width * 1000:g} {height * 1000:g}"\n'
+        '     stroke="black" fill="none" stroke-linecap="round" stroke-width="1000">\n'
+    ]
+    layer_list = layers.tolist()
+    for i, layer in enumerate(sorted(set(layer_list))):
+        d = ' '.join(
+            f'M {tokens[s]} {tokens[s+1]} L ' + ' '.join(tokens[s+2:e])
+            for s, e, l in zip(starts, ends, layer_list) if l == layer
+        )
+        label = f'{"!" if i > 0 else ""}{layer} Layer {layer}'
+        out.append(f'    <g id="Layer {layer}" inkscape:groupmode="layer" inkscape:label="{label}">\n        <path d="{d}" />\n    </g>\n')
+    out.append('</svg>\n')
+    return ''.join(out)
+
+# Encode a plot message as binary frame
+# The drawing is either msg['svg'] or lines (and layers, see encode_polylines)
+def encode_frame(msg, lines = None, layers = None, compression = 'deflate'):
+    meta = { k: v for k, v in msg.items() if k != 'svg' }
+    meta.setdefault('type', 'plot')
+    if lines != None:
+        content = CONTENT_POLYLINES
+        payload = encode_polylines(lines, layers)
+    else:
+        content = CONTENT_SVG
+        payload = msg['svg'].encode('utf-8')
+    meta = json.dumps(meta).encode('utf-8')
+    return HEADER.pack(MAGIC, content, COMPRESSION[compression], len(meta)) + meta + compress(payload, compression)
+
+# Decode a binary frame into (msg, polylines)
+# msg is a plot message like the json message; it includes the svg, unless the content are polylines
+# polylines is None or (points, layers, coords) (see decode_polylines, polylines_svg)
+# Raises ValueError on invalid frames
+def decode_frame(data, max_size = MAX_CONTENT_SIZE):
+    data = memoryview(data)
+    if len(data) < HEADER.size: raise ValueError('Invalid frame')
+    magic, content, compression, meta_size = HEADER.unpack_from(data)
+    if magic != MAGIC: raise ValueError('Invalid frame')
+    if compression not in COMPRESSION_NAMES: raise ValueError('Unknown compression')
+    if HEADER.size + meta_size > len(data): raise ValueError('Invalid frame')
+    try:
+        msg = json.loads(bytes(data[HEADER.size:HEADER.size + meta_size]))
+    except json.JSONDecodeError as e:
+        raise ValueError(f'Invalid JSON: {e.msg} (position {e.pos})') from None
+    if not isinstance(msg, dict): raise ValueError('Invalid frame')
+    msg.setdefault('type', 'plot')
+    if msg['type'] != 'plot': return msg, None
+    
+    payload = decompress(data[HEADER.size + meta_size:], COMPRESSION_NAMES[compression], max_size)
+    if content == CONTENT_SVG:
+        try:
+            msg['svg'] = bytes(payload).decode('utf-8')
+        except UnicodeDecodeError:
+            raise ValueError('Invalid svg encoding') from None
+        return msg, None
+    if content == CONTENT_POLYLINES:
+        return msg, decode_polylines(payload)
+    raise ValueError('Unknown content')
+
+def encode_chunk(upload_id, offset, data):
+    upload_id = upload_id.encode('ascii')
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, offset, len(upload_id)) + upload_id + data
+
+# Decode a chunk frame into a plot_chunk message
+def decode_chunk(data):
+    data = memoryview(data)
+    if len(data) < CHUNK_HEADER.size: raise ValueError('Invalid chunk')
+    magic, offset, id_size = CHUNK_HEADER.unpack_from(data)
+    if magic != CHUNK_MAGIC or len(data) < CHUNK_HEADER.size + id_size: raise ValueError('Invalid chunk')
+    try:
+        upload_id = bytes(data[CHUNK_HEADER.size:CHUNK_HEADER.size + id_size]).decode('ascii')
+    except UnicodeDecodeError:
+        raise ValueError('Invalid upload id') from None
+    return { 'type': 'plot_chunk', 'upload_id': upload_id, 'offset': offset, 'data': bytes(data[CHUNK_HEADER.size + id_size:]) }
+
+def benchmark(segments = 300_000):
+    import math
+    import random
+    import time
+    import ingest
+    random.seed(0)
+    
+    def timed(label, fn, repeat = 3):
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            res = fn()
+            t = time.perf_counter() - start
+            best = t if best == None else min(best, t)
+        print(f'{label:<36} {best:7.3f} s')
+        return res
+    
+    # turtle graphics: polylines of short segments with few distinct directions
+    lines = []
+    for i in range(segments // 100):
+        x, y = random.uniform(-100, 100), random.uniform(-70, 70)
+        line = [(x, y)]
+        for j in range(100):
+            angle = math.radians(random.choice([0, 60, 120, 180, 240, 300]))
+            x, y = round(x + 2 * math.cos(angle), 3), round(y + 2 * math.sin(angle), 3)
+            line.append((x, y))
+        lines.append(line)
+    msg = {
+        'type': 'plot', 'client': 'bench', 'id': 'XYZ', 'timestamp': '20241010_210611.777_UTC+1', 'speed': 100, 'format': 'A4 Landscape', 'size': [297, 210],
+        'stats': { 'count': segments, 'layer_count': 1, 'oob_count': 0, 'short_count': 0, 'travel': 0, 'travel_ink': 0, 'travel_blank': 0 },
+    }
+    msg['svg'] = polylines_svg(msg, *decode_polylines(encode_polylines(lines)))
+    
+    messages = [ ('json', json.dumps(msg)), ('svg, deflate', encode_frame(msg)) ]
+    if zstandard != None: messages.append(( 'svg, zstd', encode_frame(msg, compression = 'zstd') ))
+    messages.append(( 'polylines, deflate', encode_frame(msg, lines, compression = 'deflate') ))
+    if zstandard != None: messages.append(( 'polylines, zstd', encode_frame(msg, lines, compression = 'zstd') ))
+    
+    print(f'{segments} segments')
+    for label, message in messages:
+        print(f'{label:<36} {len(message) / 2**20:7.2f} MB')
+    for label, message in messages:
+        timed(f'ingest.decode ({label})', lambda: ingest.decode(message))
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    
+    MSG = {
+        'type': 'plot', 'client': 'a"b<c>', 'id': 'XYZ', 'timestamp': '20241010_210611.777_UTC+1', 'speed': 50, 'format': 'A4 Landscape', 'size': [297, 210],
+        'stats': { 'count': 3, 'layer_count': 2, 'oob_count': 0, 'short_count': 0, 'travel': 10, 'travel_ink': 5, 'travel_blank': 5 },
+        'svg': '<svg xmlns="http://www.w3.org/2000/svg"><path d="M 0 0 L 1 1" /></svg>',
+    }
+    
+    class Test(unittest.TestCase):
+        def test_svg_frames(self):
+            for compression in COMPRESSION:
+                if compression == 'zstd' and zstandard == None: continue
+                frame = encode_frame(MSG, compression = compression)
+                self.assertTrue(is_frame(frame))
+                self.assertEqual(decode_frame(frame), (MSG, None))
+        
+        def test_polylines(self):
+            lines = [ [(0, 0), (1.5, -2.25)], [(10, 10), (-148.5, 105), (0.001, 0)] ]
+            points, layers, coords = decode_polylines(encode_polylines(lines, [0, 2]))
+            self.assertEqual(points.tolist(), [2, 3])
+            self.assertEqual(layers.tolist(), [0, 2])
+            self.assertEqual(coords.tolist(), [[0, 0], [1500, -2250], [10000, 10000], [-148500, 105000], [1, 0]])
+            with self.assertRaises(ValueError): decode_polylines(encode_polylines(lines)[:-1])
+            with self.assertRaises(ValueError): decode_polylines(encode_polylines([ [(0, 0)] ]))
+        
+        def test_polylines_frame(self):
+            import estimate
+            import xml.etree.ElementTree as ElementTree
+            lines = [ [(0, 0), (10, 0)], [(10, 10), (20, 10)], [(0, 0), (0, 10)] ]
+            msg, polylines = decode_frame(encode_frame(MSG, lines, [0, 1, 0]))
+            self.assertNotIn('svg', msg)
+            svg = polylines_svg(msg, *polylines)
+            root = ElementTree.fromstring(svg) # valid xml, author is escaped
+            self.assertEqual(root.get('{https://sketch.process.studio/turtle-graphics}author'), 'a"b<c>')
+            self.assertIn('viewBox="-148500 -105000 297000 210000"', svg)
+            self.assertIn('inkscape:label="0 Layer 0">\n        <path d="M 0 0 L 10000 0 M 0 0 L 0 10000" />', svg)
+            self.assertIn('inkscape:label="!1 Layer 1">\n        <path d="M 10000 10000 L 20000 10000" />', svg)
+            # coordinates in mm on the page
+            layers = estimate.decode_svg(svg)
+            self.assertEqual(len(layers), 2)
+            self.assertAlmostEqual(float(layers[0][0][1][0]), 148.5 + 10)
+        
+        def test_invalid_frames(self):
+            frame = encode_frame(MSG)
+            with self.assertRaises(ValueError): decode_frame(frame[:8])
+            with self.assertRaises(ValueError): decode_frame(frame[:-4]) # truncated
+            with self.assertRaises(ValueError): decode_frame(b'XXXX' + frame[4:])
+            with self.assertRaises(ValueError): decode_frame(frame[:4] + b'\x00\x07' + frame[6:]) # compression
+        
+        def test_chunks(self):
+            chunk = encode_chunk('abc-1', 2**33, b'<svg>')
+            self.assertTrue(is_chunk(chunk))
+            self.assertFalse(is_frame(chunk))
+            self.assertEqual(decode_chunk(chunk), { 'type': 'plot_chunk', 'upload_id': 'abc-1', 'offset': 2**33, 'data': b'<svg>' })
+            with self.assertRaises(ValueError): decode_chunk(chunk[:15])
+        
+        def test_compression_bomb(self):
+            msg = dict(MSG, svg = ' ' * 2**20)
+            for compression in COMPRESSION:
+                if compression == 'zstd' and zstandard == None: continue
+                frame = encode_frame(msg, compression = compression)
+                with self.assertRaisesRegex(ValueError, 'too large'): decode_frame(frame, max_size = 2**19)
+                self.assertEqual(len(decode_frame(frame, max_size = 2**20)[0]['svg']), 2**20)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 300_000)
+    else:
+        unittest.main()
@@ -0,0 +1,237 @@
+import math
+
+# Scheduling policies: which waiting job is plotted next
+# The queue calls policy.pick(jobs) with the waiting jobs in queue order (see async_queue.py) and takes the job at the returned index
+# fifo ... first in queue (the order can be changed by hand)
+# sjf ... shortest estimated job first (time_estimate). Jobs that haven't been estimated yet (time_estimate_source
+#         'pending', see spooler.enqueue_resumed) go last
+# fair ... job of the client that used the plotter the least recently (plot time, decaying with a half life)
+# format ... same format as the previous job, to save paper changes
+# Other policies than fifo use the queue order only to break ties. Jobs are never skipped more than max_skip times
+# in a row when first in queue, so long jobs (sjf) or odd formats (format) can't starve
+# A job first in queue whose plot was interrupted by a restart is never skipped, its paper is still on a plotter. Usually
+# its own plotter takes it back without the queue, it's only queued if that plotter is gone (see spooler.own_plotter)
+# The queue order isn't changed by the policy, so positions and expected start times sent to clients (see
+# spooler.eta) follow the queue order: they only hold for fifo
+
+class Policy:
+    name = 'fifo'
+    
+    def __init__(self, max_skip = 5):
+        self.max_skip = max_skip
+        self.head = None # first job in queue, and how often it has been skipped
+        self.head_skips = 0
+    
+    def pick(self, jobs):
+        if jobs[0] is not self.head:
+            self.head = jobs[0]
+            self.head_skips = 0
+        if jobs[0].get('progress') != None: idx = 0
+        elif self.max_skip != None and self.head_skips >= self.max_skip: idx = 0
+        else: idx = self.choose(jobs)
+        if idx == 0: self.head = None
+        else: self.head_skips += 1
+        self.picked(jobs[idx])
+        return idx
+    
+    # Index of the next job
+    def choose(self, jobs):
+        return 0
+    
+    # Called with the job that is plotted next
+    def picked(self, job):
+        pass
+
+class ShortestJobFirst(Policy):
+    name = 'sjf'
+    
+    def choose(self, jobs):
+        return min( range(len(jobs)), key = lambda i: self.estimate(jobs[i]) )
+    
+    def estimate(self, job):
+        if job.get('time_estimate_source') == 'pending': return math.inf
+        return job.get('time_estimate', math.inf)
+
+class FairShare(Policy):
+    name = 'fair'
+    
+    def __init__(self, max_skip = 5, half_life = 60 * 60):
+        super().__init__(max_skip)
+        self.half_life = half_life # seconds of plot time
+        self.usage = {} # client -> decayed plot time
+    
+    def choose(self, jobs):
+        return min( range(len(jobs)), key = lambda i: self.usage.get(jobs[i]['client'], 0) )
+    
+    # Usage is measured in plot time, so it decays with the plot time of all jobs
+    def picked(self, job):
+        duration = job.get('time_estimate', 0)
+        decay = 0.5 ** (duration / self.half_life)
+        for client in list(self.usage):
+            self.usage[client] *= decay
+            if self.usage[client] < 1: del self.usage[client]
+        self.usage[job['client']] = self.usage.get(job['client'], 0) + duration
+
+class FormatBatching(Policy):
+    name = 'format'
+    
+    def __init__(self, max_skip = 5):
+        super().__init__(max_skip)
+        self.format = None # format of the previous job
+    
+    def choose(self, jobs):
+        return next( (i for i, job in enumerate(jobs) if job.get('format') == self.format), 0 )
+    
+    def picked(self, job):
+        self.format = job.get('format')
+
+POLICIES = { cls.name: cls for cls in [Policy, ShortestJobFirst, FairShare, FormatBatching] }
+
+def create(name, **kwargs):
+    if name not in POLICIES: raise ValueError(f'Unknown scheduling policy: {name} (available: {", ".join(POLICIES)})')
+    return POLICIES[name](**kwargs)
+
+
+# Replay a trace of jobs on one or more plotters (taking the next job whenever they are free)
+# trace: list of dicts with arrival (seconds), client, time_estimate (seconds), format
+# format_change: seconds it takes to change paper between jobs with different formats (on the same plotter)
+# Returns mean and max. wait (arrival to start), makespan (first arrival to last job done) and the number of format changes
+def replay(trace, policy, format_change = 60, plotters = 1):
+    trace = sorted(trace, key = lambda x: x['arrival'])
+    waiting = []
+    waits = []
+    changes = 0
+    start = trace[0]['arrival'] if trace else 0
+    free = [start] * plotters # time each plotter becomes free
+    previous = [None] * plotters # previous job of each plotter
+    end = start
+    i = 0
+    while i < len(trace) or waiting:
+        p = min( range(plotters), key = lambda p: free[p] )
+        time = free[p]
+        while i < len(trace) and trace[i]['arrival'] <= time:
+            waiting.append(trace[i])
+            i += 1
+        if not waiting:
+            free[p] = trace[i]['arrival']
+            continue
+        job = waiting.pop( policy.pick(waiting) )
+        if previous[p] != None and job['format'] != previous[p]['format']:
+            time += format_change
+            changes += 1
+        waits.append(time - job['arrival'])
+        time += job['time_estimate']
+        free[p] = time
+        previous[p] = job
+        end = max(end, time)
+    return {
+        'mean_wait': sum(waits) / len(waits) if waits else 0,
+        'max_wait': max(waits, default = 0),
+        'makespan': end - start,
+        'format_changes': changes,
+    }
+
+# Random trace: bursts of jobs from a few regular clients and many one-time clients
+def random_trace(n = 200, seed = 0):
+    import random
+    rng = random.Random(seed)
+    trace = []
+    t = 0
+    for i in range(n):
+        t += rng.expovariate(1 / 200) # a job every 3:20 min on average
+        client = f'regular-{rng.randrange(3)}' if rng.random() < 0.4 else f'client-{i}'
+        trace.append({
+            'arrival': t,
+            'client': client,
+            'time_estimate': rng.lognormvariate(math.log(150), 0.8), # median 2.5 min, a few long ones
+            'format': rng.choice(['A4_LANDSCAPE'] * 3 + ['A3_LANDSCAPE', 'A4_PORTRAIT']),
+        })
+    return trace
+
+def print_replay(trace, format_change = 60):
+    print(f'{len(trace)} jobs, {format_change} s per format change')
+    print(f'{"policy":<8} {"mean wait":>10} {"max wait":>10} {"makespan":>10} {"changes":>8}')
+    for name in POLICIES:
+        res = replay(trace, create(name), format_change)
+        print(f'{name:<8} {res["mean_wait"]/60:8.1f} m {res["max_wait"]/60:8.1f} m {res["makespan"]/60:8.1f} m {res["format_changes"]:8}')
+    # throughput with several plotters, when all jobs are waiting from the start
+    backlog = [ dict(job, arrival = 0) for job in trace ]
+    single = replay(backlog, create('fifo'), format_change)['makespan']
+    print(f'\nbacklog of {len(trace)} jobs (fifo)')
+    print(f'{"plotters":<8} {"makespan":>10} {"speedup":>10}')
+    for n in [1, 2, 3, 4]:
+        res = replay(backlog, create('fifo'), format_change, plotters = n)
+        print(f'{n:<8} {res["makespan"]/60:8.1f} m {single / res["makespan"]:9.2f}x')
+
+
+if __name__ == '__main__':
+    import sys
+    import json
+    import unittest
+    
+    def job(client, time_estimate, format = 'A4'):
+        return { 'client': client, 'time_estimate': time_estimate, 'format': format }
+    
+    class Test(unittest.TestCase):
+        def test_fifo(self):
+            self.assertEqual(create('fifo').pick([ job('a', 10), job('b', 1) ]), 0)
+        
+        def test_sjf(self):
+            policy = create('sjf', max_skip = 2)
+            jobs = [ job('a', 10), job('b', 1), job('c', 5), job('d', 1) ]
+            self.assertEqual(policy.pick(jobs), 1)
+            jobs.pop(1)
+            self.assertEqual(policy.pick(jobs), 2) # d
+            jobs.pop(2)
+            self.assertEqual(policy.pick(jobs + [job('e', 1)]), 0) # a was skipped twice
+            jobs = [ job('a', 10), job('b', 0), job('c', 5) ]
+            jobs[1]['time_estimate_source'] = 'pending' # resumed, not estimated yet
+            self.assertEqual(create('sjf').pick(jobs), 2)
+        
+        def test_interrupted(self):
+            jobs = [ job('a', 10), job('b', 1) ]
+            jobs[0]['progress'] = { 'status': 'paused' }
+            self.assertEqual(create('sjf').pick(jobs), 0)
+        
+        def test_fair(self):
+            policy = create('fair')
+            self.assertEqual(policy.pick([ job('a', 100), job('b', 100) ]), 0)
+            self.assertEqual(policy.pick([ job('a', 100), job('b', 100) ]), 1) # a has plotted already
+            self.assertEqual(policy.pick([ job('a', 100), job('b', 100), job('c', 100) ]), 2)
+        
+        def test_format(self):
+            policy = create('format', max_skip = 1)
+            b = job('b', 1, 'A4')
+            self.assertEqual(policy.pick([ job('a', 1, 'A3'), b ]), 0)
+            self.assertEqual(policy.pick([ b, job('c', 1, 'A3') ]), 1)
+            self.assertEqual(policy.pick([ b, job('d', 1, 'A3') ]), 0) # b was skipped once
+        
+        def test_create(self):
+            with self.assertRaises(ValueError): create('lifo')
+        
+        def test_replay(self):
+            trace = [ dict(job('a', 100), arrival = 0), dict(job('b', 100, 'A3'), arrival = 10), dict(job('c', 10), arrival = 20) ]
+            fifo = replay(trace, create('fifo'), format_change = 50)
+            self.assertEqual(fifo['makespan'], 100 + 50 + 100 + 50 + 10)
+            self.assertEqual(fifo['format_changes'], 2)
+            batched = replay(trace, create('format'), format_change = 50)
+            self.assertEqual(batched['makespan'], 100 + 10 + 50 + 100)
+            self.assertLess(replay(trace, create('sjf'))['mean_wait'], fifo['mean_wait'])
+        
+        def test_replay_plotters(self):
+            trace = [ dict(job(c, 100), arrival = 0) for c in 'abcd' ]
+            self.assertEqual(replay(trace, create('fifo'))['makespan'], 400)
+            res = replay(trace, create('fifo'), plotters = 2)
+            self.assertEqual(res['makespan'], 200)
+            self.assertEqual(res['mean_wait'], (0 + 0 + 100 + 100) / 4)
+            self.assertEqual(replay(trace, create('fifo'), plotters = 8)['makespan'], 100)
+    
+    # python scheduler.py replay [trace.json]
+    if len(sys.argv) > 1 and sys.argv[1] == 'replay':
+        if len(sys.argv) > 2:
+            with open(sys.argv[2]) as f: trace = json.load(f)
+        else:
+            trace = random_trace()
+        print_replay(trace)
+    else:
+        unittest.main()
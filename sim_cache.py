@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+
+# Persistent cache of simulation results
+# Results are stored as small json files, named after a key computed from the svg and the plot options
+# The cache is bounded by number of entries; least recently used entries are evicted first
+
+VERSION = 2 # increase when the format of the cached results changes
+
+class Cache:
+    def __init__(self, folder, max_entries = 1000):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._count = None # number of entries on disk (counted lazily)
+    
+    # Compute a cache key from the svg (str or bytes, or its digest) and options that influence the simulation result
+    def key(self, svg, **options):
+        h = hashlib.sha1()
+        h.update(json.dumps([VERSION, options], sort_keys=True).encode('utf-8'))
+        h.update(svg.encode('utf-8') if isinstance(svg, str) else svg)
+        return h.hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.json')
+    
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f: result = json.load(f)
+            os.utime(path) # mark as recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+    
+    def put(self, key, result):
+        path = self._path(key)
+        os.makedirs(self.folder, exist_ok=True)
+        exists = os.path.isfile(path)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(result, f)
+        os.replace(tmp, path)
+        if not exists:
+            if self._count == None: self._count = len(self._entries())
+            else: self._count += 1
+        if self._count > self.max_entries: self.evict()
+    
+    def _entries(self):
+        try:
+            return [ x for x in os.scandir(self.folder) if x.name.endswith('.json') ]
+        except FileNotFoundError:
+            return []
+    
+    # Remove least recently used entries until the cache holds at most max_entries
+    def evict(self):
+        entries = self._entries()
+        if len(entries) > self.max_entries:
+            entries.sort(key=lambda x: x.stat().st_mtime)
+            for entry in entries[:len(entries) - self.max_entries]:
+                try: os.remove(entry.path)
+                except OSError: pass
+            entries = entries[len(entries) - self.max_entries:]
+        self._count = len(entries)
+    
+    def clear(self):
+        for entry in self._entries():
+            try: os.remove(entry.path)
+            except OSError: pass
+        self._count = 0
+    
+    def __len__(self):
+        if self._count == None: self._count = len(self._entries())
+        return self._count
+
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            self.cache = Cache(os.path.join(self.tmp.name, 'cache'), max_entries = 3)
+        
+        def tearDown(self):
+            self.tmp.cleanup()
+        
+        def test_key(self):
+            c = self.cache
+            self.assertEqual( c.key('<svg/>', speed=100), c.key(b'<svg/>', speed=100) )
+            self.assertNotEqual( c.key('<svg/>', speed=100), c.key('<svg/>', speed=90) )
+            self.assertNotEqual( c.key('<svg/>', speed=100), c.key('<svg />', speed=100) )
+            self.assertEqual( c.key('<svg/>', a=1, b=2), c.key('<svg/>', b=2, a=1) )
+        
+        def test_get_put(self):
+            c = self.cache
+            key = c.key('<svg/>', speed=100)
+            self.assertEqual(c.get(key), None)
+            c.put(key, {'time_estimate': 12.5, 'layers': 2})
+            self.assertEqual(c.get(key), {'time_estimate': 12.5, 'layers': 2})
+            self.assertEqual((c.hits, c.misses), (1, 1))
+            # persistent
+            self.assertEqual(Cache(c.folder).get(key), {'time_estimate': 12.5, 'layers': 2})
+        
+        def test_overwrite(self):
+            c = self.cache
+            c.put('a', 1)
+            c.put('a', 2)
+            self.assertEqual(c.get('a'), 2)
+            self.assertEqual(len(c), 1)
+        
+        def test_eviction(self):
+            c = self.cache
+            for i, key in enumerate(['a', 'b', 'c']):
+                c.put(key, i)
+                os.utime(c._path(key), (i, i)) # deterministic access times
+            c.get('a') # a is now the most recently used
+            c.put('d', 3)
+            self.assertEqual(len(c), 3)
+            self.assertEqual(c.get('b'), None)
+            self.assertEqual([ c.get(key) for key in ['a', 'c', 'd'] ], [0, 2, 3])
+        
+        def test_clear(self):
+            c = self.cache
+            c.put('a', 1)
+            c.clear()
+            self.assertEqual(len(c), 0)
+            self.assertEqual(c.get('a'), None)
+    
+    unittest.main()
@@ -0,0 +1,212 @@
+import asyncio
+import multiprocessing
+import importlib
+import os
+import sys
+
+# A pool of warm worker processes for running (CPU heavy) functions off the main process
+# Workers import the modules given in preload on startup, so the first job doesn't pay for it
+# A worker that doesn't finish its job within the timeout is killed and replaced
+
+def _worker_main(conn, preload, quiet):
+    if quiet:
+        # don't let workers write into the terminal of the main process (i.e. the Textual UI)
+        devnull = open(os.devnull, 'w')
+        sys.stdout = devnull
+        sys.stderr = devnull
+    for module in preload:
+        importlib.import_module(module)
+    conn.send(('ready', os.getpid()))
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task == None: break # shutdown
+        fn, args, kwargs = task
+        try:
+            result = ('ok', fn(*args, **kwargs))
+        except Exception as e:
+            result = ('error', e)
+        try:
+            conn.send(result)
+        except Exception as e: # result or exception not picklable
+            conn.send(( 'error', RuntimeError(f'Cannot return result from worker: {e}') ))
+
+class Worker:
+    def __init__(self, ctx, preload, quiet):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, preload, quiet), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+    
+    # receive the next message from the worker without blocking the event loop
+    async def recv(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        fd = self.conn.fileno()
+        
+        def on_readable():
+            loop.remove_reader(fd)
+            if future.done(): return
+            try:
+                future.set_result(self.conn.recv())
+            except Exception as e: # EOFError if the worker died
+                future.set_exception(e)
+        
+        loop.add_reader(fd, on_readable)
+        try:
+            return await future
+        finally:
+            loop.remove_reader(fd)
+    
+    # wait for the worker to finish preloading
+    async def started(self):
+        if not self.ready:
+            await self.recv()
+            self.ready = True
+    
+    async def run(self, fn, args, kwargs):
+        self.conn.send((fn, args, kwargs))
+        status, result = await self.recv()
+        if status == 'error': raise result
+        return result
+    
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+    
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(1)
+        if self.process.is_alive(): self.process.kill()
+        self.conn.close()
+
+class Pool:
+    def __init__(self, size = None, preload = [], quiet = True):
+        self.size = size if size != None else (os.cpu_count() or 1)
+        self.preload = list(preload)
+        self.quiet = quiet
+        # spawn fresh interpreters; forking a process with running threads (Textual, to_thread) is unsafe
+        self.ctx = multiprocessing.get_context('spawn')
+        self.workers = []
+        self.idle = None
+        self.closed = False
+    
+    def start(self):
+        if self.idle != None: return
+        self.idle = asyncio.Queue()
+        for i in range(self.size):
+            self._spawn()
+    
+    def _spawn(self):
+        worker = Worker(self.ctx, self.preload, self.quiet)
+        self.workers.append(worker)
+        self.idle.put_nowait(worker)
+    
+    def _replace(self, worker):
+        worker.kill()
+        self.workers.remove(worker)
+        if not self.closed: self._spawn()
+    
+    # number of jobs currently running
+    def busy(self):
+        if self.idle == None: return 0
+        return len(self.workers) - self.idle.qsize()
+    
+    # Run fn(*args, **kwargs) in a worker process
+    # fn, args and the return value need to be picklable
+    # Raises TimeoutError if the job takes longer than timeout seconds (waiting for a free worker is not counted)
+    async def run(self, fn, *args, timeout = None, **kwargs):
+        if self.closed: raise RuntimeError('Pool is closed')
+        self.start()
+        worker = await self.idle.get()
+        try:
+            await worker.started()
+            async with asyncio.timeout(timeout):
+                result = await worker.run(fn, args, kwargs)
+        except BaseException as e:
+            # worker is in an unknown state (timeout, cancellation, crash): kill it and start a fresh one
+            # exceptions raised by fn itself are passed through from the worker, which stays usable
+            if isinstance(e, Exception) and worker.process.is_alive() and not isinstance(e, (TimeoutError, EOFError, OSError)):
+                self.idle.put_nowait(worker)
+            else:
+                self._replace(worker)
+            raise
+        self.idle.put_nowait(worker)
+        return result
+    
+    def close(self):
+        self.closed = True
+        for worker in self.workers: worker.stop()
+        self.workers = []
+
+
+if __name__ == '__main__':
+    import unittest
+    import time
+    import operator
+    
+    # Note: functions run in the pool need to be importable by the workers,
+    # so the tests use functions from the standard library
+    
+    class Test(unittest.IsolatedAsyncioTestCase):
+        async def asyncSetUp(self):
+            self.pool = Pool(2)
+        
+        async def asyncTearDown(self):
+            self.pool.close()
+        
+        async def test_run(self):
+            self.assertEqual( await self.pool.run(operator.add, 1, 2), 3 )
+            self.assertEqual( await self.pool.run(sorted, [3, 1, 2], reverse=True), [3, 2, 1] )
+        
+        async def test_runs_in_other_process(self):
+            pid = await self.pool.run(os.getpid)
+            self.assertNotEqual(pid, os.getpid())
+        
+        async def test_exception(self):
+            with self.assertRaises(ZeroDivisionError):
+                await self.pool.run(operator.truediv, 1, 0)
+            self.assertEqual( await self.pool.run(operator.add, 1, 2), 3 ) # still usable
+        
+        async def test_concurrent(self):
+            await asyncio.gather( self.pool.run(time.sleep, 0), self.pool.run(time.sleep, 0) ) # warm up
+            start = time.monotonic()
+            await asyncio.gather( self.pool.run(time.sleep, 0.5), self.pool.run(time.sleep, 0.5) )
+            self.assertLess(time.monotonic() - start, 0.9)
+        
+        async def test_queueing(self):
+            await asyncio.gather( self.pool.run(time.sleep, 0), self.pool.run(time.sleep, 0) ) # warm up
+            start = time.monotonic()
+            await asyncio.gather( *[self.pool.run(time.sleep, 0.25) for i in range(4)] )
+            self.assertGreater(time.monotonic() - start, 0.45)
+            self.assertEqual(self.pool.busy(), 0)
+        
+        async def test_timeout_kills_worker(self):
+            pids = set( await asyncio.gather(*[ self.pool.run(os.getpid) for i in range(4) ]) )
+            start = time.monotonic()
+            with self.assertRaises(TimeoutError):
+                await self.pool.run(time.sleep, 10, timeout=0.5)
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(len(self.pool.workers), 2)
+            for worker in self.pool.workers: self.assertTrue(worker.process.is_alive())
+            # the killed worker has been replaced
+            new_pids = set( await asyncio.gather(*[ self.pool.run(os.getpid) for i in range(4) ]) )
+            self.assertEqual(len(new_pids), 2)
+            self.assertNotEqual(pids, new_pids)
+        
+        async def test_cancel_kills_worker(self):
+            task = asyncio.create_task( self.pool.run(time.sleep, 10) )
+            await asyncio.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError): await task
+            self.assertEqual(len(self.pool.workers), 2)
+            self.assertEqual(self.pool.busy(), 0)
+    
+    unittest.main()
@@ -0,0 +1,176 @@
+import os
+import re
+import concurrent.futures
+import xml.etree.ElementTree as ElementTree
+import digest
+from job import Job
+
+# Loading waiting jobs from their spool files, when resuming the queue (see spooler.resume_queue_from_disk)
+# A job only needs the tg: attributes of the root element of its svg, so only the start of each file is parsed,
+# incrementally until the root element has been read. The digest is part of the file name of waiting jobs
+# (see spooler.waiting_name), the rest of the svg is read when it is needed (see Job.svg)
+# Files with other names (e.g. saved by earlier versions) are read in full to compute their digest
+# Files are loaded by a pool of threads, most of the time is spent waiting for the disk
+
+NS = 'https://sketch.process.studio/turtle-graphics'
+WAITING_NAME = re.compile(r'([0-9a-f]{16,})_\[') # digest at the start of the file name
+
+# Attributes of the root element of an xml file (a path or a binary file object)
+def read_header(file, chunk_size = 4096):
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, 'rb') as f: return read_header(f, chunk_size)
+    parser = ElementTree.XMLPullParser(['start'])
+    while True:
+        data = file.read(chunk_size)
+        if not data: raise ValueError('No root element')
+        parser.feed(data)
+        if hasattr(parser, 'flush'): parser.flush() # newer versions of expat wait for more data before parsing large tags
+        for event, element in parser.read_events(): return dict(element.attrib)
+
+# Job from the attributes of the root element of its svg (without the svg and its digest)
+# Raises TypeError or ValueError if an attribute is missing or invalid
+def attributes_to_job(attrs, filename = None):
+    def attr(name):
+        return attrs.get('{' + NS + '}' + name)
+    
+    received_ts = None
+    if filename != None:
+        match = re.search('\\d{8}_\\d{6}', os.path.basename(filename))
+        if match != None: received_ts = match.group(0)
+    
+    return Job({
+        'loaded_from_file': True,
+        'client': attr('author'),
+        'id': "XYZ",
+        'stats': {
+            'count': int(attr('count')),
+            'layer_count': int(attr('layer_count')),
+            'oob_count': int(attr('oob_count')),
+            'short_count': int(attr('short_count')),
+            'travel': int(attr('travel')),
+            'travel_ink': int(attr('travel_ink')),
+            'travel_blank': int(attr('travel_blank'))
+        },
+        'timestamp': attr('timestamp'),
+        'speed': int(attr('speed')),
+        'format': attr('format'),
+        'size': [int(attr('width_mm')), int(attr('height_mm'))],
+        'received': received_ts,
+        'save_path': filename,
+    })
+
+def svg_to_job(svg, filename = None, algorithm = None):
+    job = attributes_to_job(ElementTree.fromstring(svg).attrib, filename)
+    job['svg'] = svg
+    job['hash'] = digest.digest(svg, algorithm)
+    return job
+
+# Job of a spool file, the svg is only read if its digest isn't in the file name
+def load(path, algorithm = None):
+    match = WAITING_NAME.match(os.path.basename(path))
+    if match != None:
+        job = attributes_to_job(read_header(path), path)
+        job['hash'] = match.group(1)
+    else:
+        with open(path, 'r', encoding='utf-8') as f: svg = f.read()
+        job = svg_to_job(svg, path, algorithm)
+    job.spooled(path) # don't keep all svgs in memory
+    return job
+
+# Load spool files in parallel. Returns the job, or the exception raised while loading it, for each file (in order)
+def load_all(paths, workers = 8, algorithm = None):
+    def _load(path):
+        try:
+            return load(path, algorithm)
+        except Exception as e:
+            return e
+    
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix = 'spool reader') as pool:
+        return list(pool.map(_load, paths))
+
+
+SVG = '''<!-- Created with tg-plot (v4) -->
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:tg="https://sketch.process.studio/turtle-graphics"
+     tg:version="4" tg:count="1" tg:layer_count="3" tg:oob_count="0" tg:short_count="0" tg:travel="1762" tg:travel_ink="1236" tg:travel_blank="525" tg:format="A4 Landscape" tg:width_mm="297" tg:height_mm="210" tg:speed="100" tg:author="" tg:timestamp="20241010_210810.915_UTC+1"
+     width="297mm" height="210mm" viewBox="-148.5 -105 297 210">
+<path d="M 0 0 L 1 1" />
+</svg>
+'''
+
+# Startup with a spool folder of n waiting jobs: reading and parsing each svg in full (one after another),
+# or only the root elements (in parallel)
+def benchmark(n = 1000, svg_size = 200_000):
+    import tempfile
+    import time
+    body = '<path d="' + 'M 0 0 L 1 1 ' * (svg_size // 12) + '" />\n</svg>'
+    
+    with tempfile.TemporaryDirectory() as folder:
+        paths = []
+        for i in range(n):
+            svg = SVG.replace('tg:author=""', f'tg:author="client-{i}"').replace('</svg>', body)
+            path = os.path.join(folder, f'{digest.digest(svg)}_[client-{i}].svg')
+            with open(path, 'w', encoding='utf-8') as f: f.write(svg)
+            paths.append(path)
+        
+        start = time.perf_counter()
+        for path in paths:
+            with open(path, 'r', encoding='utf-8') as f: svg_to_job(f.read(), path)
+        t_full = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        jobs = load_all(paths)
+        t_header = time.perf_counter() - start
+        assert all( isinstance(job, Job) for job in jobs )
+        print(f'{n} jobs with {svg_size // 1000} kB svgs: full parse {t_full*1000:.0f} ms, header only {t_header*1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    import tempfile
+    
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            self.svg = SVG.replace('tg:author=""', 'tg:author="abc"')
+        
+        def tearDown(self):
+            self.tmp.cleanup()
+        
+        def write(self, name, svg):
+            path = os.path.join(self.tmp.name, name)
+            with open(path, 'w', encoding='utf-8') as f: f.write(svg)
+            return path
+        
+        def test_header(self):
+            path = self.write('a.svg', self.svg)
+            self.assertEqual(read_header(path, chunk_size = 16)['{' + NS + '}author'], 'abc')
+            with self.assertRaises(ElementTree.ParseError): read_header(self.write('b.svg', 'not xml'))
+            with self.assertRaises(ValueError): read_header(self.write('c.svg', ''))
+        
+        def test_load(self):
+            svg_digest = digest.digest(self.svg)
+            path = self.write(f'{svg_digest}_[abc].svg', self.svg)
+            job = load(path)
+            self.assertTrue(job.is_spooled())
+            self.assertEqual((job['client'], job['hash'], job['speed'], job['stats']['layer_count']), ('abc', svg_digest, 100, 3))
+            self.assertEqual(job['svg'], self.svg)
+            full = svg_to_job(self.svg, path)
+            self.assertEqual({ k: full[k] for k in full.keys() if k != 'svg' }, { k: job[k] for k in job.keys() if k != 'svg' })
+        
+        def test_old_names(self):
+            path = self.write('001_20241010_210810.915_[abc]_12345.svg', self.svg)
+            job = load(path, 'sha1')
+            self.assertEqual((job['hash'], job['received']), (digest.digest(self.svg, 'sha1'), '20241010_210810'))
+        
+        def test_load_all(self):
+            paths = [ self.write(f'{i:040x}_[abc].svg', self.svg) for i in range(20) ]
+            paths.insert(3, self.write(f'{0:040x}_[bad].svg', self.svg.replace('tg:speed="100"', '')))
+            jobs = load_all(paths, workers = 4)
+            self.assertEqual([ job['hash'] for job in jobs if isinstance(job, Job) ], [ f'{i:040x}' for i in range(20) ])
+            self.assertIsInstance(jobs[3], TypeError)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
@@ -0,0 +1,295 @@
+import os
+import threading
+import time
+
+# Background writer for the spool folders (see spooler.save_svg)
+# save() only records where the svg of a job should be. The file operations (renaming the previous file or writing
+# the svg) happen in a separate thread, so they don't block the event loop. Pending saves of the same job are
+# coalesced: only the last filename counts, and the file is moved or written once
+# New files are written to a temporary file and renamed, so there are never partial svgs in the spool folders.
+# With fsync, each batch of files is synced before renaming them, and the directories once per batch
+# Until its file is in place, a job keeps its svg in memory or at its previous path (see Job.spooled). Files are
+# moved by linking them first, so the path of a job always points to an existing file
+
+class SpoolWriter:
+    def __init__(self, maxsize = 1000, fsync = True, on_error = None):
+        self.maxsize = maxsize # max. number of jobs with pending saves, save() blocks when there are more
+        self.fsync = fsync
+        self.on_error = on_error # on_error(job, exception), called in the writer thread
+        self.pending = {} # id(job) -> [job, filename, overwrite, time of the first save]
+        self.writing = {} # the batch being written, same as pending
+        self.cond = threading.Condition()
+        self.thread = None
+        self.closing = False
+        self.counts = { 'saved': 0, 'coalesced': 0, 'written': 0, 'moved': 0, 'batches': 0, 'errors': 0 }
+        self.latency = { 'total': 0, 'max': 0, 'count': 0 } # seconds from save() until the file is in place
+        self.max_backlog = 0
+    
+    def start(self):
+        with self.cond:
+            if self.thread != None: return
+            self.closing = False
+            self.thread = threading.Thread(target = self._run, name = 'spool writer', daemon = True)
+            self.thread.start()
+    
+    # Save the svg of a job at filename (replacing the file if overwrite is set)
+    def save(self, job, filename, overwrite = False):
+        self.start()
+        key = id(job)
+        with self.cond:
+            while len(self.pending) >= self.maxsize and key not in self.pending: self.cond.wait()
+            self.counts['saved'] += 1
+            if key in self.pending:
+                entry = self.pending[key]
+                entry[1] = filename
+                entry[2] = entry[2] or overwrite
+                self.counts['coalesced'] += 1
+            else:
+                self.pending[key] = [job, filename, overwrite, time.perf_counter()]
+                self.max_backlog = max(self.max_backlog, len(self.pending))
+            self.cond.notify_all()
+    
+    # Filename of the pending save of a job, None if there is none
+    def target(self, job):
+        with self.cond:
+            entry = self.pending.get(id(job)) or self.writing.get(id(job))
+            return entry[1] if entry != None else None
+    
+    # Wait until all pending saves are done
+    def flush(self):
+        with self.cond:
+            while self.pending or self.writing: self.cond.wait()
+    
+    def close(self):
+        if self.thread == None: return
+        self.flush()
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.thread = None
+    
+    def stats(self):
+        with self.cond:
+            return dict(self.counts,
+                backlog = len(self.pending) + len(self.writing),
+                max_backlog = self.max_backlog,
+                latency_avg = self.latency['total'] / self.latency['count'] if self.latency['count'] > 0 else 0,
+                latency_max = self.latency['max'])
+    
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closing: self.cond.wait()
+                if not self.pending: return # closing
+                self.writing, self.pending = self.pending, {}
+                self.cond.notify_all() # room for new saves
+                batch = list(self.writing.values())
+            self._write_batch(batch)
+            with self.cond:
+                self.writing = {}
+                self.counts['batches'] += 1
+                self.cond.notify_all()
+    
+    def _done(self, entry):
+        t = time.perf_counter() - entry[3]
+        with self.cond:
+            self.latency['total'] += t
+            self.latency['count'] += 1
+            self.latency['max'] = max(self.latency['max'], t)
+    
+    def _error(self, entry, e):
+        with self.cond: self.counts['errors'] += 1
+        if callable(self.on_error): self.on_error(entry[0], e)
+    
+    # move the file of a job from src to dst: the job's path changes once the file is at dst, and it stays readable
+    def _move(self, job, src, dst):
+        try:
+            os.link(src, dst)
+        except OSError: # e.g. dst exists, or hard links aren't supported
+            os.replace(src, dst)
+            job.spooled(dst)
+            return
+        job.spooled(dst)
+        os.remove(src)
+    
+    def _write_batch(self, batch):
+        written = [] # (entry, tmp file, svg that was written)
+        dirs = set() # directories to sync
+        for entry in batch:
+            job, filename, overwrite, _ = entry
+            try:
+                previous = job.get('save_path')
+                os.makedirs(os.path.dirname(filename) or '.', exist_ok = True)
+                if job.is_spooled() and previous != filename and os.path.isfile(previous):
+                    self._move(job, previous, filename) # position, estimate or status changed, rename instead of writing the svg again
+                    dirs.update([ os.path.dirname(previous), os.path.dirname(filename) ])
+                    self.counts['moved'] += 1
+                elif overwrite or not os.path.isfile(filename):
+                    svg = job['svg'] # before writing, it might be read from the file
+                    tmp = filename + '.tmp'
+                    with open(tmp, 'w', encoding='utf-8') as f:
+                        f.write(svg)
+                        if self.fsync:
+                            f.flush()
+                            os.fsync(f.fileno())
+                    written.append((entry, tmp, svg))
+                    continue
+                else:
+                    if previous != None and previous != filename and os.path.isfile(previous): os.remove(previous)
+                    job.spooled(filename)
+                self._done(entry)
+            except Exception as e:
+                self._error(entry, e)
+        
+        # rename the new files into place, after all of them are synced
+        for entry, tmp, svg in written:
+            job, filename = entry[0], entry[1]
+            try:
+                previous = job.get('save_path')
+                os.replace(tmp, filename)
+                job.spooled(filename, svg)
+                if previous != None and previous != filename and os.path.isfile(previous): os.remove(previous)
+                dirs.add(os.path.dirname(filename))
+                self.counts['written'] += 1
+                self._done(entry)
+            except Exception as e:
+                self._error(entry, e)
+        
+        if self.fsync:
+            for folder in dirs: _sync_dir(folder)
+
+def _sync_dir(folder):
+    try:
+        fd = os.open(folder or '.', os.O_RDONLY)
+    except OSError:
+        return # e.g. directories can't be opened on windows
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+# Time the event loop is blocked by a burst of new jobs, and when all of them are renamed
+# (e.g. after moving the last job to the top), saving directly or with the spool writer
+def benchmark(n = 1000, svg_size = 200_000):
+    import tempfile
+    from job import Job
+    svg = '<svg>' + 'M 0 0 L 1 1 ' * (svg_size // 12) + '</svg>'
+    
+    with tempfile.TemporaryDirectory() as folder:
+        for name in ['blocking', 'spool writer']:
+            writer = SpoolWriter(maxsize = n)
+            jobs = [ Job(client = f'client-{i}', svg = svg + str(i)) for i in range(n) ]
+            for step in ['new', 'rename']:
+                start = time.perf_counter()
+                for i, job in enumerate(jobs):
+                    position = i if step == 'new' else (i + 1) % n # all positions change
+                    filename = os.path.join(folder, name, f'{position:03}_{job["client"]}.svg')
+                    if name == 'spool writer':
+                        writer.save(job, filename)
+                    elif step == 'new':
+                        os.makedirs(os.path.dirname(filename), exist_ok = True)
+                        with open(filename, 'w', encoding='utf-8') as f: f.write(job['svg'])
+                        job.spooled(filename)
+                    else:
+                        os.replace(job['save_path'], filename)
+                        job.spooled(filename)
+                t_block = time.perf_counter() - start
+                writer.flush()
+                t_total = time.perf_counter() - start
+                print(f'{name:<12} {n} jobs {step:<6}: event loop blocked {t_block*1000:7.1f} ms, files in place after {t_total*1000:7.1f} ms')
+            stats = writer.stats()
+            writer.close()
+            if name == 'spool writer':
+                print(f'{stats["batches"]} batches, {stats["coalesced"]} coalesced, average latency {stats["latency_avg"]*1000:.1f} ms, max. {stats["latency_max"]*1000:.1f} ms')
+
+if __name__ == '__main__':
+    import sys
+    import unittest
+    import tempfile
+    from job import Job
+    
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            self.folder = self.tmp.name
+            self.errors = []
+            self.writer = SpoolWriter(on_error = lambda job, e: self.errors.append(e))
+        
+        def tearDown(self):
+            self.writer.close()
+            self.tmp.cleanup()
+        
+        def path(self, name):
+            return os.path.join(self.folder, name)
+        
+        def read(self, name):
+            with open(self.path(name), 'r', encoding='utf-8') as f: return f.read()
+        
+        def files(self):
+            return sorted( os.path.relpath(os.path.join(root, x), self.folder) for root, dirs, names in os.walk(self.folder) for x in names )
+        
+        def test_write_and_rename(self):
+            job = Job(client = 'a', svg = '<svg>a</svg>')
+            self.writer.save(job, self.path('waiting/1.svg'))
+            self.writer.flush()
+            self.assertEqual(self.read('waiting/1.svg'), '<svg>a</svg>')
+            self.assertTrue(job.is_spooled())
+            self.writer.save(job, self.path('finished/1.svg'))
+            self.writer.flush()
+            self.assertEqual(self.files(), ['finished/1.svg'])
+            self.assertEqual(job['svg'], '<svg>a</svg>')
+            self.assertEqual(self.writer.stats()['written'], 1)
+            self.assertEqual(self.writer.stats()['moved'], 1)
+        
+        def test_coalesce(self):
+            jobs = [ Job(client = str(i), svg = f'<svg>{i}</svg>') for i in range(3) ]
+            with self.writer.cond: # hold the writer back until all saves are pending
+                for i in range(10):
+                    for job in jobs: self.writer.save(job, self.path(f'{i}_{job["client"]}.svg'))
+                self.assertEqual(self.writer.target(jobs[0]), self.path('9_0.svg'))
+            self.writer.flush()
+            self.assertEqual(self.files(), ['9_0.svg', '9_1.svg', '9_2.svg'])
+            stats = self.writer.stats()
+            self.assertEqual((stats['saved'], stats['coalesced'], stats['written'], stats['backlog']), (30, 27, 3, 0))
+            self.assertEqual(self.writer.target(jobs[0]), None)
+        
+        def test_overwrite(self):
+            job = Job(client = 'a', svg = '<svg>a</svg>')
+            self.writer.save(job, self.path('1.svg'))
+            self.writer.flush()
+            job['svg'] = '<svg>b</svg>'
+            self.writer.save(job, self.path('1.svg'), overwrite = True)
+            self.writer.flush()
+            self.assertEqual(self.read('1.svg'), '<svg>b</svg>')
+        
+        def test_no_temp_files(self):
+            job = Job(client = 'a', svg = '<svg>a</svg>')
+            self.writer.save(job, self.path('1.svg'))
+            self.writer.flush()
+            self.assertFalse(any( x.endswith('.tmp') for x in self.files() ))
+        
+        def test_error(self):
+            job = Job(client = 'a', svg = '<svg>a</svg>')
+            with open(self.path('file'), 'w') as f: f.write('')
+            self.writer.save(job, self.path('file/1.svg')) # not a directory
+            self.writer.flush()
+            self.assertEqual(len(self.errors), 1)
+            self.assertEqual(self.writer.stats()['errors'], 1)
+            self.assertEqual(job['svg'], '<svg>a</svg>') # still in memory
+        
+        def test_backpressure(self):
+            writer = SpoolWriter(maxsize = 2)
+            jobs = [ Job(client = str(i), svg = f'<svg>{i}</svg>') for i in range(20) ]
+            for job in jobs: writer.save(job, self.path(f'{job["client"]}.svg'))
+            writer.close()
+            self.assertLessEqual(writer.stats()['max_backlog'], 2)
+            self.assertEqual(len(self.files()), 20)
+    
+    if len(sys.argv) > 1 and sys.argv[1] == 'bench':
+        benchmark()
+    else:
+        unittest.main()
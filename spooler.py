@@ -8,6 +8,37 @@ PEN_POS_UP = 60 # Default: 60
 PEN_POS_DOWN = 40 # Default: 40
 MIN_SPEED = 10 # percent
 SIMULATION_TIMEOUT = 8 # seconds
+SIMULATION_WORKERS = 2 # number of worker processes for simulating jobs (None: number of CPU cores)
+SIMULATION_CACHE = 'svgs/.simulation_cache' # folder for caching simulation results (None to disable)
+SIMULATION_CACHE_SIZE = 2000 # max. number of cached simulation results
+FAST_ESTIMATE = True # Queue new jobs with an analytic time estimate, and refine it with a simulation in the background
+SIMULATION_CONCURRENCY = 2 # number of new jobs that are validated and simulated at the same time
+SIMULATION_MAX_PENDING = 20 # max. number of new jobs waiting for validation, more are rejected
+DIGEST_ALGORITHM = None # xxh3_128 (needs xxhash) | sha1 | blake2b, None: fastest available (see digest.py)
+UPLOAD_FOLDER = 'svgs/.uploads' # folder for chunked uploads in progress (see uploads.py)
+SPOOL_FSYNC = True # sync spool files to disk before renaming them into place (see spool_writer.py)
+SPOOL_MAX_PENDING = 1000 # max. number of jobs with pending spool file writes, saving blocks when there are more
+QUEUE_JOURNAL = 'svgs/0_waiting/queue.journal' # order and state of the waiting jobs, for resuming them after a restart (see journal.py)
+JOURNAL_FSYNC = False # sync the journal after each change (safer on power loss, but slower)
+RESUME_WORKERS = 8 # threads reading the waiting spool files when resuming the queue (see spool_reader.py)
+OUTPUT_FOLDER = 'svgs/.output' # output svgs of paused plots, for continuing them after a restart
+ARCHIVE_AFTER = None # days, finished, canceled and failed spool files older than this are moved into the archive (None: keep them, see archive.py)
+ARCHIVE_FOLDER = 'svgs/4_archive' # compressed segments and index of archived spool files
+PLOTTERS = [None] # AxiDraw ports or nicknames, each plotter gets its own worker taking jobs from the queue (None: first plotter found)
+CLEANUP_PATHS = False # Join touching strokes, simplify collinear runs and drop tiny fragments of new jobs (see cleanup.py)
+CLEANUP_JOIN = 0.02 # mm, strokes whose ends are closer than this are joined
+CLEANUP_SIMPLIFY = 0.01 # mm, points closer than this to a straight line are removed
+CLEANUP_MIN_LENGTH = 0.02 # mm, shorter strokes are dropped (None: keep them, e.g. for stippling)
+OPTIMIZE_TRAVEL = False # Reorder strokes of new jobs to reduce pen-up travel (see optimize.py)
+OPTIMIZE_REVERSE = True # Strokes may be plotted in reverse direction when optimizing
+OPTIMIZE_TIME_LIMIT = 5 # seconds per job, the best order found so far is used after that
+GANG_JOBS = False # Plot small waiting jobs together on one sheet, if they have the same format and pen (see geometry.py)
+GANG_MAX_JOBS = 4 # max. number of jobs on a sheet
+GANG_MARGIN = 10 # mm, border of the sheet that is kept free
+GANG_SPACING = 5 # mm, between jobs on a sheet
+GANG_LOOKAHEAD = 20 # number of waiting jobs that are considered for a sheet
+SCHEDULING_POLICY = 'fifo' # which job is plotted next: fifo | sjf (shortest first) | fair (per client) | format (fewer paper changes), see scheduler.py. Queue positions and expected start times sent to clients assume fifo
+ETA_NOTIFY_CHANGE = 60 # seconds, clients are sent a new expected start time if it changes by more than this (or their position changes)
 
 STATUS_FOLDERS = {
     'waiting'  : 'svgs/0_waiting',
@@ -42,18 +73,67 @@ import math
 import os
 from capture_output import capture_output
 import re
-import hashlib
+import digest
 import async_queue
-import xml.etree.ElementTree as ElementTree
+import sim_pool
+import sim_cache
+import estimate
+import ingest
+import admission
+import scheduler
+import geometry
+import optimize
+import cleanup
+import spool_writer
+import journal
+import spool_reader
+import archive
+import atexit
+from job import Job
+import concurrent.futures
 
 
 queue_size_cb = None
+_scheduler = scheduler.create(SCHEDULING_POLICY)
 # queue = asyncio.Queue() # an async FIFO queue
-queue = async_queue.Queue() # an async FIFO queue that can be reordered
-_jobs = {} # an index to all unfinished jobs by client id (in queue or _current_job)
-_current_job = None
-_status = 'waiting' # waiting | confirm_plot | plotting
-
+queue = async_queue.Queue(pick = _scheduler.pick, weight = lambda job: job.get('time_estimate', 0)) # an async queue that can be reordered, the scheduling policy picks the next job, sums up time estimates
+_jobs = {} # an index to all unfinished jobs by client id (in queue or current job of a plotter)
+_simulation_pool = None
+_simulation_cache = sim_cache.Cache(SIMULATION_CACHE, SIMULATION_CACHE_SIZE) if SIMULATION_CACHE != None else None
+_admission = admission.Admission(SIMULATION_CONCURRENCY, SIMULATION_MAX_PENDING)
+_loop = None # event loop of the spooler (set in start)
+
+# A connected AxiDraw with its worker loop (see run_plotter)
+class Plotter:
+    def __init__(self, index, port = None):
+        self.index = index
+        self.port = port # usb port or nickname, None: first plotter found
+        self.name = port if port != None else f'Plotter {index + 1}'
+        self.job = None # current job
+        self.status = 'waiting' # waiting | confirm_plot | plotting | paused
+        self.ad = None # AxiDraw instance while plotting (for request_plot_pause)
+
+_plotters = [ Plotter(i, port) for i, port in enumerate(PLOTTERS) ]
+
+# separate threads for estimating and cache io, so a burst of new jobs doesn't delay plotter commands in the default executor
+_simulation_executor = concurrent.futures.ThreadPoolExecutor(SIMULATION_CONCURRENCY, thread_name_prefix = 'simulation')
+_positions_changed = None # [start, end] range of positions (indices in jobs()) to notify, end None: until the end of the queue
+_positions_task = None # task sending the pending position notifications
+_notification_counts = { 'changes': 0, 'flushes': 0, 'sent': 0 }
+_sheet_count = 0 # number of sheets ganged so far (for naming them)
+_num_sheets = 0 # sheets in _jobs
+
+
+# Spool files are written in the background (see save_svg), errors are printed from the event loop
+def _spool_error(job, e):
+    message = f'⚠️  [red]Error saving job \\[{job["client"]}]: {e}'
+    if _loop != None: _loop.call_soon_threadsafe(lambda: print(message))
+    else: print(message)
+
+_spool_writer = spool_writer.SpoolWriter(SPOOL_MAX_PENDING, SPOOL_FSYNC, on_error = _spool_error)
+atexit.register(_spool_writer.close) # write pending files before exiting
+_journal = journal.Journal(QUEUE_JOURNAL, JOURNAL_FSYNC)
+_archive = archive.Archive(ARCHIVE_FOLDER, algorithm = DIGEST_ALGORITHM)
 
 # Helper function calls async function fn with args
 # Returns a coroutine (because of async def)
@@ -61,6 +141,14 @@ async def callback(fn, *args, **kwargs):
     if callable(fn):
         await fn(*args, **kwargs)
 
+# Run a coroutine in the background. The event loop only keeps weak references to tasks, so they are kept here until done
+_background_tasks = set()
+def background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 # async def _notify_queue_positions():
 #     cbs = []
 #     for i, client in enumerate(_jobs):
@@ -71,15 +159,52 @@ async def callback(fn, *args, **kwargs):
 #             cbs.append( callback(job['queue_position_cb'], i, job) )
 #     await asyncio.gather(*cbs) # run callbacks concurrently
 
-async def _notify_queue_positions():
+# Notify jobs in the range of positions start..end-1 (end None: until the end of the queue) of their queue position
+# and expected start time (job['eta'], see eta). Mutations pass the range of positions they shifted (or whose start time
+# changed). Notifications are sent by a separate task, so the ranges of all mutations within the same tick are merged,
+# and each job is notified at most once
+async def _notify_queue_positions(start = 0, end = None):
+    global _positions_changed, _positions_task
+    _notification_counts['changes'] += 1
+    if _positions_changed == None:
+        _positions_changed = [start, end]
+    else:
+        _positions_changed[0] = min(_positions_changed[0], start)
+        if _positions_changed[1] != None: _positions_changed[1] = None if end == None else max(_positions_changed[1], end)
+    if _positions_task == None: _positions_task = asyncio.create_task( _send_queue_positions() )
+
+# Positions and expected start times are in queue order (see eta)
+async def _send_queue_positions():
+    global _positions_changed, _positions_task
+    await asyncio.sleep(0) # collect changes of the current tick
+    start, end = _positions_changed
+    _positions_changed = None
+    _positions_task = None
+    
+    current = current_jobs()
+    offset = len(current)
+    end = queue.qsize() + offset if end == None else min(end, queue.qsize() + offset)
+    ahead = _current_time() + queue.prefix(min(max(start - offset, 0), queue.qsize())) # time of the jobs before the first queued job in the range
     cbs = []
-    for i, job in enumerate(jobs()):
-        if i == 0 and _status == 'plotting': i = -1
-        if 'position_notified' not in job or job['position_notified'] != i:
+    for i in range(start, end):
+        job = current[i] if i < offset else queue[i - offset]
+        eta = 0
+        if i >= offset:
+            eta = round(ahead / len(_plotters))
+            ahead += job.get('time_estimate', 0)
+        if i < offset and job_plotter(job).status == 'plotting': i = -1
+        if 'position_notified' not in job or job['position_notified'] != i or abs(eta - job.get('eta', 0)) > ETA_NOTIFY_CHANGE:
             job['position_notified'] = i
+            job['eta'] = eta
             cbs.append( callback(job['queue_position_cb'], i, job) )
+    _notification_counts['flushes'] += 1
+    _notification_counts['sent'] += len(cbs)
     await asyncio.gather(*cbs) # run callbacks concurrently
 
+# Counts of position changes, batches of notifications sent (flushes) and notifications sent
+def notification_stats():
+    return dict(_notification_counts)
+
 async def _notify_queue_size():
     await callback(queue_size_cb, num_jobs())
 
@@ -87,32 +212,70 @@ def set_queue_size_cb(cb):
     global queue_size_cb
     queue_size_cb = cb
 
+# Sheets aren't counted, only the jobs on them
 def num_jobs():
-    return len(_jobs)
+    return len(_jobs) - _num_sheets
+
+def plotters():
+    return _plotters
 
-def current_job():
-    return _current_job
+# Current jobs of all plotters (in order of the plotters)
+def current_jobs():
+    return [ p.job for p in _plotters if p.job != None and not p.job['cancel'] ]
 
-def current_client():
-    if _current_job == None: return None
-    return _current_job['client']
+# The plotter a job is the current job of, or None
+def job_plotter(job):
+    if job == None: return None
+    return next( (p for p in _plotters if p.job is job), None )
 
 def job_by_client(client):
     if client not in _jobs: return None
     return _jobs[client]
 
+# Current jobs of all plotters, followed by the queue
 def jobs():
-    lst = queue.list()
-    if (_current_job != None and not _current_job['cancel']):
-        lst.insert(0, _current_job)
-    return lst
+    return current_jobs() + queue.list()
+
+# Position of the first job in the queue (in jobs())
+def _queue_offset():
+    return len(current_jobs())
+
+# Time estimate of the current jobs (in full, even if they are partly plotted)
+def _current_time():
+    return sum( job.get('time_estimate', 0) for job in current_jobs() )
 
-def status():
+# Time estimate of all jobs in seconds
+def total_time():
+    return _current_time() + queue.total()
+
+# Expected time until a job starts in seconds: the time estimates of the current jobs and the jobs before it,
+# shared by all plotters. Assumes jobs are plotted in queue order, i.e. the fifo policy (other policies pick jobs out of
+# order, see scheduler.py). 0 for current jobs, None if the job isn't queued
+def eta(job):
+    if job_plotter(job) != None: return 0
+    try:
+        idx = queue.index(job)
+    except ValueError:
+        return None
+    return round( (_current_time() + queue.prefix(idx)) / len(_plotters) )
+
+# Status of a plotter, or of all plotters (the most active status, with a description of each plotter)
+def status(plotter = None):
+    if plotter == None and len(_plotters) == 1: plotter = _plotters[0]
+    if plotter != None:
+        return {
+            'status': plotter.status,
+            'status_desc': STATUS_DESC[plotter.status],
+            'job': plotter.job['client'] if plotter.job != None else None,
+            'job_str': job_str(plotter.job) if plotter.job != None else None,
+            'queue_size': num_jobs(),
+        }
+    statuses = [ p.status for p in _plotters ]
     return {
-        'status': _status,
-        'status_desc': STATUS_DESC[_status],
-        'job': _current_job['client'] if _current_job != None else None,
-        'job_str': job_str(_current_job) if _current_job != None else None,
+        'status': next( (x for x in ['plotting', 'paused', 'confirm_plot', 'setup'] if x in statuses), 'waiting' ),
+        'status_desc': ', '.join( f'{p.name}: {STATUS_DESC[p.status]}' for p in _plotters ),
+        'job': None,
+        'job_str': None,
         'queue_size': num_jobs(),
     }
 
@@ -133,54 +296,99 @@ def timestamp_str(date = None):
 
 def save_svg(job, overwrite_existing = False):
     if job['status'] not in STATUS_FOLDERS.keys(): return False
+    if job.get('members') != None and job['status'] in ['waiting', 'plotting']: return False # sheets are only kept in memory (their jobs are saved)
     
     min = int(job["time_estimate"] / 60) if "time_estimate" in job else 0
     sec = math.ceil(job["time_estimate"] % 60) if "time_estimate" in job else 0
-    position = f'{(job["position"] + 1):03}_' if 'position' in job and job['status'] in ['waiting', 'plotting'] else ''
     
     ink = f'{(job["stats"]["travel_ink"] / 1000):.1f}' if "stats" in job else 0
     travel = f'{(job["stats"]["travel"] / 1000):.1f}' if "stats" in job else 0
-    filename = f'{position}{job["received"]}_[{job["client"][0:10]}]_{job["hash"][0:5]}_{travel}m_{min}m{sec}s.svg'
+    if job['status'] in ['waiting', 'plotting']: filename = waiting_name(job)
+    else: filename = f'{job["received"]}_[{job["client"][0:10]}]_{job["hash"][0:5]}_{travel}m_{min}m{sec}s.svg'
     filename = os.path.join(STATUS_FOLDERS[job['status']], filename)
     
-    # remove previous save
-    if 'save_path' in job and job['save_path'] != filename:
-        try:
-            # print('removing', job['save_path'])
-            os.remove(job['save_path'])
-        except:
-            pass
+    previous = _spool_writer.target(job) or job.get('save_path')
+    if previous == filename and not overwrite_existing: return True
     
-    # save file
-    if not os.path.isfile(filename) or overwrite_existing:
-        # print('writing', filename)
+    if 'upload_path' in job:
+        # uploaded in chunks, move the file instead of writing it again
+        # right away (it's a rename), the upload is discarded after enqueueing
         os.makedirs( os.path.dirname(filename), exist_ok=True)
-        with open(filename, 'w', encoding='utf-8') as f: f.write(job['svg'])
-        job['save_path'] = filename
+        os.replace(job.pop('upload_path'), filename)
+        job.spooled(filename)
+        return True
+    
+    # the file is moved or written in the background, the job keeps its svg until then
+    # from then on the svg is read from the file when needed
+    _spool_writer.save(job, filename, overwrite_existing)
     return True
 
+# Spool file name of a waiting job, it doesn't change while the job waits (the order is kept in the journal)
+def waiting_name(job):
+    return f'{job["hash"]}_[{job["client"][0:10]}].svg'
+
+# Record the position of a job in the journal: before the job after it in jobs()
+def _journal_place(job):
+    current = current_jobs()
+    if job in current:
+        idx = current.index(job)
+        after = current[idx + 1] if idx + 1 < len(current) else (queue[0] if queue.qsize() > 0 else None)
+    else:
+        idx = queue.index(job)
+        after = queue[idx + 1] if idx + 1 < queue.qsize() else None
+    _journal.move(waiting_name(job), waiting_name(after) if after != None else None)
+
+# State of a job that is kept in the journal, so it doesn't need to be simulated again after a restart
+def _estimate_state(job):
+    return {
+        'speed': job['speed'],
+        'time_estimate': job['time_estimate'],
+        'time_estimate_source': job.get('time_estimate_source'),
+        'layers': job.get('layers'),
+        'layer_estimates': job.get('layer_estimates'),
+    }
+
+# Remove a job from the journal, and the output svg of its paused plot
+def _journal_remove(job):
+    output = _journal.state(waiting_name(job)).get('output')
+    _journal.remove(waiting_name(job))
+    if output != None:
+        try: os.remove(output)
+        except OSError: pass
+
+# Save the output svg of a paused plot, so it can be continued after a restart. Returns the path, None on error
+# Sheets aren't in the journal, their output isn't saved
+def save_output(job):
+    if waiting_name(job) not in _journal: return None
+    path = os.path.join(OUTPUT_FOLDER, waiting_name(job))
+    os.makedirs(OUTPUT_FOLDER, exist_ok = True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f: f.write(job['output_svg'])
+    os.replace(path + '.tmp', path)
+    return path
+
+async def save_output_async(job):
+    try:
+        return await asyncio.to_thread(save_output, job)
+    except OSError as e:
+        print(f'⚠️  [yellow]Error saving output of job \\[{job["client"]}], it can\'t be continued after a restart: {e}')
+        return None
+
+# Counts of saved, coalesced, written and moved spool files, backlog and latency (see spool_writer.py)
+def spool_stats():
+    return _spool_writer.stats()
+
 # def save_svg_async(*args, **kwargs):
 #     return asyncio.to_thread(save_svg, *args, **kwargs)
 
 
-# Updated pre version 4 SVGs, so they are compatible with resume queue
-def update_svg(job):
-    match = re.search('tg:version="(\\d+)"', job['svg'])
-    if match != None and int(match.group(1)) >= 4: return
-    
-    MARKER = 'xmlns:tg="https://sketch.process.studio/turtle-graphics"'
-    idx = job['svg'].find(MARKER)
-    if idx == -1: return
-    idx += len(MARKER)
-    insert = f'\n     tg:version="4" tg:layer_count="1" tg:oob_count="{job['stats']['oob_count']}" tg:short_count="{job['stats']['short_count']}" tg:format="{job['format']}" tg:width_mm="{job['size'][0]}" tg:height_mm="{job['size'][1]}" tg:speed="{job['speed']}" tg:author="{job['client']}" tg:timestamp="{job['timestamp']}"'
-    
-    job['svg'] = job['svg'][:idx] + insert + job['svg'][idx:]
-    job['hash'] = hashlib.sha1(job['svg'].encode('utf-8')).hexdigest()
-
-# job {'type': 'plot, 'client', 'id', 'svg', stats, timestamp, hash, speed, format, size, received?}
+# job {'type': 'plot, 'client', 'id', 'svg', stats, timestamp, hash, speed, format, size, received?} (dict or Job)
 # adds to job: { 'cancel', time_estimate', 'layers', received }
+# the job is queued as a Job (see job.py), callbacks receive the Job
+# validating_cb(ahead, job) is called while the job waits for validation (see admission.py)
 # todo: don't wait on callbacks
-async def enqueue(job, queue_position_cb = None, done_cb = None, cancel_cb = None, error_cb = None):
+async def enqueue(job, queue_position_cb = None, done_cb = None, cancel_cb = None, error_cb = None, validating_cb = None):
+    if not isinstance(job, Job): job = Job(job)
+    
     # the client might be in queue (or currently plotting)
     if job['client'] in _jobs:
         await callback( error_cb, 'Cannot add job, you already have a job queued!', job )
@@ -196,166 +404,211 @@ async def enqueue(job, queue_position_cb = None, done_cb = None, cancel_cb = Non
     if 'received' not in job or job['received'] == None:
         job['received'] = timestamp_str()
     
-    # speed
-    if 'speed' in job: job['speed'] = max( min(job['speed'], 100), MIN_SPEED ) # limit speed  (MIN_SPEED, 100)
-    else: job['speed'] = 100
-    # format
-    if 'format' not in job: job['format'] = 'A4_LANDSCAPE'
+    # speed, format, svg header and digest (already done for jobs from ingest.decode)
+    ingest.normalize_job(job, MIN_SPEED)
+    if ('upload_path' not in job and ingest.update_svg(job)) or 'hash' not in job: job['hash'] = digest.digest(job['svg'], DIGEST_ALGORITHM) # uploads are read from the file, don't read them here
+    
+    # the same drawing might be submitted again, e.g. by a client that reconnected with a new id
+    if queued_duplicate(job) != None:
+        print(f'⚠️  [yellow]Rejected job \\[{job["client"]}] {job["hash"][0:5]}, the same drawing is queued already')
+        await callback( error_cb, 'Cannot add job, the same drawing is queued already!', job )
+        return False
     
     # add to jobs index
     _jobs[ job['client'] ] = job
     print(f'New job \\[{job["client"]}] {job["hash"][0:5]}')
+    
+    def on_validating(ahead):
+        background( callback(validating_cb, ahead, job) )
+    
     try:
-        async with asyncio.timeout(SIMULATION_TIMEOUT):
-            sim = await simulate_async(job) # run simulation
+        async with _admission.slot(on_validating):
+            if job['cancel']: return False # canceled while waiting for a slot (see cancel)
+            if not job.get('loaded_from_file'): # jobs from spool files (resumed or reprinted) are cleaned up and optimized already
+                if CLEANUP_PATHS: await cleanup_job(job)
+                if OPTIMIZE_TRAVEL: await optimize_job(job)
+            sim = recovered_simulation(job) # resumed from disk, with the estimate kept in the journal
+            if sim != None and sim.get('analytic'): background( refine_estimate(job) )
+            if sim == None: sim = await cached_simulation_async(job)
+            if sim == None and FAST_ESTIMATE:
+                sim = await estimate_async(job) # None if the svg isn't supported by the estimator
+                if sim != None: background( refine_estimate(job) )
+            if sim == None:
+                sim = await simulate_cached_async(job, timeout = SIMULATION_TIMEOUT) # run simulation
+    except admission.Overloaded:
+        print(f'⚠️  [yellow]Too many pending jobs, rejected job \\[{job["client"]}] {job["hash"][0:5]}')
+        del _jobs[ job['client'] ]
+        await callback( error_cb, 'Cannot add job, the plotter is busy. Please try again in a minute!', job )
+        return False
     except TimeoutError:
+        if job['cancel']: return False
         print(f'⚠️  [red]Timeout on simulating job \\[{job["client"]}] {job["hash"][0:5]}')
+        del _jobs[ job['client'] ]
         job['status'] = 'error'
         save_svg(job)
         await callback( error_cb, 'Cannot add job, it took to long to simulate!', job )
         return False
+    if job['cancel']: return False # canceled while validating
     
-    job['time_estimate'] = sim['time_estimate']
-    job['layers'] = sim['layers']
+    apply_simulation(job, sim)
     
-    update_svg(job)
     await queue.put(job)
-    job['position'] = job_pos(job)
     save_svg(job)
+    _journal.add(waiting_name(job), received = job['received'], **_estimate_state(job)) # jobs resumed from disk keep their place
     
     await _notify_queue_size() # notify new queue size
-    await _notify_queue_positions()
+    await _notify_queue_positions(_queue_offset() + queue.qsize() - 1) # added at the end
     return True
 
+# Unfinished job with the same digest as a new job (as received, jobs might have been rewritten since), None if there is none
+def queued_duplicate(job):
+    return next( (x for x in _jobs.values() if x.get('members') == None and job['hash'] in [ x['hash'], x.get('received_hash') ]), None )
+
 async def cancel(client, force = False):
-    global _current_job
     if not force:
-        if _current_job != None and _current_job['client'] == client:
-            await callback( _current_job['error_cb'], 'Cannot cancel, already plotting!', _current_job )
+        plotter = next( (p for p in _plotters if p.job != None and p.job['client'] == client), None )
+        if plotter != None:
+            await callback( plotter.job['error_cb'], 'Cannot cancel, already plotting!', plotter.job )
             return False
     
     # remove from job index
     if client not in _jobs: return False
     job = _jobs[client]
-    if job == _current_job and _status == 'plotting': return # can't cancel if plotting
+    if job.get('sheet') != None:
+        if job['sheet']['status'] != 'waiting': # plotted or being plotted
+            await callback( job['error_cb'], 'Cannot cancel, already plotting!', job )
+            return False
+        await ungang(job['sheet']) # still waiting for the operator, the job leaves the sheet
+    plotter = job_plotter(job)
+    if plotter != None and plotter.status == 'plotting': return # can't cancel if plotting
     job['status'] = 'canceled'
     job['cancel'] = True # set cancel flag
-    job['position'] = None
     del _jobs[client]
     
     # remove from queue
-    # if job is the current job, it has already been taken from the top of the queue
-    if job == _current_job:
-        _current_job = None
+    # if job is the current job of a plotter, it has already been taken from the queue
+    if plotter != None:
+        plotter.job = None
+        changed = 0 # all jobs move up
     else:
-        queue.pop( queue.index(job) )
+        try:
+            changed = _queue_offset() + queue.index(job) # jobs after the canceled one move up
+            queue.remove(job)
+        except ValueError:
+            changed = None # not queued yet, still being validated (enqueue drops it)
     
     await callback( job['cancel_cb'], job ) # notify canceled job
     await _notify_queue_size() # notify new queue size
-    await _notify_queue_positions() # notify queue positions (might have changed for some)
+    if changed != None: await _notify_queue_positions(changed) # notify queue positions (might have changed for some)
     print(f'❌ [red]Canceled job \\[{job["client"]}]')
+    _journal_remove(job)
     save_svg(job)
-    update_positions_and_save()
     return True
 
-async def cancel_current_job(force = True):
-    return await cancel(_current_job['client'], force = force)
-
-async def finish_current_job():
-    global _current_job
-    _current_job['status'] = 'finished'
-    _current_job['position'] = None
-    await callback( _current_job['done_cb'], _current_job ) # notify job done
-    del _jobs[ _current_job['client'] ] # remove from jobs index
-    finished_job = _current_job
-    _current_job = None
-    await _notify_queue_positions() # notify queue positions. current job is 0
+async def cancel_current_job(plotter, force = True):
+    return await cancel(plotter.job['client'], force = force)
+
+async def finish_current_job(plotter):
+    finished_job = plotter.job
+    finished_job['status'] = 'finished'
+    await callback( finished_job['done_cb'], finished_job ) # notify job done
+    del _jobs[ finished_job['client'] ] # remove from jobs index
+    plotter.job = None
+    await _notify_queue_positions() # notify queue positions. current jobs come first, all jobs after it move up
     await _notify_queue_size() # notify queue size
     print(f'✅ [green]Finished job \\[{finished_job["client"]}]')
-    _status = 'waiting'
+    _journal_remove(finished_job)
     save_svg(finished_job)
-    update_positions_and_save()
     return True
 
-# current job: 0 (if plotting or waiting, check job['status'])
-def job_pos(job):
-    if (job == _current_job): return 0
-    try:
-        return queue.index(job) + 1
-    except ValueError:
-        return None
-
-def update_position(job):
-    if job == None: return
-    job['position'] = job_pos(job)
-
-def update_positions_and_save():
-    # print('updating positions')
-    for job in _jobs.values():
-        update_position(job)
-        # print(job['client'], job['position'])
-        save_svg(job, overwrite_existing=False)
-
-# positions
-# 0 .. current job
-# 1 .. first in queue (idx 0)
-# last .. num_jobs()-1
+# positions (indices in jobs())
+# 0 .. n-1 .. current jobs of n plotters
+# n .. first in queue (idx 0)
+# last .. len(jobs())-1
 
 # plot['status']: 'waiting'|'plotting'|'paused'|'ok'|'error'|'finished'|'canceled'
 async def move(client, new_pos):
-    global _current_job
     # print('move', client, new_pos)
     job = _jobs[client]
-    current_pos = job_pos(job)
-    # print('move: current pos', current_pos)
     # cannot move if job is already plotting
     if job['status'] in ['plotting', 'paused']:
         # print('move: already plotting, can\'t move')
         return
     
+    current = current_jobs()
+    offset = len(current)
+    total = offset + queue.qsize()
+    if job.get('sheet') != None: return # jobs on a sheet move with it
+    plotter = job_plotter(job)
+    current_pos = current.index(job) if plotter != None else offset + queue.index(job)
+    # print('move: current pos', current_pos)
+    
     # normalize new_pos
-    if new_pos < 0: new_pos = num_jobs() + new_pos
+    if new_pos < 0: new_pos = total + new_pos
     
     # clamp to lower bound
     if new_pos < 0: new_pos = 0
     
-    # can't take place of the plotting (or paused job)
-    if new_pos == 0 and _status in ['plotting', 'paused']: new_pos = 1
+    # can't take place of a plotting (or paused job)
+    while new_pos < offset and job_plotter(current[new_pos]).status in ['plotting', 'paused']: new_pos += 1
     
     # print(f'move from {current_pos} to {new_pos}')
     
     # clamp to upper bound
-    if new_pos > num_jobs()-1: new_pos = num_jobs()-1
+    if new_pos > total-1: new_pos = total-1
     
     # nothing to do
     if new_pos == current_pos:
         # print('move: nothing to do')
         return
     
-    # move job from queue to current job
-    if new_pos == 0:
+    target = job_plotter(current[new_pos]) if new_pos < offset else None
+    # a sheet never goes (back) into the queue, it's taken apart instead: its jobs are next in line
+    if plotter != None and target == None and job.get('members') != None:
+        await ungang(job)
+        return
+    if plotter == None and target != None and target.job.get('members') != None:
+        await ungang(target.job, before = job) # the plotter takes the moved job next
+        return
+    # move job from queue to current job of a plotter
+    if plotter == None and target != None:
         # print('move to top')
-        queue.pop(current_pos-1) # remove from current position
-        queue.insert(0, _current_job) # move current job (pos 0) to first waiting position
-        _current_job = job # set to current job
-        prompt_ui('start_plot', f'Ready to plot job \\[{_current_job["client"]}] ?')
+        queue.remove(job) # remove from current position
+        queue.insert(0, target.job) # move current job to first waiting position
+        target.job = job # set to current job
+        prompt_ui(target, 'start_plot', f'Ready to plot job \\[{target.job["client"]}] ?')
+    # swap the current jobs of two plotters
+    elif target != None:
+        plotter.job, target.job = target.job, plotter.job
+        for p in [plotter, target]: prompt_ui(p, 'start_plot', f'Ready to plot job \\[{p.job["client"]}] ?')
     # move current job to queue
-    elif current_pos == 0:
+    elif plotter != None:
         # print('move from top')
-        old_current_job = _current_job
-        _current_job = queue.pop(0) # new current job is next in line
-        queue.insert(new_pos-1, old_current_job)
-        prompt_ui('start_plot', f'Ready to plot job \\[{_current_job["client"]}] ?')
+        plotter.job = queue.pop(0) # new current job is next in line
+        queue.insert(new_pos - offset, job)
+        prompt_ui(plotter, 'start_plot', f'Ready to plot job \\[{plotter.job["client"]}] ?')
     # move within queue
     else:
         # print('move within queue')
-        queue.move(current_pos-1, new_pos-1)
+        queue.move(current_pos - offset, new_pos - offset)
     
-    # update 'position' attribute of all jobs and save svgs
-    update_positions_and_save()
+    # one journal record per job that moved (instead of renaming the files of all jobs in between)
+    _journal_place(job)
+    if plotter == None and target != None: _journal_place(queue[0]) # the previous current job
+    elif target != None: _journal_place(plotter.job)
+    elif plotter != None: _journal_place(plotter.job) # the new current job
     
     await _notify_queue_size()
-    await _notify_queue_positions() # notify queue positions (might have changed for some)
+    if plotter == None and target == None:
+        await _notify_queue_positions(min(current_pos, new_pos), max(current_pos, new_pos) + 1) # only the jobs between the two positions shift
+    else:
+        await _notify_queue_positions(min(current_pos, new_pos)) # the current jobs changed, all jobs after them start at a different time
+
+# Estimated time of a layer (0-based) as string, e.g. ', 2:15 min'
+def layer_estimate_str(job, layer):
+    if 'layer_estimates' not in job or layer >= len(job['layer_estimates']): return ''
+    secs = job['layer_estimates'][layer]
+    return f', {math.floor(secs/60)}:{round(secs%60):02} min'
 
 def job_str(job):
     info = '[' + str(job["client"])[0:10] + '] ' + job['hash'][0:5]
@@ -396,10 +649,11 @@ def print_axidraw(*args):
         print(f"[gray50]\\[AxiDraw] " + line)
 
 # Raise pen and disable XY stepper motors
-def align():
+def align(port = None):
     with capture_output(print_axidraw, print_axidraw):
         ad = axidraw.AxiDraw()
         ad.plot_setup()
+        ad.options.port = port
         ad.options.mode = 'align' # A setup mode: Raise pen, disable XY stepper motors
         ad.options.pen_pos_up = PEN_POS_UP
         ad.options.pen_pos_down = PEN_POS_DOWN
@@ -408,10 +662,11 @@ def align():
     return ad.errors.code
 
 # Cycle the pen down and back up
-def cycle():
+def cycle(port = None):
     with capture_output(print_axidraw, print_axidraw):
         ad = axidraw.AxiDraw()
         ad.plot_setup()
+        ad.options.port = port
         ad.options.mode = 'cycle' # A setup mode: Lower and then raise the pen
         ad.options.pen_pos_up = PEN_POS_UP
         ad.options.pen_pos_down = PEN_POS_DOWN
@@ -419,37 +674,48 @@ def cycle():
         ad.plot_run()
     return ad.errors.code
 
-def request_plot_pause():
-    global _current_ad
-    if _current_ad != None:
-        _current_ad.transmit_pause_request()
+def request_plot_pause(plotter):
+    if plotter.ad != None:
+        plotter.ad.transmit_pause_request()
 
-def plot(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE, options_cb = None, return_ad = False):
-    if 'svg' not in job: return 0
+# Plot options depending on job speed (in percent)
+def plot_options(speed):
+    speed = speed / 100
+    return {
+        'speed_pendown': int(110 * speed),
+        'speed_penup': int(110 * speed),
+        'accel': int(100 * speed),
+        'pen_rate_lower': int(100 * speed),
+        'pen_rate_raise': int(100 * speed),
+        'pen_pos_up': PEN_POS_UP,
+        'pen_pos_down': PEN_POS_DOWN,
+    }
+
+def set_plot_options(ad, speed):
+    ad.options.model = 2 # A3
+    ad.options.reordering = 4 # No reordering
+    ad.options.auto_rotate = True # (This is the default) Drawings that are taller than wide will be rotated 90 deg to the left
+    for key, value in plot_options(speed).items():
+        setattr(ad.options, key, value)
+
+# svg: plot this svg instead of the job's (used for resuming from the output svg)
+# plotter: the plotter to use (None: first plotter found, e.g. for simulating)
+def plot(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE, options_cb = None, return_ad = False, svg = None, plotter = None):
+    if svg == None and 'svg' not in job: return 0
     job['status'] = 'plotting'
-    speed = job['speed'] / 100
     with capture_output(print_axidraw, print_axidraw):
         ad = axidraw.AxiDraw()
-        ad.plot_setup(job['svg'])
-        ad.options.model = 2 # A3
-        ad.options.reordering = 4 # No reordering
-        ad.options.auto_rotate = True # (This is the default) Drawings that are taller than wide will be rotated 90 deg to the left
-        ad.options.speed_pendown = int(110 * speed)
-        ad.options.speed_penup = int(110 * speed)
-        ad.options.accel = int(100 * speed)
-        ad.options.pen_rate_lower = int(100 * speed)
-        ad.options.pen_rate_raise = int(100 * speed)
-        ad.options.pen_pos_up = PEN_POS_UP
-        ad.options.pen_pos_down = PEN_POS_DOWN
+        ad.plot_setup(svg if svg != None else job['svg'])
+        set_plot_options(ad, job['speed'])
+        if plotter != None: ad.options.port = plotter.port
         if callable(options_cb): options_cb(ad.options)
         if TESTING: ad.options.preview = True
-        global _current_ad
-        _current_ad = ad # for request_plot_pause()
+        if plotter != None: plotter.ad = ad # for request_plot_pause()
         job['output_svg'] = ad.plot_run(output=True)
-    _current_ad = None
+    if plotter != None: plotter.ad = None
     if (ad.errors.code in PLOTTER_PAUSED and align_after_pause) or \
        (ad.errors.code not in PLOTTER_PAUSED and align_after):
-        align()
+        align(plotter.port if plotter != None else None)
     
     if ad.errors.code in PLOTTER_PAUSED: job['status'] = 'paused'
     elif ad.errors.code in PLOTTER_OK: job['status'] = 'ok'
@@ -458,35 +724,39 @@ def plot(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE,
     if return_ad: return ad
     else: return ad.errors.code
 
-def resume_home(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE, options_cb = None, return_ad = False):
+def resume_home(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE, options_cb = None, return_ad = False, plotter = None):
     if 'output_svg' not in job: return 0
-    orig_svg = job['svg'] # save original svg
-    job['svg'] = job['output_svg'] # set last output svg as input
     
     def _options_cb(options):
         if callable(options_cb): options_cb(options)
         options.mode = 'res_home'
     
-    res = plot(job, align_after, align_after_pause, _options_cb, return_ad)
-    job['svg'] = orig_svg # restore original svg
-    return res
+    return plot(job, align_after, align_after_pause, _options_cb, return_ad, svg = job['output_svg'], plotter = plotter) # last output svg as input
 
-def resume_plot(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE, options_cb = None, return_ad = False):
+def resume_plot(job, align_after = ALIGN_AFTER, align_after_pause = ALIGN_AFTER_PAUSE, options_cb = None, return_ad = False, plotter = None):
     if 'output_svg' not in job: return 0
-    orig_svg = job['svg'] # save original svg
-    job['svg'] = job['output_svg'] # set last output svg as input
     
     def _options_cb(options):
         if callable(options_cb): options_cb(options)
         options.mode = 'res_plot'
     
-    res = plot(job, align_after, align_after_pause, _options_cb, return_ad)
-    job['svg'] = orig_svg # restore original svg
-    return res
+    return plot(job, align_after, align_after_pause, _options_cb, return_ad, svg = job['output_svg'], plotter = plotter) # last output svg as input
+
+LAYER_TAG = re.compile(r'<g\b[^>]*\binkscape:groupmode="layer"[^>]*>')
+LAYER_LABEL = re.compile(r'\binkscape:label="!?\s*(\d+)?')
+
+# Layer numbers of all layers in the svg (as used by AxiDraw's layers mode)
+# Returns None if there is a layer without number
+def layer_numbers(svg):
+    numbers = []
+    for tag in LAYER_TAG.finditer(svg):
+        label = LAYER_LABEL.search(tag.group(0))
+        if label == None or label.group(1) == None: return None
+        numbers.append(int(label.group(1)))
+    return numbers
 
 def simulate(job):
     if 'svg' not in job: return 0
-    speed = job['speed'] / 100
     
     stats = {
         'error_code': None,
@@ -494,7 +764,8 @@ def simulate(job):
         'distance_total': 0,
         'distance_pendown': 0,
         'pen_lifts': 0,
-        'layers': 0
+        'layers': 0,
+        'layer_stats': [],
     }
     
     def update_stats(ad):
@@ -504,7 +775,32 @@ def simulate(job):
         stats['distance_pendown'] += ad.distance_pendown
         stats['pen_lifts'] += ad.pen_lifts
         stats['layers'] += 1
+        stats['layer_stats'].append({
+            'time_estimate': ad.time_estimate,
+            'distance_total': ad.distance_total,
+            'distance_pendown': ad.distance_pendown,
+            'pen_lifts': ad.pen_lifts,
+        })
+    
+    numbers = layer_numbers(job['svg'])
+    if numbers != None and len(numbers) > 1 and len(set(numbers)) == len(numbers):
+        # Parse the document once and simulate layer by layer (layers mode)
+        # Pause markers (!) are removed, otherwise each layer would stop before plotting
+        svg = re.sub(r'(\binkscape:label=")!', r'\1', job['svg'])
+        with capture_output(print_axidraw, print_axidraw):
+            ad = axidraw.AxiDraw()
+            ad.plot_setup(svg)
+            set_plot_options(ad, job['speed'])
+            ad.options.preview = True
+            ad.options.mode = 'layers'
+            for number in numbers:
+                ad.options.layer = number
+                ad.plot_run()
+                update_stats(ad)
+                if ad.errors.code != 0: break
+        return stats
     
+    # Fallback: simulate layers one after another, resuming from the output svg of the previous pass
     def _options_cb(options):
         options.preview = True
     
@@ -523,14 +819,313 @@ def simulate(job):
 async def plot_async(*args, **kwargs):
     return await asyncio.to_thread(plot, *args, **kwargs)
 
-async def simulate_async(*args, **kwargs):
-    return await asyncio.to_thread(simulate, *args, **kwargs)
+def simulation_pool():
+    global _simulation_pool
+    if _simulation_pool == None:
+        _simulation_pool = sim_pool.Pool(SIMULATION_WORKERS, preload = ['pyaxidraw.axidraw'])
+    return _simulation_pool
+
+def run_in_simulation_thread(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(_simulation_executor, fn, *args)
+
+# Runs the simulation in a worker process (see sim_pool.py)
+# Only the fields needed for simulating are sent to the worker (callbacks aren't picklable)
+# Raises TimeoutError if the simulation takes longer than timeout seconds; the worker is killed in that case
+async def simulate_async(job, timeout = None):
+    sim_job = { 'svg': job['svg'], 'speed': job['speed'] }
+    return await simulation_pool().run(simulate, sim_job, timeout = timeout)
+
+# The simulation result only depends on the svg (identified by its digest), speed and the plot options set in plot()
+def simulation_cache_key(job):
+    return _simulation_cache.key(job['hash'], digest = DIGEST_ALGORITHM or digest.DEFAULT, speed = job['speed'], model = 2, reordering = 4, auto_rotate = True, pen_pos_up = PEN_POS_UP, pen_pos_down = PEN_POS_DOWN)
+
+# Returns the cached simulation result or None
+async def cached_simulation_async(job):
+    if _simulation_cache == None: return None
+    return await run_in_simulation_thread(lambda: _simulation_cache.get(simulation_cache_key(job)))
+
+# Like simulate_async, but looks up the result in the simulation cache first
+async def simulate_cached_async(job, timeout = None):
+    sim = await cached_simulation_async(job)
+    if sim != None: return sim
+    
+    sim = await simulate_async(job, timeout = timeout)
+    if _simulation_cache != None:
+        await run_in_simulation_thread(lambda: _simulation_cache.put(simulation_cache_key(job), sim))
+    return sim
+
+# Analytic time estimate (see estimate.py), returns None if the svg isn't supported by the estimator
+def estimate_job(job):
+    try:
+        sim = estimate.estimate(job['svg'], plot_options(job['speed']))
+    except Exception:
+        return None
+    sim['analytic'] = True
+    return sim
+
+async def estimate_async(job):
+    return await run_in_simulation_thread(estimate_job, job)
+
+# Time estimate of a job resumed from disk, from the state kept in the journal (see resume_queue_from_disk)
+# Returns None if there is none
+def recovered_simulation(job):
+    if not job.get('loaded_from_file') or 'time_estimate' not in job: return None
+    return {
+        'time_estimate': job['time_estimate'],
+        'layers': job['layers'],
+        'layer_stats': [ { 'time_estimate': x } for x in job.get('layer_estimates') or [] ],
+        'analytic': job.get('time_estimate_source') == 'analytic',
+    }
+
+def apply_simulation(job, sim):
+    job['time_estimate'] = sim['time_estimate']
+    job['layers'] = sim['layers']
+    job['time_estimate_source'] = 'analytic' if sim.get('analytic') else 'simulation'
+    job['layer_estimates'] = [ x['time_estimate'] for x in sim.get('layer_stats', []) ]
+
+# Give a job a rewritten svg (and its digest)
+def replace_svg(job, svg):
+    if 'received_hash' not in job: job['received_hash'] = job['hash']
+    job['svg'] = svg
+    if 'upload_path' in job: os.remove(job.pop('upload_path')) # the original upload isn't needed anymore
+    job['hash'] = digest.digest(svg, DIGEST_ALGORITHM)
+
+# Join strokes, simplify them and drop tiny fragments (see cleanup.py), in a simulation worker process
+# The job gets the cleaned svg (and its digest), the pen lifts and points before and after are kept in 'cleaned'
+async def cleanup_job(job):
+    try:
+        svg, report = await simulation_pool().run(cleanup.cleanup_svg, job['svg'], join = CLEANUP_JOIN, simplify = CLEANUP_SIMPLIFY, min_length = CLEANUP_MIN_LENGTH, reverse = OPTIMIZE_REVERSE, timeout = SIMULATION_TIMEOUT)
+    except Exception as e:
+        print(f'⚠️  [yellow]Error cleaning up job \\[{job["client"]}] {job["hash"][0:5]}: {e}')
+        return
+    if report == None or svg == job['svg']: return
+    replace_svg(job, svg)
+    job['cleaned'] = report
+    print(f'🧹 [blue]Cleaned up job \\[{job["client"]}]: pen lifts {report["pen_lifts_before"]} → {report["pen_lifts_after"]}, points {report["points_before"]} → {report["points_after"]}, {report["dropped"]} fragments dropped')
+
+# Reorder the strokes of a job to reduce pen-up travel (see optimize.py), in a simulation worker process
+# The job gets the optimized svg (and its digest), the travel in its stats is updated and the savings are kept in 'optimized'
+async def optimize_job(job):
+    try:
+        svg, report = await simulation_pool().run(optimize.optimize_svg, job['svg'], reverse = OPTIMIZE_REVERSE, time_limit = OPTIMIZE_TIME_LIMIT, options = plot_options(job['speed']), timeout = OPTIMIZE_TIME_LIMIT + SIMULATION_TIMEOUT)
+    except Exception as e:
+        print(f'⚠️  [yellow]Error optimizing job \\[{job["client"]}] {job["hash"][0:5]}: {e}')
+        return
+    if report == None or report['travel_blank_after'] >= report['travel_blank_before']: return
+    replace_svg(job, svg)
+    job['optimized'] = report
+    if 'stats' in job:
+        stats = dict(job['stats'])
+        stats['travel_blank'] = report['travel_blank_after']
+        if 'travel_ink' in stats: stats['travel'] = stats['travel_ink'] + report['travel_blank_after']
+        job['stats'] = stats
+    saved = report['time_before'] - report['time_after']
+    print(f'🔀 [blue]Optimized job \\[{job["client"]}]: pen-up travel {report["travel_blank_before"]/1000:.1f} → {report["travel_blank_after"]/1000:.1f} m, {math.floor(saved/60)}:{round(saved%60):02} min faster')
+
+# Replace the analytic estimate of a queued job with the result of a full simulation
+async def refine_estimate(job):
+    speed = job['speed']
+    try:
+        async with _admission.slot(background = True): # new jobs go first
+            if _jobs.get(job['client']) is not job or job['speed'] != speed: return # job is finished, canceled or its speed changed
+            sim = await simulate_cached_async(job, timeout = SIMULATION_TIMEOUT)
+    except TimeoutError:
+        print(f'⚠️  [yellow]Timeout on simulating job \\[{job["client"]}] {job["hash"][0:5]}, keeping analytic estimate')
+        return
+    except Exception as e:
+        print(f'⚠️  [red]Error simulating job \\[{job["client"]}] {job["hash"][0:5]}: {e}')
+        return
+    if _jobs.get(job['client']) is not job or job['speed'] != speed: return # job is finished, canceled or its speed changed
+    apply_simulation(job, sim)
+    await _estimate_changed(job) # kept in the journal, the spool file of a waiting job keeps its name
+
+# The time estimate of a job changed: update the sums of the queue, jobs after it start at a different time
+async def _estimate_changed(job):
+    _journal.update(waiting_name(job), **_estimate_state(job))
+    if job_plotter(job) != None:
+        await _notify_queue_positions(_queue_offset()) # all queued jobs
+    else:
+        try:
+            idx = queue.index(job)
+        except ValueError:
+            return
+        queue.reweigh(job)
+        await _notify_queue_positions(_queue_offset() + idx + 1) # the jobs after it
+    await _notify_queue_size() # updates queue display
+
+# Change the speed of a job (waiting or current, but not while plotting) and estimate its time again
+async def set_speed(job, speed):
+    job['speed'] = speed
+    sim = await cached_simulation_async(job)
+    if sim == None:
+        sim = await estimate_async(job) # None if the svg isn't supported by the estimator
+        background( refine_estimate(job) ) # simulate in the background
+    if sim == None or job['speed'] != speed or _jobs.get(job['client']) is not job: return # changed again, or finished or canceled in the meantime
+    apply_simulation(job, sim)
+    await _estimate_changed(job) # kept in the journal, the spool file of a waiting job keeps its name
+
+# Ganging (see geometry.py): when a plotter takes a job, compatible waiting jobs that fit on the same sheet
+# are taken out of the queue and plotted together with it, saving a paper change for each of them
+# The sheet is a job of its own (with the jobs in 'members'). It is only kept in memory, the jobs on it stay in
+# the waiting folder until the sheet is done, so they are resumed separately after a restart
+# Callbacks of the sheet are forwarded to the jobs on it, so each client is notified as if its job was plotted alone
+# Until the sheet is plotted, it can be taken apart again (see ungang): when the operator declines it, or a job on it
+# is canceled
+
+# Single layer jobs with the same format and size can share a sheet (their pens and svgs are checked in plan_sheet)
+def gang_compatible(job, other):
+    return other.get('members') == None and not other['cancel'] and not other.get('no_gang') and other.get('layers') == 1 and \
+        other['format'] == job['format'] and list(other.get('size', [])) == list(job.get('size', []))
+
+# Bounding box of a job on the page (see geometry.bounds), computed once. None if the job can't be ganged (e.g. it has
+# transforms or shapes other than paths, see geometry.check_supported)
+def gang_bounds(job):
+    if 'bounds' not in job:
+        job['bounds'] = None
+        job['pen'] = None
+        try:
+            job['bounds'] = geometry.bounds(job['svg'])
+            job['pen'] = geometry.pen(job['svg'])
+        except Exception:
+            pass
+    return job['bounds']
+
+# The job and the candidates that fit on a sheet with it, and the composite svg (None if no other job fits)
+# Runs in a thread, reading the svgs of the candidates might take a while
+def plan_sheet(job, candidates):
+    if gang_bounds(job) == None: return None
+    members = [job]
+    offsets = None
+    for other in candidates:
+        if len(members) == GANG_MAX_JOBS: break
+        if gang_bounds(other) == None or other['pen'] != job['pen']: continue
+        arranged = geometry.arrange([ x['bounds'] for x in members + [other] ], job['size'], GANG_MARGIN, GANG_SPACING)
+        if arranged == None: continue
+        members.append(other)
+        offsets = arranged
+    if offsets == None: return None
+    svg = geometry.compose([ (x['svg'], offset) for x, offset in zip(members, offsets) ], job['size'], job['pen'] or 'black')
+    return members, svg
+
+# Replace the current job of the plotter with a sheet of it and compatible waiting jobs (if there are any)
+async def gang(plotter):
+    global _sheet_count, _num_sheets
+    job = plotter.job
+    if not gang_compatible(job, job): return
+    candidates = [ other for other in queue.list()[:GANG_LOOKAHEAD] if gang_compatible(job, other) ]
+    if len(candidates) == 0: return
+    plan = await run_in_simulation_thread(plan_sheet, job, candidates)
+    if plan == None: return
+    members, svg = plan
+    
+    sheet = Job(
+        type = 'plot',
+        client = f'Sheet-{_sheet_count + 1}',
+        id = None,
+        svg = svg,
+        hash = digest.digest(svg, DIGEST_ALGORITHM),
+        timestamp = timestamp_str_full(),
+        received = timestamp_str(),
+        speed = min( x['speed'] for x in members ),
+        format = job['format'],
+        size = job['size'],
+        stats = { key: sum( x['stats'].get(key, 0) for x in members ) for key in job['stats'] },
+        status = 'waiting',
+        cancel = False,
+        members = members,
+        queue_position_cb = _sheet_position,
+        done_cb = _sheet_done,
+        cancel_cb = _sheet_canceled,
+        error_cb = _sheet_error,
+    )
+    sheet['stats']['layer_count'] = 1
+    sim = await estimate_async(sheet)
+    if sim == None: sim = { 'time_estimate': sum( x['time_estimate'] for x in members ), 'layers': 1 }
+    apply_simulation(sheet, sim)
+    
+    # the jobs might have been canceled, moved or taken by another plotter in the meantime
+    def queued(x):
+        try:
+            queue.index(x)
+            return _jobs.get(x['client']) is x and not x['cancel']
+        except ValueError:
+            return False
+    if plotter.job is not job or job['cancel'] or not all(map(queued, members[1:])): return
+    
+    for x in members[1:]: queue.remove(x)
+    for x in members: x['sheet'] = sheet
+    _sheet_count += 1
+    _num_sheets += 1
+    _jobs[ sheet['client'] ] = sheet
+    plotter.job = sheet
+    print(f'📄 [blue]Ganged {len(members)} jobs on \\[{sheet["client"]}]: ' + ', '.join( f'\\[{x["client"]}]' for x in members ))
+    await _notify_queue_size()
+    await _notify_queue_positions(_queue_offset()) # the jobs on the sheet left the queue
+
+async def _sheet_position(pos, sheet):
+    cbs = []
+    for job in sheet['members']:
+        job['position_notified'] = pos
+        job['eta'] = sheet['eta']
+        cbs.append( callback(job['queue_position_cb'], pos, job) )
+    await asyncio.gather(*cbs)
+
+async def _sheet_done(sheet):
+    global _num_sheets
+    _num_sheets -= 1
+    for job in sheet['members']:
+        job['status'] = 'finished'
+        await callback( job['done_cb'], job )
+        del _jobs[ job['client'] ]
+        _journal_remove(job)
+        save_svg(job)
+
+async def _sheet_canceled(sheet):
+    global _num_sheets
+    _num_sheets -= 1
+    for job in sheet['members']:
+        job['status'] = 'canceled'
+        job['cancel'] = True
+        del _jobs[ job['client'] ]
+        await callback( job['cancel_cb'], job )
+        _journal_remove(job)
+        save_svg(job)
+
+# Put the jobs of a sheet that hasn't been plotted back at the head of the queue, in their order on the sheet
+# Jobs of a declined sheet aren't ganged again, so the operator is asked for each of them on its own
+# A job moved to the place of the sheet (see move) goes before them
+async def ungang(sheet, declined = False, before = None):
+    global _num_sheets
+    if _jobs.get(sheet['client']) is not sheet: return # taken apart already
+    plotter = job_plotter(sheet)
+    if plotter != None: plotter.job = None
+    _num_sheets -= 1
+    del _jobs[ sheet['client'] ]
+    sheet['status'] = 'canceled'
+    for x in reversed(sheet['members']):
+        x['sheet'] = None
+        if declined: x['no_gang'] = True
+        queue.insert(0, x)
+    if before != None:
+        queue.remove(before)
+        queue.insert(0, before)
+        _journal_place(before)
+    for x in reversed(sheet['members']): _journal_place(x)
+    if plotter != None: cancel_prompt_ui(plotter) # the plotter takes the next job (see run_plotter)
+    print(f'📄 [yellow]Took apart \\[{sheet["client"]}], its jobs are back in the queue')
+    await _notify_queue_size()
+    await _notify_queue_positions(0)
+
+# A plot error concerns the whole sheet, so all jobs on it get the error. They stay on the sheet, which is retried
+# or canceled by the operator
+async def _sheet_error(msg, sheet):
+    await asyncio.gather(*[ callback(job['error_cb'], msg, job) for job in sheet['members'] ])
 
-async def align_async():
-    return await asyncio.to_thread(align)
+async def align_async(port = None):
+    return await asyncio.to_thread(align, port)
 
-async def cycle_async():
-    return await asyncio.to_thread(cycle)
+async def cycle_async(port = None):
+    return await asyncio.to_thread(cycle, port)
 
 async def resume_plot_async(*args, **kwargs):
     return await asyncio.to_thread(resume_plot, *args, **kwargs)
@@ -538,22 +1133,22 @@ async def resume_plot_async(*args, **kwargs):
 async def resume_home_async(*args, **kwargs):
     return await asyncio.to_thread(resume_home, *args, **kwargs)
 
-async def prompt_setup(message = 'Press \'Done\' when ready'):
+async def prompt_setup(plotter, message = 'Press \'Done\' when ready'):
     while True:
-        res = await prompt_ui('setup', message)
+        res = await prompt_ui(plotter, 'setup', message)
         res = res['id']
         if res == 'align': # Align
             print('Aligning...')
-            await align_async() # -> prompt again
+            await align_async(plotter.port) # -> prompt again
         elif res == 'cycle': # Cycle
             print('Cycling...')
-            await cycle_async() # -> prompt again
+            await cycle_async(plotter.port) # -> prompt again
         elif res == 'neg' : # Finish
             return True
 
-async def prompt_waiting(message = 'Setup as needed'):
+async def prompt_waiting(plotter, message = 'Setup as needed'):
     while True:
-        res = await prompt_ui('waiting', message)
+        res = await prompt_ui(plotter, 'waiting', message)
         if not res:
             # print('prompt cancelled')
             return False # the prompt was intentionally cancelled
@@ -561,17 +1156,17 @@ async def prompt_waiting(message = 'Setup as needed'):
         res = res['id']
         if res == 'align': # Align
             print('Aligning...')
-            await align_async() # -> prompt again
+            await align_async(plotter.port) # -> prompt again
         elif res == 'cycle': # Cycle
             print('Cycling...')
-            await cycle_async() # -> prompt again
+            await cycle_async(plotter.port) # -> prompt again
 
-def cancel_prompt_waiting():
-    cancel_prompt_ui()
+def cancel_prompt_waiting(plotter):
+    cancel_prompt_ui(plotter)
 
-async def prompt_start_plot(message):
+async def prompt_start_plot(plotter, message):
     while True:
-        res = await prompt_ui('start_plot', message)
+        res = await prompt_ui(plotter, 'start_plot', message)
         if not res: return False # the prompt was intentionally cancelled -> Cancel plotting
         
         res = res['id']
@@ -579,124 +1174,234 @@ async def prompt_start_plot(message):
             return True
         elif res == 'align': # Align
             print('Aligning...')
-            await align_async() # -> prompt again
+            await align_async(plotter.port) # -> prompt again
         elif res == 'cycle': # Cycle
             print('Cycling...')
-            await cycle_async() # -> prompt again
+            await cycle_async(plotter.port) # -> prompt again
         elif res == 'neg': # Cancel
             return False
 
-async def prompt_plotting(message = ''):
-    return await prompt_ui('plotting', message);
+async def prompt_plotting(plotter, message = ''):
+    return await prompt_ui(plotter, 'plotting', message);
 
-async def prompt_repeat_plot(message):
+async def prompt_repeat_plot(plotter, message):
     while True:
-        res = await prompt_ui('repeat_plot', message)
+        res = await prompt_ui(plotter, 'repeat_plot', message)
         res = res['id']
         if res == 'pos': # Start Plot
             return True
         elif res == 'align': # Align
             print('Aligning...')
-            await align_async() # -> prompt again
+            await align_async(plotter.port) # -> prompt again
         elif res == 'cycle': # Cycle
             print('Cycling...')
-            await cycle_async() # -> prompt again
+            await cycle_async(plotter.port) # -> prompt again
         elif res == 'neg': # Done
             return False
 
-async def prompt_resume_plot(message, job):
+async def prompt_resume_plot(plotter, message, job):
     while True:
-        res = await prompt_ui('resume_plot', message)
+        res = await prompt_ui(plotter, 'resume_plot', message)
         res = res['id']
         
         if res == 'pos': # Resume Plot
             return True
         elif res == 'home': # Home
             print('Returning home...')
-            await resume_home_async(job) # -> prompt again
+            await resume_home_async(job, plotter = plotter) # -> prompt again
         elif res == 'align': # Align
             print('Aligning...')
-            await align_async() # -> prompt again
+            await align_async(plotter.port) # -> prompt again
         elif res == 'cycle': # Cycle
             print('Cycling...')
-            await cycle_async() # -> prompt again
+            await cycle_async(plotter.port) # -> prompt again
         elif res == 'neg': # Done
             return False
 
+# Job of an svg saved by the spooler (see spool_reader.py)
 def svg_to_job(svg, filename = None):
-    NS = 'https://sketch.process.studio/turtle-graphics'
-    root = ElementTree.fromstring(svg)
-    
-    def attr(attr, ns = NS):
-        return root.get(attr if ns == None else "{" + ns + "}" + attr)
-    
-    received_ts = None
-    if filename != None:
-        match = re.search('\\d{8}_\\d{6}', os.path.basename(filename))
-        if match != None: received_ts = match.group(0)
-    
-    job = {
-        'loaded_from_file': True,
-        'client': attr('author'),
-        'id': "XYZ",
-        'svg': svg,
-        'stats': {
-            'count': int(attr('count')),
-            'layer_count': int(attr('layer_count')),
-            'oob_count': int(attr('oob_count')),
-            'short_count': int(attr('short_count')),
-            'travel': int(attr('travel')),
-            'travel_ink': int(attr('travel_ink')),
-            'travel_blank': int(attr('travel_blank'))
-        },
-        'timestamp': attr('timestamp'),
-        'speed': int(attr('speed')),
-        'format': attr('format'),
-        'size': [int(attr('width_mm')), int(attr('height_mm'))],
-        'hash': hashlib.sha1(svg.encode('utf-8')).hexdigest(),
-        'received': received_ts,
-        'save_path': filename,
-    }
-    
-    return job
+    return spool_reader.svg_to_job(svg, filename, DIGEST_ALGORITHM)
     
 
+# Restore the state of a job resumed from disk, as kept in the journal: when it was received, its speed and time
+# estimate (so it isn't simulated again), and the progress of a plot that was interrupted by the restart
+def restore_state(job, state):
+    for key in ['received', 'speed', 'time_estimate', 'time_estimate_source', 'layers', 'layer_estimates']:
+        if state.get(key) != None: job[key] = state[key]
+    if 'layers' not in job: job.pop('time_estimate', None) # incomplete, simulate again
+    
+    status = state.get('status') # plotting | paused | plotted (waiting for repeat or done)
+    if status == 'paused':
+        try:
+            with open(state['output'], 'r', encoding='utf-8') as f: job['output_svg'] = f.read()
+        except (KeyError, OSError):
+            status = 'plotting' # can't be continued, plot it again
+    if status in ['plotting', 'paused', 'plotted']:
+        job['progress'] = {
+            'status': status,
+            'loop': state.get('loop', 0),
+            'layer': state.get('layer', 0) if status == 'paused' else 0,
+            'interrupt': state.get('interrupt', 0) if status == 'paused' else 0,
+            'plotter': state.get('plotter'), # name of the plotter, its paper is still on it
+        }
+
+# Received time of a resumed job that isn't in the journal (and not in the file name): when its spool file was written
+def received_from_file(job):
+    try:
+        return timestamp_str(datetime.fromtimestamp(os.path.getmtime(job['save_path'])))
+    except (OSError, KeyError, TypeError):
+        return timestamp_str()
+
+# Queue jobs resumed from disk, all at once. They have been validated, cleaned up and optimized before
+# Time estimates come from the journal (see restore_state) or the simulation cache. Jobs without one are queued with
+# an estimate of 0 and estimated in the background, after new jobs (see _estimate_resumed)
+async def enqueue_resumed(jobs):
+    cached = {}
+    missing = [ job for job in jobs if recovered_simulation(job) == None ]
+    if _simulation_cache != None and len(missing) > 0:
+        sims = await run_in_simulation_thread(lambda: [ _simulation_cache.get(simulation_cache_key(job)) for job in missing ])
+        cached = { id(job): sim for job, sim in zip(missing, sims) }
+    
+    offset = _queue_offset()
+    start = offset + queue.qsize()
+    for job in jobs:
+        if job['client'] in _jobs:
+            print(f'⚠️  [yellow]Job \\[{job["client"]}] is queued already, not resuming {job["save_path"]}')
+            continue
+        job['status'] = 'waiting'
+        job['cancel'] = False
+        for key in ['queue_position_cb', 'done_cb', 'cancel_cb', 'error_cb']: job[key] = None
+        if job.get('received') == None: job['received'] = received_from_file(job)
+        ingest.normalize_job(job, MIN_SPEED)
+        
+        sim = recovered_simulation(job) or cached.get(id(job))
+        if sim != None: apply_simulation(job, sim)
+        else:
+            job['time_estimate'] = 0 # until estimated
+            job['time_estimate_source'] = 'pending' # plotted last by sjf (see scheduler.py)
+            job['layers'] = job['stats']['layer_count']
+        _jobs[ job['client'] ] = job
+        plotter = own_plotter(job)
+        if plotter != None: plotter.job = job
+        else: queue.put_nowait(job)
+        save_svg(job) # files with other names are renamed (see waiting_name)
+        _journal.add(waiting_name(job), received = job['received'], **(_estimate_state(job) if sim != None else {}))
+        
+        if sim == None: background( _estimate_resumed(job) )
+        elif sim.get('analytic'): background( refine_estimate(job) )
+    
+    await _notify_queue_size()
+    await _notify_queue_positions(start if _queue_offset() == offset else 0) # jobs taken back by their plotters come first
+
+# The plotter that was plotting a job when it was interrupted by a restart, if it is free. It takes the job back before
+# any other (see run_plotter). None if the plotter doesn't exist anymore, then the job is first in queue for any plotter
+# (see scheduler.py)
+def own_plotter(job):
+    name = (job.get('progress') or {}).get('plotter')
+    if name == None: return None
+    return next( (p for p in _plotters if p.name == name and p.job == None), None )
+
+# Estimate a job that was resumed without an estimate (see enqueue_resumed), in the background after new jobs
+async def _estimate_resumed(job):
+    speed = job['speed']
+    if FAST_ESTIMATE:
+        async with _admission.slot(background = True): # new jobs go first
+            sim = await estimate_async(job) if _jobs.get(job['client']) is job else None
+        if sim != None and _jobs.get(job['client']) is job and job['speed'] == speed: # not finished, canceled or changed in the meantime
+            apply_simulation(job, sim)
+            await _estimate_changed(job)
+    await refine_estimate(job)
+
+# Waiting jobs are loaded from the headers of their spool files in parallel (see spool_reader.py), in the order of
+# the journal, and queued at once
 async def resume_queue_from_disk():
-    import xml.etree.ElementTree as ElementTree
     try:
-        list = sorted(os.listdir(STATUS_FOLDERS['waiting']))
-        list = [ os.path.join(STATUS_FOLDERS['waiting'], x) for x in list if x.endswith('.svg') ]
+        names = [ x for x in os.listdir(STATUS_FOLDERS['waiting']) if x.endswith('.svg') ]
+    except FileNotFoundError:
+        names = []
+    # in the order of the journal, files that aren't in it at the end (e.g. saved with positions in their names)
+    _journal.retain(names) # forget jobs whose files are gone
+    order = _journal.order()
+    names = order + sorted( set(names).difference(order) )
+    outputs = { _journal.state(x).get('output') for x in order }
+    try:
+        for entry in os.scandir(OUTPUT_FOLDER):
+            if entry.path not in outputs: os.remove(entry.path) # of jobs that are gone
     except FileNotFoundError:
-        list = []
+        pass
+    paths = [ os.path.join(STATUS_FOLDERS['waiting'], x) for x in names ]
     
+    loaded = await asyncio.to_thread(spool_reader.load_all, paths, RESUME_WORKERS, DIGEST_ALGORITHM)
     resumable_jobs = []
-    for filename in list:
-        # print('Loading ', filename)
-        try:
-            with open(filename, 'r') as file: svg = file.read()
-            job = svg_to_job(svg, filename)
-            resumable_jobs.append(job)
-        except:
+    for filename, job in zip(paths, loaded):
+        if isinstance(job, Exception):
             print('Error resuming ', filename)
+            continue
+        restore_state(job, _journal.state(os.path.basename(filename)))
+        status = job['progress']['status'] if 'progress' in job else None
+        if status == 'paused': print(f'⚠️  [yellow]Job \\[{job["client"]}] was paused, it can be continued')
+        elif status == 'plotting': print(f'⚠️  [yellow]Job \\[{job["client"]}] was interrupted while plotting')
+        resumable_jobs.append(job)
     
     if len(resumable_jobs) > 0: print(f"Resuming {len(resumable_jobs)} jobs...")
     else: print("No jobs to resume")
-    for job in resumable_jobs:
-        await enqueue(job)
+    await enqueue_resumed(resumable_jobs)
+
+
+# Move spool files of finished, canceled and failed jobs that are older than ARCHIVE_AFTER into the archive
+# Returns the number of archived files. Runs in a thread (see archive_periodically)
+def archive_old_files(days = ARCHIVE_AFTER):
+    cutoff = datetime.now().timestamp() - days * 24 * 60 * 60
+    count = 0
+    for status in ['finished', 'canceled', 'error']:
+        try:
+            entries = [ x for x in os.scandir(STATUS_FOLDERS[status]) if x.name.endswith('.svg') and x.is_file() ]
+        except FileNotFoundError:
+            continue
+        paths = sorted( x.path for x in entries if x.stat().st_mtime < cutoff )
+        if len(paths) > 0: count += _archive.add(paths, status)
+    return count
+
+async def archive_periodically(interval = 24 * 60 * 60):
+    while True:
+        try:
+            count = await asyncio.to_thread(archive_old_files)
+            if count > 0: print(f'Archived {count} spool files')
+        except Exception as e:
+            print(f'⚠️  [red]Error archiving spool files: {e}')
+        await asyncio.sleep(interval)
+
+# Archived jobs, by digest (or a prefix), client, date (YYYYMMDD or YYYYMMDD_HHMMSS) or status (see Archive.find)
+def find_archived(**kwargs):
+    return _archive.find(**kwargs)
+
+# Queue an archived job again, straight from the archive
+# Like jobs resumed from disk it is loaded_from_file: archived svgs were cleaned up and optimized before they were
+# plotted, so that is skipped (see enqueue). It has no time estimate, so it's taken from the simulation cache or
+# estimated again
+async def reprint(entry, queue_position_cb = None, done_cb = None, cancel_cb = None, error_cb = None, validating_cb = None):
+    try:
+        svg = ( await asyncio.to_thread(_archive.read, entry) ).decode('utf-8')
+        job = svg_to_job(svg)
+    except Exception as e:
+        print(f'⚠️  [red]Error reading archived job {entry["name"]}: {e}')
+        await callback( error_cb, 'Cannot reprint job, it could not be read from the archive!', None )
+        return False
+    print(f'Reprinting archived job \\[{job["client"]}] {entry["name"]}')
+    return await enqueue(job, queue_position_cb, done_cb, cancel_cb, error_cb, validating_cb)
 
 
-def set_status(status):
-    global _status
-    _status = status
+def set_status(plotter, status):
+    plotter.status = status
     print_status()
 
 async def start(app):
-    global _current_job
-    global _status
-    
     global print
     print = app.print
     
+    global _loop
+    _loop = asyncio.get_running_loop()
+    
     global tprint
     tprint = app.tprint
     
@@ -708,83 +1413,116 @@ async def start(app):
     print_status = app.update_header
     
     if TESTING: print('[yellow]TESTING MODE enabled')
+    simulation_pool().start() # start worker processes early, so they are warm for the first job
     if RESUME_QUEUE: await resume_queue_from_disk()
+    if ARCHIVE_AFTER != None: background( archive_periodically() )
     
-    await align_async()
-    # await prompt_setup()
+    await asyncio.gather(*[ run_plotter(plotter) for plotter in _plotters ])
+
+# Worker loop of a plotter: takes jobs from the queue and plots them
+async def run_plotter(plotter):
+    await align_async(plotter.port)
+    # await prompt_setup(plotter)
     
     while True:
-        # get the next job from the queue, waits until a job becomes available
-        if queue.empty():
-            set_status('waiting')
-            asyncio.create_task( prompt_waiting() ) # this allows align/cycle
-        _current_job = await queue.get()
-        cancel_prompt_waiting()
-        update_positions_and_save()
+        # a job this plotter was plotting before a restart is its current job already (see enqueue_resumed)
+        if plotter.job == None:
+            # get the next job from the queue, waits until a job becomes available
+            if queue.empty():
+                set_status(plotter, 'waiting')
+                background( prompt_waiting(plotter) ) # this allows align/cycle
+            plotter.job = await queue.get()
+            cancel_prompt_waiting(plotter)
+            await _notify_queue_positions(0, _queue_offset() + queue.picked) # the current jobs after this plotter's and the jobs before the picked one move down
+        _journal_place(plotter.job)
+        progress = plotter.job.pop('progress', None) # the plot was interrupted by a restart (see restore_state)
+        if GANG_JOBS and not plotter.job['cancel'] and progress == None: await gang(plotter)
         
-        if not _current_job['cancel']: # skip if job is canceled
-            set_status('confirm_plot')
-            ready = await prompt_start_plot(f'[green]Ready to plot[/green] job \\[{_current_job["client"]}] ?')
-            if not ready:
-                await cancel_current_job()
-                set_status('waiting')
-                _current_job = None
-                continue # skip over rest of the loop
-            
+        if not plotter.job['cancel']: # skip if job is canceled
             # plot (and retry on error or repeat)
             loop = 0 # number or tries/repetitions
             layer = 0 # number of programmatic pauses (error 1)
             interrupt = 0 # number of stops by button press (error 102) or keyboard interrupt (103)
             resume = False # flag indicating resume (vs. plotting from start)
+            if progress != None: loop, layer, interrupt = progress['loop'], progress['layer'], progress['interrupt']
+            
+            set_status(plotter, 'confirm_plot')
+            if progress != None and progress['status'] == 'paused':
+                prompt = "[blue]Continue paused job[/blue]"
+                if plotter.job['layers'] > 1: prompt += f" layer ({layer+1}/{plotter.job['layers']})"
+                ready = await prompt_resume_plot(plotter, f'{prompt} \\[{plotter.job["client"]}] ?', plotter.job)
+                if ready: resume = True
+                else:
+                    resume = 'skip_to_repeat' # Skip to asking to repeat job
+                    plotter.job['status'] = 'ok' # set status to 'successfully printed'
+            elif progress != None and progress['status'] == 'plotted':
+                resume = 'skip_to_repeat'
+            else:
+                message = '[yellow]Plot interrupted job again' if progress != None else '[green]Ready to plot'
+                ready = await prompt_start_plot(plotter, f'{message}[/] job \\[{plotter.job["client"]}] ?')
+                if plotter.job == None: # a sheet that was taken apart while waiting (see ungang)
+                    set_status(plotter, 'waiting')
+                    continue
+                if not ready:
+                    if plotter.job.get('members') != None: await ungang(plotter.job, declined = True)
+                    else: await cancel_current_job(plotter)
+                    set_status(plotter, 'waiting')
+                    plotter.job = None
+                    continue # skip over rest of the loop
+            
             while True:
-                set_status('plotting')
-                await prompt_plotting(f'\\[{_current_job["client"]}]') # this returns immediately
+                set_status(plotter, 'plotting')
+                _journal.update(waiting_name(plotter.job), status = 'plotting', plotter = plotter.name, loop = (loop - 1 if resume == True else loop)) # if interrupted, it is plotted again from start after a restart
+                await prompt_plotting(plotter, f'\\[{plotter.job["client"]}]') # this returns immediately
                 if (resume == 'skip_to_repeat'):
                     error = 0
                 elif resume:
-                    print(f'🖨️  [yellow]Resuming job \\[{_current_job["client"]}] ...')
-                    error = await resume_plot_async(_current_job)
+                    print(f'🖨️  [yellow]Resuming job \\[{plotter.job["client"]}] ...')
+                    error = await resume_plot_async(plotter.job, plotter = plotter)
                 else:
                     loop += 1
-                    print(f'🖨️  [yellow]Plotting job \\[{_current_job["client"]}] ...')
-                    await _notify_queue_positions() # notify plotting
-                    error = await plot_async(_current_job)
+                    print(f'🖨️  [yellow]Plotting job \\[{plotter.job["client"]}] ...')
+                    await _notify_queue_positions(0, _queue_offset()) # notify plotting
+                    error = await plot_async(plotter.job, plotter = plotter)
                 resume = False
                 # No error
                 if error == 0:
                     if REPEAT_JOBS:
-                        print(f'[blue]Done ({loop}x) job \\[{_current_job["client"]}]')
-                        set_status('confirm_plot')
+                        print(f'[blue]Done ({loop}x) job \\[{plotter.job["client"]}]')
+                        set_status(plotter, 'confirm_plot')
                         layer = 0
                         interrupt = 0
-                        repeat = await prompt_repeat_plot(f'[yellow]Repeat ({loop+1}) job[/yellow] \\[{_current_job["client"]}] ?')
+                        _journal.update(waiting_name(plotter.job), status = 'plotted', plotter = plotter.name, loop = loop)
+                        repeat = await prompt_repeat_plot(plotter, f'[yellow]Repeat ({loop+1}) job[/yellow] \\[{plotter.job["client"]}] ?')
                         if repeat: continue
-                    await finish_current_job()
+                    await finish_current_job(plotter)
                     break
                 # Paused programmatically (1), Stopped by pause button press (102) or Stopped by keyboard interrupt (103)
                 elif error in PLOTTER_PAUSED:
                     print(f'[yellow]Plotter: {get_error_msg(error)}')
-                    set_status('paused')
+                    set_status(plotter, 'paused')
                     if error in [1]:
                         layer += 1
-                        prompt = f"[blue]Continue layer ({layer+1}/{_current_job['layers']})[/blue]"
+                        prompt = f"[blue]Continue layer ({layer+1}/{plotter.job['layers']}{layer_estimate_str(plotter.job, layer)})[/blue]"
                     elif error in [102, 103]:
                         interrupt += 1
                         prompt = f"[blue]Continue ({interrupt+1}) interrupted job[/blue]"
-                        if _current_job['layers'] > 1: prompt += f" layer ({layer+1}/{_current_job['layers']})"
-                    ready = await prompt_resume_plot(f'{prompt} \\[{_current_job["client"]}] ?', _current_job)
+                        if plotter.job['layers'] > 1: prompt += f" layer ({layer+1}/{plotter.job['layers']})"
+                    output = await save_output_async(plotter.job) # continue from here after a restart
+                    if output != None: _journal.update(waiting_name(plotter.job), status = 'paused', plotter = plotter.name, loop = loop, layer = layer, interrupt = interrupt, output = output)
+                    ready = await prompt_resume_plot(plotter, f'{prompt} \\[{plotter.job["client"]}] ?', plotter.job)
                     if ready: resume = True
                     else:
                         resume = 'skip_to_repeat' # Skip to asking to repeat job
-                        _current_job['status'] = 'ok' # set status to 'successfully printed'
+                        plotter.job['status'] = 'ok' # set status to 'successfully printed'
                 # Errors
                 else:
                     print(f'[red]Plotter: {get_error_msg(error)}')
-                    set_status('confirm_plot')
-                    ready = await prompt_start_plot(f'[red]Retry job \\[{_current_job["client"]}] ?')
+                    set_status(plotter, 'confirm_plot')
+                    ready = await prompt_start_plot(plotter, f'[red]Retry job \\[{plotter.job["client"]}] ?')
                     if not ready:
-                        await cancel(_current_job['client'], force = True)
+                        await cancel(plotter.job['client'], force = True)
                         break
-                        
-            set_status('waiting')
-        _current_job = None
+            
+            set_status(plotter, 'waiting')
+        plotter.job = None
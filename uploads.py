@@ -0,0 +1,184 @@
+import os
+import re
+import time
+import digest
+
+# Chunked uploads of large svgs
+# Chunks are appended to a part file in the upload folder and hashed as they arrive (see digest.py),
+# so memory per upload stays constant regardless of the size of the drawing
+# Interrupted uploads can be resumed: beginning an upload with the same id continues at the end of the part file
+# The methods do blocking file io, use asyncio.to_thread when calling them from the event loop
+
+READ_SIZE = 2**20 # block size for rehashing part files
+UPLOAD_ID = re.compile(r'[A-Za-z0-9_-]{1,64}')
+
+class Upload:
+    def __init__(self, folder, upload_id, client, size, algorithm = None):
+        self.id = upload_id
+        self.client = client
+        self.size = size
+        self.path = os.path.join(folder, upload_id + '.part')
+        self.meta = None # plot message (without svg) the upload was started with
+        self.hash = digest.new(algorithm)
+        self.offset = 0
+        self.touched = time.time()
+        
+        # resume from a previous part file (e.g. after a server restart)
+        if os.path.isfile(self.path):
+            if os.path.getsize(self.path) > size: os.remove(self.path) # not the same upload
+            else:
+                with open(self.path, 'rb') as f:
+                    for block in iter(lambda: f.read(READ_SIZE), b''):
+                        self.hash.update(block)
+                        self.offset += len(block)
+        os.makedirs(folder, exist_ok=True)
+        self.file = open(self.path, 'ab')
+    
+    # Append data at offset (needs to be the current offset)
+    def write(self, offset, data):
+        if self.file == None: raise ValueError('Upload is already finished')
+        if offset != self.offset: raise ValueError(f'Wrong upload offset {offset} (expected {self.offset})')
+        if self.offset + len(data) > self.size: raise ValueError('Upload is larger than announced')
+        self.file.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+        self.touched = time.time()
+    
+    def complete(self):
+        return self.offset == self.size
+    
+    # Close the part file and return the digest of the uploaded data
+    def finish(self):
+        if not self.complete(): raise ValueError(f'Upload is incomplete ({self.offset} of {self.size} bytes)')
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        return self.hash.hexdigest()
+    
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+class Uploads:
+    def __init__(self, folder, max_size = 200 * 2**20, expiry = 24 * 60 * 60, algorithm = None):
+        self.folder = folder
+        self.algorithm = algorithm # digest algorithm (see digest.py)
+        self.max_size = max_size # bytes per upload
+        self.expiry = expiry # seconds after which unfinished uploads are removed
+        self.uploads = {}
+    
+    # Start or resume an upload; check upload.offset for where to continue
+    def begin(self, upload_id, client, size):
+        if not UPLOAD_ID.fullmatch(upload_id): raise ValueError('Invalid upload id')
+        if size <= 0: raise ValueError('Invalid upload size')
+        if size > self.max_size: raise ValueError(f'Upload is too large (max. {self.max_size // 2**20} MB)')
+        self.expire()
+        upload = self.uploads.get(upload_id)
+        if upload != None:
+            if upload.client != client: raise ValueError('Upload id is already in use')
+            if upload.size != size or upload.file == None: # restart
+                self.discard(upload_id)
+                upload = None
+        if upload == None:
+            upload = Upload(self.folder, upload_id, client, size, self.algorithm)
+            self.uploads[upload_id] = upload
+        upload.touched = time.time()
+        return upload
+    
+    def get(self, upload_id):
+        if upload_id not in self.uploads: raise ValueError('Unknown upload (begin the upload again)')
+        return self.uploads[upload_id]
+    
+    # Forget the upload and remove its part file (if it hasn't been moved)
+    def discard(self, upload_id):
+        upload = self.uploads.pop(upload_id, None)
+        if upload == None: return
+        upload.close()
+        try: os.remove(upload.path)
+        except OSError: pass
+    
+    # Remove unfinished uploads that haven't been touched within the expiry time
+    def expire(self):
+        now = time.time()
+        for upload in list(self.uploads.values()):
+            if now - upload.touched > self.expiry: self.discard(upload.id)
+        try:
+            entries = list(os.scandir(self.folder))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if not entry.name.endswith('.part') or entry.name[:-5] in self.uploads: continue
+            try:
+                if now - entry.stat().st_mtime > self.expiry: os.remove(entry.path)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    import unittest
+    import tempfile
+    
+    class Test(unittest.TestCase):
+        def setUp(self):
+            self.tmp = tempfile.TemporaryDirectory()
+            self.folder = os.path.join(self.tmp.name, 'uploads')
+            self.uploads = Uploads(self.folder, max_size = 1000)
+        
+        def tearDown(self):
+            for upload in self.uploads.uploads.values(): upload.close()
+            self.tmp.cleanup()
+        
+        def test_upload(self):
+            data = b'<svg>' + b'x' * 500 + b'</svg>'
+            upload = self.uploads.begin('abc', 'client', len(data))
+            self.assertEqual(upload.offset, 0)
+            for i in range(0, len(data), 100):
+                upload.write(i, data[i:i+100])
+            self.assertEqual(upload.finish(), digest.digest(data))
+            with open(upload.path, 'rb') as f: self.assertEqual(f.read(), data)
+            self.uploads.discard('abc')
+            self.assertFalse(os.path.exists(upload.path))
+        
+        def test_errors(self):
+            with self.assertRaises(ValueError): self.uploads.begin('../x', 'client', 10)
+            with self.assertRaises(ValueError): self.uploads.begin('abc', 'client', 1001)
+            with self.assertRaises(ValueError): self.uploads.get('abc')
+            upload = self.uploads.begin('abc', 'client', 10)
+            with self.assertRaises(ValueError): self.uploads.begin('abc', 'other', 10)
+            with self.assertRaisesRegex(ValueError, 'offset'): upload.write(5, b'12345')
+            upload.write(0, b'12345')
+            with self.assertRaisesRegex(ValueError, 'larger'): upload.write(5, b'123456')
+            with self.assertRaisesRegex(ValueError, 'incomplete'): upload.finish()
+        
+        def test_resume(self):
+            data = bytes(range(256)) * 3
+            upload = self.uploads.begin('abc', 'client', len(data))
+            upload.write(0, data[:300])
+            # same server
+            self.assertIs(self.uploads.begin('abc', 'client', len(data)), upload)
+            # after a restart
+            upload.close()
+            uploads = Uploads(self.folder, max_size = 1000)
+            upload = uploads.begin('abc', 'client', len(data))
+            self.assertEqual(upload.offset, 300)
+            upload.write(300, data[300:])
+            self.assertEqual(upload.finish(), digest.digest(data))
+        
+        def test_algorithm(self):
+            uploads = Uploads(self.folder, algorithm = 'sha1')
+            upload = uploads.begin('abc', 'client', 3)
+            upload.write(0, b'abc')
+            self.assertEqual(upload.finish(), digest.digest(b'abc', 'sha1'))
+        
+        def test_expire(self):
+            upload = self.uploads.begin('abc', 'client', 10)
+            upload.write(0, b'12345')
+            upload.touched -= 100
+            os.utime(upload.path, (0, 0))
+            self.uploads.expiry = 50
+            self.uploads.expire()
+            self.assertEqual(self.uploads.uploads, {})
+            self.assertEqual(os.listdir(self.folder), [])
+    
+    unittest.main()